@@ -1,11 +1,23 @@
-from flask import Flask, render_template, request, jsonify
+import time
+_T_INICIO = time.perf_counter()  # para el informe de arranque
+
+from flask import Flask, render_template, request, jsonify, g, Response
 import os
+import io
+import csv
+import json
+import datetime
+import uuid
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import database
 import ocr_service
+import jobs
+import http_cache
+import eventos
+import metricas
 from werkzeug.utils import secure_filename
 
 import sys
@@ -25,10 +37,81 @@ UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'csv'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+app.config['MAX_CONTENT_LENGTH'] = 128 * 1024 * 1024  # 128MB max (lotes de varias fotos)
+
+# Métricas por ruta. Se registra antes que http_cache para que el cronómetro
+# arranque aunque éste responda 304 sin llegar a la vista (y, al revés, su
+# after_request se ejecuta el último, con el estado final).
+@app.before_request
+def _iniciar_metricas():
+    if metricas.ACTIVO:
+        metricas.iniciar_peticion(request.endpoint or 'sin_ruta')
+
+@app.after_request
+def _registrar_metricas(resp):
+    ctx = metricas.terminar_peticion(request.endpoint, request.method, resp.status_code, request.path)
+    if ctx is not None:
+        # Visible en la pestaña Network de las DevTools
+        resp.headers['Server-Timing'] = (f'app;dur={ctx["segundos"] * 1000:.1f}, '
+                                         f'db;dur={ctx["sql_s"] * 1000:.1f};desc="{ctx["consultas"]} consultas", '
+                                         f'escritor;dur={ctx["escritura_s"] * 1000:.1f}')
+        if ctx.get('perfil_id'):
+            resp.headers['X-Perfil'] = ctx['perfil_id']
+    return resp
+
+http_cache.init_app(app)
+
+# Cambios de la BD -> terminales conectados a /api/events
+canal_eventos = eventos.CanalEventos()
+esperas_trabajos = eventos.Cupo(eventos.MAX_ESPERAS_TRABAJOS)
+database.add_change_listener(canal_eventos.publicar)
+
+# Los albaranes se procesan en segundo plano (ver jobs.py)
+ocr_jobs = jobs.JobQueue()
 
-# Asegurar que existe la BD
-database.init_db()
+# Archivo por años, vacuum y copias: tareas largas, de una en una y sin reintentos
+mantenimiento_jobs = jobs.JobQueue(workers=1, max_pendientes=5, max_intentos=1,
+                                   timeout=float(os.environ.get('TPV_MAINTENANCE_TIMEOUT', 4 * 3600)))
+
+# Estado actual de pool, escritor, cachés y colas en /api/metrics
+for _nombre, _ayuda, _fn in [
+    ('tpv_db_pool_in_use', 'Conexiones del pool en uso', lambda: database.get_pool().stats()['in_use']),
+    ('tpv_db_pool_created', 'Conexiones abiertas por el pool', lambda: database.get_pool().stats()['created']),
+    ('tpv_db_pool_waits', 'Esperas acumuladas por una conexión libre', lambda: database.get_pool().stats()['waits']),
+    ('tpv_db_write_queue', 'Escrituras esperando al escritor', lambda: database.get_writer_stats().get('en_cola')),
+    ('tpv_scan_cache_size', 'Productos en la caché de escaneo', lambda: database.get_scan_cache_stats()['size']),
+    ('tpv_scan_cache_hit_ratio', 'Aciertos de la caché de escaneo', lambda: database.get_scan_cache_stats()['hit_ratio']),
+    ('tpv_ocr_jobs_queued', 'Albaranes en cola', lambda: ocr_jobs.stats()['en_cola']),
+    ('tpv_events_clients', 'Terminales conectados a /api/events', lambda: canal_eventos.stats()['clientes']),
+    ('tpv_data_version', 'Versión de los datos (version_datos)', database.get_data_version),
+]:
+    metricas.registrar_indicador(_nombre, _ayuda, _fn)
+
+# La BD se inicializa/migra en la primera petición (o antes, desde main.py),
+# no al importar el módulo: el arranque del .exe no espera a SQLite.
+STARTUP_TIMINGS = {}
+
+def preparar_bd():
+    t = time.perf_counter()
+    if database.ensure_initialized():
+        STARTUP_TIMINGS['db_ms'] = round((time.perf_counter() - t) * 1000, 1)
+
+@app.before_request
+def _antes_de_peticion():
+    if 'primera_peticion_ms' not in STARTUP_TIMINGS:
+        g.t_primera_peticion = time.perf_counter()
+    preparar_bd()
+
+@app.after_request
+def _despues_de_peticion(resp):
+    t = g.pop('t_primera_peticion', None)
+    if t is not None and 'primera_peticion_ms' not in STARTUP_TIMINGS:
+        ahora = time.perf_counter()
+        STARTUP_TIMINGS['primera_peticion_ms'] = round((ahora - t) * 1000, 1)
+        STARTUP_TIMINGS['listo_ms'] = round((ahora - _T_INICIO) * 1000, 1)
+        print("Arranque: import {import_ms} ms, BD {db} ms, primera petición {primera_peticion_ms} ms "
+              "(listo en {listo_ms} ms)".format(db=STARTUP_TIMINGS.get('db_ms', 0), **STARTUP_TIMINGS))
+    return resp
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -41,20 +124,101 @@ def index():
 
 @app.route('/api/dashboard', methods=['GET'])
 def get_dashboard():
-    stats = database.get_dashboard_stats()
-    return jsonify(stats)
+    # ETag / 304 en http_cache (ligado a la versión de datos)
+    return jsonify(database.get_dashboard_stats())
+
+@app.route('/api/informes', methods=['GET'])
+def get_informe():
+    # ?periodo=mes|trimestre|año|semana|dia[&fecha=YYYY-MM-DD]  o  ?desde=...&hasta=...
+    periodo = request.args.get('periodo')
+    agrupar = request.args.get('agrupar', 'dia')
+    try:
+        if periodo:
+            desde, hasta = database.rango_periodo(periodo, request.args.get('fecha'))
+        else:
+            desde, hasta = request.args.get('desde'), request.args.get('hasta')
+            if not (desde and hasta):
+                return jsonify({'error': 'Indica periodo o desde/hasta'}), 400
+        return jsonify(database.get_report(desde, hasta, agrupar))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/startup', methods=['GET'])
+def get_startup():
+    return jsonify({**STARTUP_TIMINGS, 'schema_version': database.SCHEMA_VERSION})
+
+@app.route('/api/db/stats', methods=['GET'])
+def get_db_stats():
+    return jsonify(database.get_pool_stats())
+
+# --- MANTENIMIENTO (archivo por años, vacuum, copias de seguridad) ---
+# Se encolan y responden 202; el estado se sigue en /api/mantenimiento/trabajos/<id>
+
+@app.route('/api/mantenimiento', methods=['GET'])
+def get_mantenimiento():
+    return jsonify({**database.get_storage_stats(), 'trabajos': mantenimiento_jobs.list()})
+
+def _encolar_mantenimiento(fn, descripcion):
+    try:
+        job = mantenimiento_jobs.submit(fn, descripcion)
+    except jobs.ColaLlenaError as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    return jsonify({'success': True, 'job_id': job['id'], 'estado': job['estado']}), 202
+
+@app.route('/api/mantenimiento/archivar', methods=['POST'])
+def archivar_años():
+    # {"hasta_año": 2023} opcional; por defecto, los años cerrados salvo el último
+    hasta = (request.get_json(silent=True) or {}).get('hasta_año')
+    if hasta is not None and (not isinstance(hasta, int) or hasta >= datetime.date.today().year):
+        return jsonify({'error': 'hasta_año debe ser un año cerrado'}), 400
+    return _encolar_mantenimiento(lambda: database.archivar(hasta), f'Archivar hasta {hasta or "el último año cerrado"}')
+
+@app.route('/api/mantenimiento/vacuum', methods=['POST'])
+def vacuum():
+    return _encolar_mantenimiento(database.vacuum_incremental, 'Vacuum incremental')
+
+@app.route('/api/mantenimiento/copia', methods=['POST'])
+def copia_seguridad():
+    return _encolar_mantenimiento(database.copia_seguridad, 'Copia de seguridad')
+
+@app.route('/api/mantenimiento/trabajos/<job_id>', methods=['GET'])
+def get_trabajo_mantenimiento(job_id):
+    job = mantenimiento_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job)
+
+def _pagina_historial(obtener):
+    # ?desde=&hasta=YYYY-MM-DD (días locales) &limit=&cursor=
+    # La siguiente página se pide con el cursor de la cabecera X-Next-Cursor
+    try:
+        filas, siguiente = obtener(request.args.get('desde'), request.args.get('hasta'),
+                                   request.args.get('limit', type=int), request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    resp = jsonify(filas)
+    if siguiente:
+        resp.headers['X-Next-Cursor'] = siguiente
+    return resp
 
 @app.route('/api/ventas/historial', methods=['GET'])
 def get_historial_ventas():
-    ventas = database.get_recent_sales()
-    return jsonify(ventas)
+    return _pagina_historial(database.get_sales_page)
+
+@app.route('/api/producto/ventas', methods=['GET'])
+def get_ventas_producto():
+    code = request.args.get('code')
+    if not code: return jsonify({'error': 'Falta el código'}), 400
+    try:
+        return jsonify(database.get_product_sales(code, request.args.get('desde'), request.args.get('hasta')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 # --- GASTOS ---
 
 @app.route('/api/gastos', methods=['GET'])
 def get_gastos():
-    gastos = database.get_expenses()
-    return jsonify(gastos)
+    return _pagina_historial(database.get_expenses_page)
 
 @app.route('/api/gastos', methods=['POST'])
 def add_gasto():
@@ -76,11 +240,39 @@ def delete_gasto(id):
 
 # --- PRODUCTOS (Existentes) ---
 
+def _parse_fields():
+    fields = request.args.get('fields')
+    return [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+
 @app.route('/api/productos', methods=['GET'])
 def get_productos():
+    # ?search=&limit=&cursor=&fields=codigo,nombre  |  ?count=1
     search = request.args.get('search')
-    productos = database.get_all_products(search)
-    return jsonify(productos)
+    if request.args.get('count'):
+        return jsonify({'total': database.count_products(search)})
+
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', type=int)
+    try:
+        productos = database.get_all_products(search, limit=limit, cursor=cursor, fields=_parse_fields())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    resp = jsonify(productos)
+    # Página completa: puede haber más. El cliente pide la siguiente con ?cursor=
+    # (las búsquedas van por relevancia y no se paginan)
+    if limit and not search and len(productos) == min(limit, database.MAX_PAGE_SIZE):
+        resp.headers['X-Next-Cursor'] = str(productos[-1]['id'])
+    return resp
+
+@app.route('/api/productos/<int:id>', methods=['GET'])
+def get_producto(id):
+    try:
+        prod = database.get_product_by_id(id, _parse_fields())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if prod: return jsonify(prod)
+    return jsonify(None), 404
 
 @app.route('/api/productos', methods=['POST'])
 def add_producto():
@@ -93,19 +285,77 @@ def add_producto():
     
     if not all([codigo, nombre]):
         return jsonify({'error': 'Faltan datos'}), 400
+    stock_minimo = _stock_minimo(data.get('stock_minimo'))
+    if stock_minimo is False:
+        return jsonify({'error': 'stock_minimo debe ser un entero >= 0'}), 400
         
-    res = database.add_or_update_product(codigo, nombre, float(costo or 0), float(venta or 0), int(stock_add))
+    res = database.add_or_update_product(codigo, nombre, float(costo or 0), float(venta or 0), int(stock_add),
+                                         stock_minimo=stock_minimo)
     
     if res['success']:
         return jsonify({'message': 'Ok', 'action': res['action']}), 201
     else:
         return jsonify({'error': res['error']}), 500
 
+@app.route('/api/productos/bulk', methods=['POST'])
+def bulk_productos():
+    # {"productos": [{"codigo", "nombre", "costo", "venta", "stock"}, ...]}
+    productos = (request.json or {}).get('productos', [])
+    if not productos: return jsonify({'error': 'No hay productos'}), 400
+    res = database.bulk_upsert_products(productos)
+    if 'resultados' not in res:
+        return jsonify({'error': res['error']}), 500
+    return jsonify(res), 200 if res['success'] else 207
+
+def _stock_minimo(valor):
+    # None/'' = sin cambios; False = no válido
+    if valor is None or valor == '':
+        return None
+    try:
+        valor = int(valor)
+    except (TypeError, ValueError):
+        return False
+    return valor if valor >= 0 else False
+
+@app.route('/api/productos/<int:id>/stock-minimo', methods=['PUT', 'POST'])
+def set_stock_minimo(id):
+    stock_minimo = _stock_minimo((request.json or {}).get('stock_minimo'))
+    if stock_minimo is None or stock_minimo is False:
+        return jsonify({'error': 'stock_minimo debe ser un entero >= 0'}), 400
+    prod = database.set_stock_minimo(id, stock_minimo)
+    if prod is None:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    return jsonify(prod)
+
 @app.route('/api/productos/<int:id>', methods=['DELETE'])
 def delete_producto(id):
     database.delete_product(id)
     return jsonify({'message': 'Producto eliminado'})
 
+# --- STOCK ---
+
+@app.route('/api/stock/movimientos', methods=['POST'])
+def ajustar_stock():
+    # {"movimientos": [{"codigo"|"id", "delta"|"stock"}], "motivo": "...", "atomico": false}
+    data = request.json or {}
+    movimientos = data.get('movimientos', [])
+    if not movimientos: return jsonify({'error': 'No hay movimientos'}), 400
+    resultado = database.ajustar_stock(movimientos, data.get('motivo', 'ajuste'), bool(data.get('atomico')))
+    if 'aplicados' not in resultado:
+        return jsonify(resultado), 400 if 'errores' in resultado else 500
+    return jsonify(resultado), 200 if resultado['success'] else 207
+
+@app.route('/api/stock/movimientos', methods=['GET'])
+def get_movimientos_stock():
+    return jsonify(database.get_stock_movements(request.args.get('code'), request.args.get('limit', 100, type=int)))
+
+@app.route('/api/stock/reponer', methods=['GET'])
+def get_reposicion():
+    return jsonify(database.get_reorder_suggestions(
+        request.args.get('limit', 100, type=int),
+        request.args.get('dias', database.REPONER_DIAS_VENTAS, type=int),
+        request.args.get('cobertura', database.REPONER_COBERTURA, type=int)))
+
 @app.route('/api/producto/scan', methods=['GET'])
 def scan_producto():
     code = request.args.get('code')
@@ -113,6 +363,10 @@ def scan_producto():
     if prod: return jsonify(prod)
     return jsonify(None), 404
 
+@app.route('/api/producto/scan/stats', methods=['GET'])
+def scan_cache_stats():
+    return jsonify(database.get_scan_cache_stats())
+
 # --- VENTAS (Existente) ---
 @app.route('/api/venta', methods=['POST'])
 def crear_venta():
@@ -121,7 +375,18 @@ def crear_venta():
     if not items: return jsonify({'error': 'Ticket vacío'}), 400
     resultado = database.procesar_venta(items)
     if resultado['success']: return jsonify(resultado)
-    else: return jsonify({'error': resultado['error']}), 400
+    else: return jsonify({'error': resultado['error'], 'errores': resultado.get('errores', [])}), 400
+
+@app.route('/api/ventas/batch', methods=['POST'])
+def crear_ventas_batch():
+    data = request.json or {}
+    tickets = data.get('tickets', [])
+    if not tickets: return jsonify({'error': 'No hay tickets'}), 400
+    resultado = database.procesar_ventas_batch(tickets, atomico=bool(data.get('atomico')))
+    if 'resultados' not in resultado:
+        return jsonify({'error': resultado['error']}), 500
+    # 207: el lote se procesó pero algún ticket falló
+    return jsonify(resultado), 200 if resultado['success'] else 207
 
 # --- IA / CONFIG ---
 
@@ -134,6 +399,34 @@ def set_api_key():
         return jsonify({'success': True})
     return jsonify({'error': 'No key provided'}), 400
 
+def _guardar_subida(file):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Prefijo único: dos subidas con el mismo nombre no se pisan mientras esperan en la cola
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename.rsplit('.', 1)[0])}.{ext}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(filepath)
+    return filepath
+
+def _tarea_extraccion(file):
+    """(fn, descripcion, on_finish) para la cola de OCR.
+
+    Las fotos se procesan desde memoria; los CSV se guardan en disco porque
+    el parser los lee por bloques y pueden ser muy grandes.
+    """
+    if file.filename.rsplit('.', 1)[1].lower() == 'csv':
+        filepath = _guardar_subida(file)
+        return (lambda: ocr_service.procesar_albaran(filepath), file.filename,
+                lambda _job: _borrar_fichero(filepath))
+    datos = file.read()
+    return (lambda: ocr_service.procesar_albaran_datos(datos, file.filename), file.filename, None)
+
+def _cancelar_tareas(tareas):
+    # La cola no las ha aceptado: hay que limpiar lo que se guardó en disco
+    for _fn, _descripcion, on_finish in tareas:
+        if on_finish:
+            on_finish(None)
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -142,19 +435,298 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        resultado = ocr_service.procesar_albaran(filepath)
-        
-        try: os.remove(filepath)
-        except: pass
-            
-        return jsonify(resultado)
+        tarea = _tarea_extraccion(file)
+        try:
+            job = ocr_jobs.submit(*tarea)
+        except jobs.ColaLlenaError as e:
+            _cancelar_tareas([tarea])
+            return jsonify({'success': False, 'error': str(e)}), 503
+
+        return jsonify({'success': True, 'job_id': job['id'], 'estado': job['estado']}), 202
     
     return jsonify({'error': 'File type not allowed'}), 400
 
+MAX_FICHEROS_LOTE = 30
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    # Varias fotos/CSV de una misma entrega: cada uno es un trabajo de la cola
+    # (se extraen en paralelo con los workers de ocr_jobs) y se siguen como lote
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        return jsonify({'error': 'No se han enviado ficheros'}), 400
+    if len(files) > MAX_FICHEROS_LOTE:
+        return jsonify({'error': f'Máximo {MAX_FICHEROS_LOTE} ficheros por lote'}), 400
+    rechazados = [f.filename for f in files if not allowed_file(f.filename)]
+    if rechazados:
+        return jsonify({'error': f"Tipo de fichero no permitido: {', '.join(rechazados)}"}), 400
+
+    tareas = [_tarea_extraccion(f) for f in files]
+    try:
+        lote = ocr_jobs.submit_lote(tareas)
+    except jobs.ColaLlenaError as e:
+        _cancelar_tareas(tareas)
+        return jsonify({'success': False, 'error': str(e)}), 503
+
+    return jsonify({'success': True, 'lote_id': lote['id'], 'total': lote['total']}), 202
+
+def _resumen_lote(lote):
+    """Estado del lote con los productos de los ficheros ya terminados combinados."""
+    completados = [j['resultado'] for j in lote['jobs'] if j['estado'] == jobs.COMPLETADO]
+    lote['productos'] = ocr_service.combinar_productos(r.get('productos') for r in completados)
+    lote['rechazadas'] = sum(r.get('rechazadas', 0) for r in completados)
+    # Los resultados completos ya van combinados en 'productos'
+    lote['jobs'] = [{k: v for k, v in j.items() if k != 'resultado'} for j in lote['jobs']]
+    return lote
+
+@app.route('/api/lotes/<lote_id>', methods=['GET'])
+def get_lote(lote_id):
+    lote = ocr_jobs.get_lote(lote_id)
+    if lote is None:
+        return jsonify({'error': 'Lote no encontrado'}), 404
+    return jsonify(_resumen_lote(lote))
+
+@app.route('/api/lotes/<lote_id>', methods=['DELETE'])
+def cancel_lote(lote_id):
+    lote = ocr_jobs.cancel_lote(lote_id)
+    if lote is None:
+        return jsonify({'error': 'Lote no encontrado'}), 404
+    return jsonify(_resumen_lote(lote))
+
+def _stream_trabajo(stream):
+    # Sin hueco en esperas_trabajos: 503 y el frontend sigue por polling
+    if not esperas_trabajos.tomar():
+        return jsonify({'error': 'Demasiados seguimientos abiertos'}), 503
+    resp = Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(esperas_trabajos.soltar)
+    return resp
+
+@app.route('/api/lotes/<lote_id>/events', methods=['GET'])
+def lote_events(lote_id):
+    if ocr_jobs.get_lote(lote_id) is None:
+        return jsonify({'error': 'Lote no encontrado'}), 404
+
+    def stream():
+        version = -1
+        terminados = 0
+        while True:
+            lote = ocr_jobs.wait_lote(lote_id, version, timeout=15)
+            if lote is None:
+                return
+            if lote['version'] == version:
+                yield ': keep-alive\n\n'
+                continue
+            version = lote['version']
+            # Con cada fichero que termina se manda la lista combinada hasta el momento;
+            # los cambios intermedios (reintentos, "procesando") solo llevan el progreso
+            if lote['terminados'] != terminados or lote['estado'] == jobs.COMPLETADO:
+                terminados = lote['terminados']
+                yield f"event: lote\ndata: {json.dumps(_resumen_lote(lote))}\n\n"
+            else:
+                progreso = {k: lote[k] for k in ('id', 'total', 'terminados', 'estado', 'version')}
+                progreso['jobs'] = [{k: j[k] for k in ('id', 'descripcion', 'estado', 'mensaje')} for j in lote['jobs']]
+                yield f"event: progreso\ndata: {json.dumps(progreso)}\n\n"
+            if lote['estado'] == jobs.COMPLETADO:
+                return
+
+    return _stream_trabajo(stream)
+
+def _borrar_fichero(path):
+    try: os.remove(path)
+    except OSError: pass
+
+@app.route('/api/ocr/cache', methods=['GET'])
+def get_ocr_cache_stats():
+    return jsonify(database.get_extraction_cache_stats())
+
+@app.route('/api/ocr/cache', methods=['DELETE'])
+def clear_ocr_cache():
+    return jsonify({'success': True, 'borradas': database.clear_extraction_cache()})
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': ocr_jobs.list(), 'stats': ocr_jobs.stats()})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # ?wait=N&version=V: long polling, responde en cuanto cambie el trabajo.
+    # Sin hueco en esperas_trabajos se responde al momento (polling normal)
+    if request.args.get('wait') and esperas_trabajos.tomar():
+        try:
+            job = ocr_jobs.wait(job_id, request.args.get('version', -1, type=int),
+                                timeout=min(request.args.get('wait', 0, type=float), 30))
+        finally:
+            esperas_trabajos.soltar()
+    else:
+        job = ocr_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = ocr_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    if ocr_jobs.get(job_id) is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+
+    def stream():
+        version = -1
+        while True:
+            job = ocr_jobs.wait(job_id, version, timeout=15)
+            if job is None:
+                return
+            if job['version'] == version:
+                yield ': keep-alive\n\n'
+                continue
+            version = job['version']
+            yield f"event: job\ndata: {json.dumps(job)}\n\n"
+            if job['estado'] in jobs.ESTADOS_FINALES:
+                return
+
+    return _stream_trabajo(stream)
+
+@app.route('/api/events', methods=['GET'])
+def stream_eventos():
+    # SSE con los cambios (ventas, stock, productos, gastos) como deltas.
+    # Al reconectar, el navegador manda Last-Event-ID y se reenvía lo perdido;
+    # si ya no está en el buffer (o es de otro arranque) se manda "reset" para
+    # que recargue las vistas.
+    last_id = request.headers.get('Last-Event-ID')
+    ultimo = canal_eventos.parse_id(last_id)
+    if not canal_eventos.conectar():
+        return jsonify({'error': 'Demasiados terminales conectados'}), 503
+
+    def stream():
+        desde = ultimo
+        yield 'retry: 3000\n\n'
+        if desde is None:
+            desde = canal_eventos.ultimo_id
+            if last_id:
+                yield f"id: {canal_eventos.id_evento(desde)}\nevent: reset\ndata: {{}}\n\n"
+        limite = time.monotonic() + eventos.DURACION_MAX
+        while time.monotonic() < limite:
+            nuevos = canal_eventos.esperar(desde, timeout=15)
+            if nuevos is None:
+                desde = canal_eventos.ultimo_id
+                yield f"id: {canal_eventos.id_evento(desde)}\nevent: reset\ndata: {{}}\n\n"
+            elif not nuevos:
+                yield ': keep-alive\n\n'
+            else:
+                for n, tipo, datos in nuevos:
+                    yield f"id: {canal_eventos.id_evento(n)}\nevent: {tipo}\ndata: {json.dumps(datos)}\n\n"
+                desde = nuevos[-1][0]
+
+    resp = Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # call_on_close se ejecuta aunque el cliente corte antes de empezar el stream
+    resp.call_on_close(canal_eventos.desconectar)
+    return resp
+
+@app.route('/api/events/stats', methods=['GET'])
+def stats_eventos():
+    return jsonify({**canal_eventos.stats(), "esperas_trabajos": esperas_trabajos.stats()})
+
+# --- EXPORTACIÓN (contabilidad) ---
+
+def _csv_valor(v):
+    # Formato de Excel en español: separador ; y coma decimal
+    return f'{v:.2f}'.replace('.', ',') if isinstance(v, float) else v
+
+def _stream_csv(filas, columnas):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')  # BOM: Excel abre el UTF-8 con tildes bien
+    writer.writerow(columnas)
+    for n, fila in enumerate(filas, 1):
+        writer.writerow([_csv_valor(fila[c]) for c in columnas])
+        if n % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _stream_jsonl(filas):
+    lote = []
+    for fila in filas:
+        lote.append(json.dumps(fila, ensure_ascii=False))
+        if len(lote) >= 500:
+            yield '\n'.join(lote) + '\n'
+            lote = []
+    if lote:
+        yield '\n'.join(lote) + '\n'
+
+@app.route('/api/export/<tipo>', methods=['GET'])
+def exportar(tipo):
+    # /api/export/ventas|lineas|gastos?formato=csv|jsonl & (periodo=mes|trimestre|año[&fecha=] | desde=&hasta=)
+    # Se genera mientras se descarga: un año entero de tickets no se carga en memoria
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'jsonl'):
+        return jsonify({'error': 'Formato debe ser csv o jsonl'}), 400
+    try:
+        periodo = request.args.get('periodo')
+        if periodo:
+            desde, hasta = database.rango_periodo(periodo, request.args.get('fecha'))
+        else:
+            desde, hasta = request.args.get('desde'), request.args.get('hasta')
+        filas = database.iter_export(tipo, desde, hasta)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    nombre = f"{tipo}_{desde or 'inicio'}_{hasta or 'hoy'}.{formato}"
+    headers = {'Content-Disposition': f'attachment; filename="{nombre}"'}
+    if formato == 'csv':
+        columnas = database.EXPORTACIONES[tipo][2]
+        return Response(_stream_csv(filas, columnas), mimetype='text/csv', headers=headers)
+    return Response(_stream_jsonl(filas), mimetype='application/x-ndjson', headers=headers)
+
+# --- MÉTRICAS ---
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metricas.exportar(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/metrics/lentas', methods=['GET'])
+def get_lentas():
+    # Últimas consultas SQL y peticiones que superaron TPV_SLOW_QUERY_MS / TPV_SLOW_REQUEST_MS
+    return jsonify({
+        'umbral_sql_ms': metricas.SQL_LENTA_MS,
+        'umbral_peticion_ms': metricas.PETICION_LENTA_MS,
+        'lentas': metricas.get_lentas(request.args.get('limit', 50, type=int)),
+    })
+
+@app.route('/api/metrics/perfilado', methods=['GET', 'POST'])
+def perfilado():
+    # {"activo": true, "endpoint": "get_dashboard", "peticiones": 20}: perfila con
+    # cProfile las siguientes peticiones (de ese endpoint, hasta N) sin reiniciar
+    perfilador = metricas.get_perfilado()
+    if request.method == 'POST':
+        data = request.json or {}
+        peticiones = data.get('peticiones')
+        if peticiones is not None and (not isinstance(peticiones, int) or peticiones < 1):
+            return jsonify({'error': 'peticiones debe ser un entero positivo'}), 400
+        perfilador.configurar(data.get('activo', True), data.get('endpoint'), peticiones)
+    return jsonify(perfilador.estado())
+
+@app.route('/api/metrics/perfiles', methods=['GET'])
+def get_perfiles():
+    return jsonify(metricas.get_perfilado().listar())
+
+@app.route('/api/metrics/perfiles/<perfil_id>', methods=['GET'])
+def get_perfil(perfil_id):
+    perfil = metricas.get_perfilado().get(perfil_id)
+    if perfil is None:
+        return jsonify({'error': 'Perfil no encontrado'}), 404
+    if request.args.get('formato') == 'texto':
+        return Response(perfil['perfil'], mimetype='text/plain')
+    return jsonify(perfil)
+
 @app.route('/api/config/ip', methods=['GET'])
 def get_local_ip():
     import socket
@@ -167,8 +739,11 @@ def get_local_ip():
         ip = "127.0.0.1"
     return jsonify({'ip': ip})
 
+STARTUP_TIMINGS['import_ms'] = round((time.perf_counter() - _T_INICIO) * 1000, 1)
+
 if __name__ == '__main__':
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-    # Escuchar en todas las interfaces para permitir acceso desde el móvil
-    app.run(host='0.0.0.0', debug=True, port=5000)
+    # Servidor de desarrollo (recarga automática). Para producción: main.py o server.py.
+    # El depurador de Werkzeug permite ejecutar código: solo con TPV_DEBUG=1 y
+    # entonces únicamente en local.
+    debug = os.environ.get('TPV_DEBUG') == '1'
+    app.run(host='127.0.0.1' if debug else '0.0.0.0', debug=debug, port=5000, threaded=True)
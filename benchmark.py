@@ -0,0 +1,634 @@
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import database
+
+# Pruebas de carga y rendimiento con datos sintéticos de una tienda grande.
+#
+# 1. Genera (una vez, se reutiliza) una BD con N productos, millones de ventas
+#    repartidas en varios años y los gastos de esos años.
+# 2. Arranca el servidor real (server.py) en otro proceso sobre una copia de
+#    esa BD y mide latencias y rendimiento de los endpoints con varios
+#    terminales simultáneos, más una carga mixta de cajas cobrando.
+# 3. Mide en proceso procesar_csv y la importación masiva de un CSV grande.
+# 4. Guarda los resultados en JSON para comparar con otra ejecución:
+#        python benchmark.py                       # escala completa
+#        python benchmark.py --pequeño             # prueba rápida
+#        python benchmark.py --comparar anterior.json --umbral 0.2
+#    Con --comparar termina con código 1 si algo empeora más del umbral.
+
+BASE_DIR = database.BASE_DIR
+DIR_DATOS = os.path.join(tempfile.gettempdir(), 'nexus_bench')
+DIR_RESULTADOS = os.path.join(BASE_DIR, 'benchmark_resultados')
+FORMATO = 1  # versión del formato del JSON de resultados
+
+ESCALA_COMPLETA = {"productos": 100000, "ventas": 2000000, "años": 3, "peticiones": 2000, "filas_csv": 100000}
+ESCALA_PEQUEÑA = {"productos": 10000, "ventas": 100000, "años": 1, "peticiones": 300, "filas_csv": 10000}
+
+STOCK_INICIAL = 10 ** 7  # que las ventas del benchmark nunca fallen por stock
+GASTOS_POR_DIA = 4
+
+_FAMILIAS = ['Agua', 'Leche', 'Café', 'Aceite', 'Arroz', 'Pasta', 'Galletas', 'Yogur', 'Queso', 'Jamón',
+             'Cerveza', 'Vino', 'Zumo', 'Refresco', 'Pan', 'Chocolate', 'Detergente', 'Champú', 'Papel',
+             'Atún', 'Tomate', 'Harina', 'Azúcar', 'Sal', 'Huevos', 'Mantequilla', 'Cereales', 'Té']
+_MARCAS = ['Hacendado', 'Pascual', 'Marcilla', 'Carbonell', 'Brillante', 'Gallo', 'Fontaneda', 'Danone',
+           'García Baquero', 'Navidul', 'Mahou', 'Don Simón', 'Bimbo', 'Valor', 'Ariel', 'Pantene',
+           'Calvo', 'Orlando', 'Kellogg', 'Central Lechera']
+_VARIANTES = ['Clásico', 'Light', 'Integral', 'Sin lactosa', 'Eco', 'Familiar', 'Natural', 'Extra',
+              'Desnatada', 'Entera', 'Picante', 'Suave']
+_FORMATOS = ['250 g', '500 g', '1 kg', '1 L', '1,5 L', '330 ml', 'Pack 6', 'Pack 12', '75 cl', '200 ml']
+_CONCEPTOS = [('Luz', 'Suministros'), ('Agua', 'Suministros'), ('Alquiler', 'Local'), ('Proveedor', 'Compras'),
+              ('Limpieza', 'Servicios'), ('Gestoría', 'Servicios'), ('Transporte', 'Compras'),
+              ('Mantenimiento', 'Local'), ('Bolsas', 'Material'), ('Teléfono', 'Suministros')]
+
+
+# --- GENERACIÓN DE DATOS ---
+
+def _codigo(i):
+    # EAN-13 ficticio (prefijo 84 = España) con dígito de control válido
+    base = f'84{i:010d}'
+    suma = sum(int(d) * (3 if n % 2 else 1) for n, d in enumerate(base))
+    return base + str((10 - suma % 10) % 10)
+
+
+def _nombre(rnd):
+    return f'{rnd.choice(_FAMILIAS)} {rnd.choice(_MARCAS)} {rnd.choice(_VARIANTES)} {rnd.choice(_FORMATOS)}'
+
+
+def _pesos_popularidad(n, rnd):
+    # Ley de Zipf aproximada: unos pocos productos se llevan la mayoría de ventas
+    orden = list(range(n))
+    rnd.shuffle(orden)
+    acumulado = []
+    total = 0.0
+    for rango in range(1, n + 1):
+        total += 1.0 / rango
+        acumulado.append(total)
+    return orden, acumulado
+
+
+def ruta_datos(params, dir_datos=DIR_DATOS):
+    return os.path.join(dir_datos, f"tienda_{params['productos']}p_{params['ventas']}v_{params['años']}a.db")
+
+
+def generar_datos(params, dir_datos=DIR_DATOS, semilla=42, forzar=False):
+    """Crea la BD sintética (si no existe ya) y devuelve (ruta, resumen)."""
+    ruta = ruta_datos(params, dir_datos)
+    meta = ruta + '.json'
+    if not forzar and os.path.exists(ruta) and os.path.exists(meta):
+        with open(meta, encoding='utf-8') as f:
+            return ruta, json.load(f)
+
+    os.makedirs(dir_datos, exist_ok=True)
+    for sufijo in ('', '-wal', '-shm', '.json'):
+        if os.path.exists(ruta + sufijo):
+            os.remove(ruta + sufijo)
+
+    t0 = time.perf_counter()
+    # El esquema lo crea database.py, igual que en una instalación real
+    database.DB_NAME = ruta
+    database.ensure_initialized()
+    database.close_writer()
+    database.close_pool()
+
+    rnd = random.Random(semilla)
+    conn = sqlite3.connect(ruta)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-262144')
+    try:
+        print(f"Generando {params['productos']} productos...")
+        productos = []
+        for i in range(params['productos']):
+            costo = round(rnd.uniform(0.2, 40), 2)
+            productos.append((i + 1, _codigo(i), _nombre(rnd), costo, round(costo * rnd.uniform(1.2, 1.8), 2)))
+        with conn:
+            conn.executemany('INSERT INTO productos (id, codigo, nombre, costo, venta, stock) VALUES (?, ?, ?, ?, ?, ?)',
+                             [(pid, codigo, nombre, costo, venta, STOCK_INICIAL)
+                              for pid, codigo, nombre, costo, venta in productos])
+
+        lineas_totales = _generar_ventas(conn, rnd, productos, params)
+        gastos = _generar_gastos(conn, rnd, params)
+
+        print("Regenerando resumen diario y estadísticas...")
+        with conn:
+            database._rebuild_resumen(conn)
+        conn.execute('ANALYZE')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+
+    resumen = {
+        **params,
+        "lineas": lineas_totales,
+        "gastos": gastos,
+        "semilla": semilla,
+        "bytes": os.path.getsize(ruta),
+        "segundos_generacion": round(time.perf_counter() - t0, 1),
+    }
+    with open(meta, 'w', encoding='utf-8') as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=2)
+    print(f"Datos listos en {ruta} ({resumen['bytes'] / 1e6:.0f} MB, {resumen['segundos_generacion']} s)")
+    return ruta, resumen
+
+
+def _generar_ventas(conn, rnd, productos, params, bloque=50000):
+    n_ventas = params['ventas']
+    orden, acumulado = _pesos_popularidad(len(productos), rnd)
+    fin = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    inicio = fin - datetime.timedelta(days=365 * params['años'])
+    paso = (fin - inicio).total_seconds() / max(n_ventas, 1)
+
+    lineas_totales = 0
+    venta_id = 0
+    print(f"Generando {n_ventas} ventas en {params['años']} años...")
+    while venta_id < n_ventas:
+        ventas = []
+        lineas = []
+        for _ in range(min(bloque, n_ventas - venta_id)):
+            venta_id += 1
+            fecha = (inicio + datetime.timedelta(seconds=venta_id * paso)).strftime('%Y-%m-%d %H:%M:%S')
+            total = 0.0
+            n_lineas = min(1 + int(rnd.expovariate(0.4)), 20)
+            for idx in rnd.choices(orden, cum_weights=acumulado, k=n_lineas):
+                pid, codigo, nombre, _, venta = productos[idx]
+                cantidad = 1 if rnd.random() < 0.8 else rnd.randint(2, 6)
+                total += cantidad * venta
+                lineas.append((venta_id, pid, codigo, nombre, cantidad, venta, fecha))
+            ventas.append((venta_id, fecha, round(total, 2)))
+        with conn:
+            conn.executemany("INSERT INTO ventas (id, fecha, total, items) VALUES (?, ?, ?, '')", ventas)
+            conn.executemany('''
+                INSERT INTO venta_lineas (venta_id, producto_id, codigo, nombre, cantidad, precio, fecha)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', lineas)
+        lineas_totales += len(lineas)
+        print(f"  {venta_id}/{n_ventas} ventas ({lineas_totales} líneas)", end='\r')
+    print()
+    return lineas_totales
+
+
+def _generar_gastos(conn, rnd, params):
+    hoy = datetime.date.today()
+    gastos = []
+    for dias in range(365 * params['años'], -1, -1):
+        dia = hoy - datetime.timedelta(days=dias)
+        for _ in range(rnd.randint(0, GASTOS_POR_DIA * 2)):
+            concepto, categoria = rnd.choice(_CONCEPTOS)
+            fecha = f'{dia.isoformat()} {rnd.randint(8, 20):02d}:{rnd.randint(0, 59):02d}:00'
+            gastos.append((fecha, concepto, round(rnd.uniform(5, 600), 2), categoria))
+    with conn:
+        conn.executemany('INSERT INTO gastos (fecha, concepto, monto, categoria) VALUES (?, ?, ?, ?)', gastos)
+    return len(gastos)
+
+
+def generar_csv(ruta, filas, n_productos, semilla=7):
+    """Albarán CSV grande: la mitad de códigos existen (actualizan), la otra mitad son nuevos."""
+    rnd = random.Random(semilla)
+    with open(ruta, 'w', encoding='utf-8', newline='') as f:
+        f.write('SKU;Descripción;Unidades;Precio Coste\n')
+        for i in range(filas):
+            codigo = _codigo(rnd.randrange(n_productos)) if i % 2 else _codigo(n_productos + i)
+            costo = f'{rnd.uniform(0.2, 40):.2f}'.replace('.', ',')
+            f.write(f'{codigo};{_nombre(rnd)};{rnd.randint(1, 48)};{costo}\n')
+    return ruta
+
+
+# --- MEDICIÓN ---
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    k = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados) + 0.5)) - 1))
+    return valores_ordenados[k]
+
+
+def resumir(latencias, segundos, errores=0, **extra):
+    ms = sorted(x * 1000 for x in latencias)
+    return {
+        "n": len(ms),
+        "errores": errores,
+        "segundos": round(segundos, 3),
+        "ops_s": round(len(ms) / segundos, 1) if segundos else None,
+        "ms": {
+            "media": round(sum(ms) / len(ms), 3) if ms else None,
+            "p50": _redondear(percentil(ms, 50)),
+            "p90": _redondear(percentil(ms, 90)),
+            "p99": _redondear(percentil(ms, 99)),
+            "max": _redondear(ms[-1] if ms else None),
+        },
+        **extra,
+    }
+
+
+def _redondear(x):
+    return round(x, 3) if x is not None else None
+
+
+class Terminal:
+    """Cliente HTTP con conexión persistente, como el navegador de una caja."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def peticion(self, metodo, ruta, cuerpo=None):
+        datos = json.dumps(cuerpo).encode() if cuerpo is not None else None
+        cabeceras = {'Content-Type': 'application/json'} if datos else {}
+        for intento in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(metodo, ruta, body=datos, headers=cabeceras)
+                resp = self.conn.getresponse()
+                resp.read()
+                return resp.status
+            except (http.client.HTTPException, OSError):
+                # El servidor cierra las conexiones inactivas: reconectar una vez
+                self.conn.close()
+                self.conn = None
+                if intento:
+                    raise
+
+    def cerrar(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def medir_http(host, port, generar_peticion, n, hilos, estados_ok=(200,)):
+    """Lanza n peticiones repartidas entre `hilos` terminales y resume las latencias."""
+    latencias = []
+    errores = [0]
+    lock = threading.Lock()
+    por_hilo = [n // hilos + (1 if i < n % hilos else 0) for i in range(hilos)]
+
+    def trabajar(cuantas, semilla):
+        rnd = random.Random(semilla)
+        terminal = Terminal(host, port)
+        propias = []
+        fallos = 0
+        try:
+            for _ in range(cuantas):
+                metodo, ruta, cuerpo = generar_peticion(rnd)
+                t = time.perf_counter()
+                try:
+                    estado = terminal.peticion(metodo, ruta, cuerpo)
+                except Exception:
+                    estado = None
+                propias.append(time.perf_counter() - t)
+                if estado not in estados_ok:
+                    fallos += 1
+        finally:
+            terminal.cerrar()
+        with lock:
+            latencias.extend(propias)
+            errores[0] += fallos
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=trabajar, args=(c, i)) for i, c in enumerate(por_hilo) if c]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return resumir(latencias, time.perf_counter() - t0, errores[0], hilos=hilos)
+
+
+def simular_terminales(host, port, codigos, terminales, segundos):
+    """Carga mixta: cada caja escanea 1-8 productos, cobra y de vez en cuando mira el dashboard."""
+    por_op = {}
+    lock = threading.Lock()
+    fin = time.perf_counter() + segundos
+
+    def caja(semilla):
+        rnd = random.Random(semilla)
+        terminal = Terminal(host, port)
+        propias = {}
+
+        def anotar(op, t, ok):
+            lat, errs = propias.setdefault(op, ([], [0]))
+            lat.append(time.perf_counter() - t)
+            if not ok:
+                errs[0] += 1
+
+        try:
+            while time.perf_counter() < fin:
+                items = []
+                for codigo in rnd.sample(codigos, rnd.randint(1, 8)):
+                    t = time.perf_counter()
+                    estado = terminal.peticion('GET', f'/api/producto/scan?code={codigo}')
+                    anotar('scan', t, estado == 200)
+                    items.append({"codigo": codigo, "cantidad": 1, "precio": 1.0})
+                t = time.perf_counter()
+                estado = terminal.peticion('POST', '/api/venta', {"items": items})
+                anotar('venta', t, estado == 200)
+                if rnd.random() < 0.1:
+                    t = time.perf_counter()
+                    estado = terminal.peticion('GET', '/api/dashboard')
+                    anotar('dashboard', t, estado == 200)
+        finally:
+            terminal.cerrar()
+        with lock:
+            for op, (lat, errs) in propias.items():
+                total_lat, total_errs = por_op.setdefault(op, ([], [0]))
+                total_lat.extend(lat)
+                total_errs[0] += errs[0]
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=caja, args=(i,)) for i in range(terminales)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracion = time.perf_counter() - t0
+    resultado = {op: resumir(lat, duracion, errs[0]) for op, (lat, errs) in por_op.items()}
+    return {
+        "terminales": terminales,
+        "segundos": round(duracion, 3),
+        "ventas_s": resultado.get('venta', {}).get('ops_s'),
+        "operaciones": resultado,
+    }
+
+
+# --- SERVIDOR ---
+
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def arrancar_servidor(ruta_bd, port, threads):
+    # En otro proceso: los clientes no compiten por el GIL con el servidor
+    codigo = (
+        'import sys, database; database.DB_NAME = sys.argv[1]; import server; '
+        'server.main(["--host", "127.0.0.1", "--port", sys.argv[2], "--threads", sys.argv[3]])'
+    )
+    env = dict(os.environ, TPV_OCR_BACKEND='fake')
+    proc = subprocess.Popen([sys.executable, '-c', codigo, ruta_bd, str(port), str(threads)],
+                            cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL)
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proc.poll() is not None:
+            raise RuntimeError(f"El servidor terminó al arrancar (código {proc.returncode})")
+        try:
+            if Terminal('127.0.0.1', port).peticion('GET', '/api/startup') == 200:
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("El servidor no respondió en 60 s")
+
+
+def parar_servidor(proc):
+    proc.terminate()
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# --- ESCENARIOS ---
+
+def _muestra_codigos(ruta_bd, n=5000, semilla=3):
+    conn = sqlite3.connect(ruta_bd)
+    try:
+        total = conn.execute('SELECT MAX(id) FROM productos').fetchone()[0]
+        rnd = random.Random(semilla)
+        ids = rnd.sample(range(1, total + 1), min(n, total))
+        return [r[0] for r in conn.execute(
+            'SELECT codigo FROM productos WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(ids),))]
+    finally:
+        conn.close()
+
+
+def escenarios_http(ruta_bd, params, hilos, terminales, segundos_mixto, threads_servidor):
+    codigos = _muestra_codigos(ruta_bd)
+    busquedas = [f.lower() for f in _FAMILIAS] + [m.split()[0].lower() for m in _MARCAS] + ['cafe', 'lech', 'choco']
+    n = params['peticiones']
+
+    def scan(rnd):
+        # 5% de códigos que no existen (producto sin dar de alta)
+        codigo = rnd.choice(codigos) if rnd.random() > 0.05 else f'000{rnd.randrange(10 ** 9)}'
+        return 'GET', f'/api/producto/scan?code={codigo}', None
+
+    def venta(rnd):
+        items = [{"codigo": c, "cantidad": rnd.randint(1, 3), "precio": 1.0}
+                 for c in rnd.sample(codigos, rnd.randint(1, 6))]
+        return 'POST', '/api/venta', {"items": items}
+
+    def buscar(rnd):
+        return 'GET', f'/api/productos?search={urllib.parse.quote(rnd.choice(busquedas))}', None
+
+    port = _puerto_libre()
+    proc = arrancar_servidor(ruta_bd, port, threads_servidor)
+    resultados = {}
+    try:
+        casos = [
+            ('scan', scan, n, (200, 404)),
+            ('venta', venta, n, (200,)),
+            ('dashboard', lambda rnd: ('GET', '/api/dashboard', None), max(n // 4, 1), (200,)),
+            ('productos_busqueda', buscar, n, (200,)),
+            ('ventas_historial', lambda rnd: ('GET', '/api/ventas/historial', None), max(n // 4, 1), (200,)),
+        ]
+        for nombre, generar, peticiones, ok in casos:
+            print(f"  {nombre}: {peticiones} peticiones, {hilos} terminales...")
+            resultados[nombre] = medir_http('127.0.0.1', port, generar, peticiones, hilos, ok)
+            _imprimir(nombre, resultados[nombre])
+
+        print(f"  mixto: {terminales} cajas durante {segundos_mixto} s...")
+        resultados['terminales'] = simular_terminales('127.0.0.1', port, codigos, terminales, segundos_mixto)
+        for op, r in resultados['terminales']['operaciones'].items():
+            _imprimir(f'terminales.{op}', r)
+    finally:
+        parar_servidor(proc)
+    return resultados
+
+
+def escenarios_importacion(ruta_bd, params, dir_datos):
+    import ocr_service
+
+    ruta_csv = generar_csv(os.path.join(dir_datos, f"albaran_{params['filas_csv']}.csv"),
+                           params['filas_csv'], params['productos'])
+    resultados = {}
+
+    t = time.perf_counter()
+    res = ocr_service.procesar_csv(ruta_csv)
+    segundos = time.perf_counter() - t
+    resultados['procesar_csv'] = {
+        "filas": len(res.get('productos', [])), "segundos": round(segundos, 3),
+        "filas_s": round(len(res.get('productos', [])) / segundos, 1), "success": res['success'],
+    }
+    print(f"  procesar_csv: {resultados['procesar_csv']['filas_s']} filas/s")
+
+    database.DB_NAME = ruta_bd
+    database.ensure_initialized()
+    try:
+        t = time.perf_counter()
+        res = database.bulk_upsert_products(ocr_service.iter_csv_productos(ruta_csv), detalle=False, por_bloques=True)
+        segundos = time.perf_counter() - t
+    finally:
+        database.close_writer()
+        database.close_pool()
+    filas = res.get('creados', 0) + res.get('actualizados', 0)
+    resultados['importacion'] = {
+        "filas": filas, "segundos": round(segundos, 3), "filas_s": round(filas / segundos, 1),
+        "creados": res.get('creados'), "actualizados": res.get('actualizados'), "success": res['success'],
+    }
+    print(f"  importación (CSV -> BD): {resultados['importacion']['filas_s']} filas/s")
+    return resultados
+
+
+def _imprimir(nombre, r):
+    ms = r['ms']
+    print(f"    {nombre:<28} {r['ops_s']:>9} ops/s  p50 {ms['p50']} ms  p99 {ms['p99']} ms  errores {r['errores']}")
+
+
+# --- RESULTADOS ---
+
+def _entorno():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _metricas(resultados):
+    """Aplana los resultados a {nombre: (valor, mayor_es_mejor)} para comparar."""
+    metricas = {}
+
+    def latencias(prefijo, r):
+        metricas[f'{prefijo}.ops_s'] = (r['ops_s'], True)
+        metricas[f'{prefijo}.p50_ms'] = (r['ms']['p50'], False)
+        metricas[f'{prefijo}.p99_ms'] = (r['ms']['p99'], False)
+
+    for nombre, r in resultados.items():
+        if nombre == 'terminales':
+            for op, ro in r['operaciones'].items():
+                latencias(f'terminales.{op}', ro)
+        elif 'ms' in r:
+            latencias(nombre, r)
+        elif 'filas_s' in r:
+            metricas[f'{nombre}.filas_s'] = (r['filas_s'], True)
+    return metricas
+
+
+def comparar(actual, anterior, umbral):
+    """Imprime la comparación y devuelve la lista de regresiones (cambio peor que umbral)."""
+    nuevas = _metricas(actual['resultados'])
+    viejas = _metricas(anterior['resultados'])
+    regresiones = []
+    print(f"\nComparación con {anterior['entorno'].get('commit')} ({anterior['fecha']}):")
+    for nombre in sorted(nuevas):
+        if nombre not in viejas:
+            continue
+        valor, mayor_mejor = nuevas[nombre]
+        previo = viejas[nombre][0]
+        if not valor or not previo:
+            continue
+        cambio = (valor - previo) / previo
+        peor = -cambio if mayor_mejor else cambio
+        marca = '  REGRESIÓN' if peor > umbral else ''
+        print(f"  {nombre:<36} {previo:>10} -> {valor:<10} ({cambio:+.1%}){marca}")
+        if marca:
+            regresiones.append({"metrica": nombre, "antes": previo, "ahora": valor, "cambio": round(cambio, 4)})
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de Nexus ERP con datos sintéticos')
+    parser.add_argument('--pequeño', action='store_true', help='escala reducida para una prueba rápida')
+    parser.add_argument('--productos', type=int)
+    parser.add_argument('--ventas', type=int)
+    parser.add_argument('--años', type=int)
+    parser.add_argument('--peticiones', type=int, help='peticiones por endpoint')
+    parser.add_argument('--filas-csv', type=int, help='filas del albarán CSV a importar')
+    parser.add_argument('--hilos', type=int, default=8, help='terminales simultáneos por endpoint')
+    parser.add_argument('--terminales', type=int, default=12, help='cajas en la carga mixta')
+    parser.add_argument('--segundos', type=int, default=20, help='duración de la carga mixta')
+    parser.add_argument('--threads-servidor', type=int, default=16)
+    parser.add_argument('--datos', default=DIR_DATOS, help='carpeta de las BD sintéticas (se reutilizan)')
+    parser.add_argument('--regenerar', action='store_true', help='volver a generar la BD sintética')
+    parser.add_argument('--salida', help='fichero JSON de resultados')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior')
+    parser.add_argument('--umbral', type=float, default=0.2, help='empeoramiento tolerado al comparar (0.2 = 20%%)')
+    parser.add_argument('--solo', choices=['http', 'importacion'], help='ejecutar solo un grupo de escenarios')
+    args = parser.parse_args(argv)
+
+    params = dict(ESCALA_PEQUEÑA if args.pequeño else ESCALA_COMPLETA)
+    for clave in params:
+        valor = getattr(args, clave, None)
+        if valor is not None:
+            params[clave] = valor
+
+    ruta_base, datos = generar_datos(params, args.datos, forzar=args.regenerar)
+
+    # Cada ejecución trabaja sobre una copia: las ventas del benchmark no se acumulan
+    ruta_bd = ruta_base.replace('.db', '.run.db')
+    for sufijo in ('-wal', '-shm'):
+        if os.path.exists(ruta_bd + sufijo):
+            os.remove(ruta_bd + sufijo)
+    shutil.copyfile(ruta_base, ruta_bd)
+
+    resultados = {}
+    if args.solo in (None, 'http'):
+        print("Escenarios HTTP:")
+        resultados.update(escenarios_http(ruta_bd, params, args.hilos, args.terminales, args.segundos,
+                                          args.threads_servidor))
+    if args.solo in (None, 'importacion'):
+        print("Escenarios de importación:")
+        resultados.update(escenarios_importacion(ruta_bd, params, args.datos))
+
+    informe = {
+        "formato": FORMATO,
+        "fecha": datetime.datetime.now().isoformat(timespec='seconds'),
+        "entorno": _entorno(),
+        "datos": datos,
+        "parametros": {**params, "hilos": args.hilos, "terminales": args.terminales, "segundos": args.segundos,
+                       "threads_servidor": args.threads_servidor},
+        "resultados": resultados,
+    }
+
+    salida = args.salida
+    if not salida:
+        os.makedirs(DIR_RESULTADOS, exist_ok=True)
+        nombre = f"{datetime.datetime.now():%Y%m%d-%H%M%S}_{informe['entorno']['commit'] or 'sin-git'}.json"
+        salida = os.path.join(DIR_RESULTADOS, nombre)
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+        regresiones = comparar(informe, anterior, args.umbral)
+        if regresiones:
+            print(f"{len(regresiones)} métricas empeoran más de un {args.umbral:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
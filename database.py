@@ -2,9 +2,21 @@ import sqlite3
 import os
 import datetime
 import json
+import math
+import re
+import ast
+import base64
+import atexit
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
 
 import sys
 
+import metricas
+
 # Determinar la ruta base para el archivo de base de datos
 if getattr(sys, 'frozen', False):
     # Si es un ejecutable de PyInstaller, usar la carpeta donde está el .exe
@@ -15,239 +27,2614 @@ else:
 
 DB_NAME = os.path.join(BASE_DIR, 'tpv.db')
 
-def get_db_connection():
-    # Asegurar que el directorio base es escribible
-    conn = sqlite3.connect(DB_NAME)
+# --- POOL DE CONEXIONES ---
+# Reutilizamos las conexiones entre peticiones en lugar de abrir el fichero en
+# cada escaneo. Cada conexión se configura una sola vez al crearse.
+
+POOL_SIZE = int(os.environ.get('TPV_DB_POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.environ.get('TPV_DB_POOL_TIMEOUT', 30))  # segundos esperando una conexión libre
+BUSY_TIMEOUT_MS = int(os.environ.get('TPV_DB_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = int(os.environ.get('TPV_DB_CACHE_KB', 16384))
+MMAP_SIZE = int(os.environ.get('TPV_DB_MMAP_BYTES', 64 * 1024 * 1024))
+
+
+def _abrir_conexion(db_path):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
+    # Antes de WAL: en una BD nueva solo se puede elegir antes de escribir la
+    # cabecera; en una existente sin auto_vacuum no hace nada (ver vacuum_completo)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
     return conn
 
-def init_db():
+
+class PooledConnection(sqlite3.Connection):
+    """Conexión que vuelve al pool al llamar a close() en lugar de cerrarse.
+
+    Con las métricas activas cada sentencia se ejecuta con un CursorMedido
+    (tiempo y filas por consulta, registro de consultas lentas).
+    """
+
+    pool = None
+    archivos = ()    # esquemas de archivo adjuntos (ATTACH), ver _preparar_archivos
+    archivos_gen = 0
+
+    def execute(self, sql, parameters=()):
+        if not metricas.ACTIVO:
+            return super().execute(sql, parameters)
+        return self.cursor(metricas.CursorMedido).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not metricas.ACTIVO:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor(metricas.CursorMedido).executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if not metricas.ACTIVO:
+            return super().commit()
+        t = time.perf_counter()
+        super().commit()
+        metricas.observar_sql('COMMIT', time.perf_counter() - t, 0)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
+    def __init__(self, db_path, max_size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()  # LIFO: la conexión más "caliente" primero
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._acquired = 0
+        self._reused = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def _connect(self):
+        conn = _abrir_conexion(self.db_path)
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.max_size:
+                    self._created += 1
+                    reused = False
+                else:
+                    reused = True
+            if not reused:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                t0 = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise sqlite3.OperationalError('Pool de conexiones agotado')
+                with self._lock:
+                    self._waits += 1
+                    self._wait_time += time.perf_counter() - t0
+
+        with self._lock:
+            self._acquired += 1
+            if reused:
+                self._reused += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        return conn
+
+    def release(self, conn):
+        # Nunca devolver al pool una transacción a medias
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.pool = None
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "db_path": self.db_path,
+                "max_size": self.max_size,
+                "created": self._created,
+                "idle": self._idle.qsize(),
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "acquired": self._acquired,
+                "reused": self._reused,
+                "waits": self._waits,
+                "wait_time_ms": round(self._wait_time * 1000, 2),
+                "timeouts": self._timeouts,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    # El pool se crea al primer uso y se recrea si cambia DB_NAME
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != DB_NAME:
+            if _pool is not None:
+                _pool.close_all()
+                _scan_cache.clear()
+            _pool = ConnectionPool(DB_NAME)
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+def get_pool_stats():
+    stats = get_pool().stats()
+    stats["escritor"] = get_writer_stats()
+    return stats
+
+def get_db_connection():
+    # Devuelve una conexión del pool; conn.close() la devuelve al pool
+    conn = get_pool().acquire()
+    _comprobar_version()
+    if _archivos_db != DB_NAME:
+        _buscar_archivos()
+    if conn.archivos_gen != _archivos_gen:
+        try:
+            _preparar_archivos(conn)
+        except Exception:
+            conn.close()
+            raise
+    return conn
+
+# Cerrar las conexiones al salir para que SQLite haga el checkpoint del WAL
+atexit.register(close_pool)
+
+# --- ESCRITOR ÚNICO ---
+# Todas las escrituras pasan por un hilo que tiene su propia conexión. Las
+# operaciones que llegan juntas (varias cajas cobrando, bloques de una
+# importación) se confirman en una sola transacción: un único bloqueo de
+# escritura y un único commit para el grupo, sin "database is locked".
+# Cada operación va en su propio SAVEPOINT, así que si una falla se deshace
+# solo ella y las demás del grupo se confirman igual.
+#
+# Una operación es fn(conn, despues): escribe con conn sin hacer commit y
+# añade a la lista despues lo que haya que hacer tras confirmar (invalidar
+# cachés, avisar a los terminales). Su valor de retorno (o su excepción)
+# llega al llamador.
+#
+# La conexión del escritor no adjunta los archivos por años: BEGIN IMMEDIATE
+# bloquearía también cada fichero adjunto.
+
+WRITER_ACTIVO = os.environ.get('TPV_DB_WRITER', '1') != '0'             # 0: cada escritura en su hilo, como antes
+WRITE_GROUP_MS = float(os.environ.get('TPV_DB_GROUP_MS', 2))            # espera para juntar operaciones
+WRITE_GROUP_MAX = int(os.environ.get('TPV_DB_GROUP_MAX', 200))          # operaciones por transacción como máximo
+
+
+class _Anular(Exception):
+    """Lanzada por una operación para deshacer sus escrituras y devolver resultado igualmente."""
+
+    def __init__(self, resultado):
+        super().__init__('Operación anulada')
+        self.resultado = resultado
+
+
+class _Operacion:
+    __slots__ = ('fn', 'future', 'encolada')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+        self.encolada = time.perf_counter()
+
+
+class Escritor:
+    def __init__(self, db_path, espera_ms=WRITE_GROUP_MS, max_grupo=WRITE_GROUP_MAX):
+        self.db_path = db_path
+        self.espera = espera_ms / 1000
+        self.max_grupo = max_grupo
+        self._cola = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._operaciones = 0
+        self._fallidas = 0
+        self._grupos = 0
+        self._max_en_grupo = 0
+        self._espera_total = 0.0
+        self._commit_total = 0.0
+        self._conn = None
+        self._despues = None  # lista despues de la operación en curso
+        self._activo = True   # False cuando el hilo termina: no se aceptan más operaciones
+        self._error = None    # por qué terminó
+        self._hilo = threading.Thread(target=self._bucle, name='db-writer', daemon=True)
+        self._hilo.start()
+
+    @property
+    def activo(self):
+        return self._activo and self._hilo.is_alive()
+
+    def en_hilo_escritor(self):
+        return threading.current_thread() is self._hilo
+
+    def submit(self, fn):
+        op = _Operacion(fn)
+        # Con el lock: o entra antes de que el hilo vacíe la cola al terminar, o se rechaza
+        with self._lock:
+            if self._activo:
+                self._cola.put(op)
+                return op.future
+        op.future.set_exception(self._error)
+        return op.future
+
+    def anidada(self, fn):
+        """Escritura lanzada desde otra operación: va dentro de la transacción en curso."""
+        conn = self._conn
+        despues = []
+        conn.execute('SAVEPOINT anidada')
+        try:
+            resultado = fn(conn, despues)
+        except _Anular as e:
+            conn.execute('ROLLBACK TO SAVEPOINT anidada')
+            conn.execute('RELEASE SAVEPOINT anidada')
+            return e.resultado
+        except Exception:
+            conn.execute('ROLLBACK TO SAVEPOINT anidada')
+            conn.execute('RELEASE SAVEPOINT anidada')
+            raise
+        conn.execute('RELEASE SAVEPOINT anidada')
+        self._despues.extend(despues)
+        return resultado
+
+    def cerrar(self, timeout=10):
+        self._cola.put(None)
+        self._hilo.join(timeout)
+
+    def _bucle(self):
+        conn = None
+        error = None
+        try:
+            conn = self._conn = _abrir_conexion(self.db_path)
+            while True:
+                op = self._cola.get()
+                if op is None:
+                    break
+                grupo = [op]
+                fin = False
+                # Lo que ya está en cola entra sin esperar; luego se da un margen
+                # corto para que lleguen las ventas que vienen justo detrás
+                limite = time.perf_counter() + self.espera
+                while len(grupo) < self.max_grupo:
+                    restante = limite - time.perf_counter()
+                    try:
+                        op = self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op is None:
+                        fin = True
+                        break
+                    grupo.append(op)
+                try:
+                    self._ejecutar_grupo(conn, grupo)
+                except Exception as e:
+                    # Fallo fuera de las operaciones (métricas, avisos...): el hilo sigue
+                    print(f"Error en el escritor de la base de datos: {e}")
+                    for op in grupo:
+                        if not op.future.done():
+                            op.future.set_exception(e)
+                if fin:
+                    break
+        except Exception as e:
+            print(f"El escritor de la base de datos se ha detenido: {e}")
+            error = e
+        finally:
+            # Nadie más va a leer la cola: las operaciones que quedan fallan en vez de esperar siempre
+            error = error or sqlite3.OperationalError('El escritor de la base de datos se ha cerrado')
+            with self._lock:
+                self._error = error
+                self._activo = False
+            while True:
+                try:
+                    op = self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                if op is not None and op.future.set_running_or_notify_cancel():
+                    op.future.set_exception(error)
+            if conn is not None:
+                conn.close()
+
+    def _ejecutar_grupo(self, conn, grupo):
+        t0 = time.perf_counter()
+        hechas = []  # (op, resultado, excepcion, despues)
+        anterior = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for op in grupo:
+                if not op.future.set_running_or_notify_cancel():
+                    continue
+                despues = self._despues = []
+                conn.execute('SAVEPOINT op')
+                try:
+                    resultado = op.fn(conn, despues)
+                    conn.execute('RELEASE SAVEPOINT op')
+                    hechas.append((op, resultado, None, despues))
+                except _Anular as e:
+                    conn.execute('ROLLBACK TO SAVEPOINT op')
+                    conn.execute('RELEASE SAVEPOINT op')
+                    hechas.append((op, e.resultado, None, []))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO SAVEPOINT op')
+                    conn.execute('RELEASE SAVEPOINT op')
+                    hechas.append((op, None, e, []))
+            if any(_bump_data_version in despues for _, _, _, despues in hechas):
+                anterior = _subir_version(conn)
+            conn.commit()
+        except Exception as e:
+            # Falló el BEGIN, el commit o un ROLLBACK TO: no se confirmó nada del grupo
+            _deshacer_version(anterior)
+            if conn.in_transaction:
+                conn.rollback()
+            for op in grupo:
+                if not op.future.done():
+                    op.future.set_exception(e)
+            with self._lock:
+                self._fallidas += len(grupo)
+            return
+        t1 = time.perf_counter()
+
+        for op, resultado, excepcion, despues in hechas:
+            for fn in despues:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"Error tras confirmar una escritura: {e}")
+            if excepcion is not None:
+                op.future.set_exception(excepcion)
+            else:
+                op.future.set_result(resultado)
+
+        metricas.escritor_grupo.observar(len(hechas))
+        for op, _, _, _ in hechas:
+            metricas.escritor_espera.observar(t0 - op.encolada)
+        with self._lock:
+            self._grupos += 1
+            self._operaciones += len(hechas)
+            self._fallidas += sum(1 for h in hechas if h[2] is not None)
+            self._max_en_grupo = max(self._max_en_grupo, len(hechas))
+            self._espera_total += sum(t0 - op.encolada for op, _, _, _ in hechas)
+            self._commit_total += t1 - t0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "activo": self._activo,
+                "en_cola": self._cola.qsize(),
+                "operaciones": self._operaciones,
+                "fallidas": self._fallidas,
+                "transacciones": self._grupos,
+                "media_por_transaccion": round(self._operaciones / self._grupos, 2) if self._grupos else 0,
+                "max_por_transaccion": self._max_en_grupo,
+                "espera_media_ms": round(self._espera_total / self._operaciones * 1000, 2) if self._operaciones else 0,
+                "transaccion_media_ms": round(self._commit_total / self._grupos * 1000, 2) if self._grupos else 0,
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    # Como el pool: se crea al primer uso y se recrea si cambia DB_NAME o si su hilo ha muerto
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.db_path != DB_NAME or not _writer.activo:
+            if _writer is not None:
+                _writer.cerrar()
+            _writer = Escritor(DB_NAME)
+        return _writer
+
+def close_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.cerrar()
+            _writer = None
+
+def get_writer_stats():
+    if not WRITER_ACTIVO:
+        return {"activo": False}
+    return get_writer().stats()
+
+def _escribir(fn):
+    """Ejecuta la operación fn(conn, despues) en una transacción y devuelve su resultado.
+
+    Con el escritor activo se encola y se espera al commit de su grupo; si no,
+    se ejecuta aquí mismo con una conexión del pool.
+    """
+    if WRITER_ACTIVO:
+        escritor = get_writer()
+        if escritor.en_hilo_escritor():
+            return escritor.anidada(fn)
+        t = time.perf_counter()
+        try:
+            return escritor.submit(fn).result()
+        finally:
+            metricas.anotar_escritura(time.perf_counter() - t)
+
     conn = get_db_connection()
+    despues = []
+    anterior = None
     try:
-        # Tabla Productos
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS productos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codigo TEXT UNIQUE NOT NULL,
-                nombre TEXT NOT NULL,
-                costo REAL NOT NULL,
-                venta REAL NOT NULL,
-                stock INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Tabla Ventas/Tickets
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS ventas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total REAL NOT NULL,
-                items TEXT NOT NULL
-            )
-        ''')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            resultado = fn(conn, despues)
+            if _bump_data_version in despues:
+                anterior = _subir_version(conn)
+            conn.commit()
+        except _Anular as e:
+            conn.rollback()
+            return e.resultado
+        except Exception:
+            _deshacer_version(anterior)
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+    for f in despues:
+        f()
+    return resultado
+
+# Se registra después de close_pool, así que se ejecuta antes (atexit es LIFO)
+atexit.register(close_writer)
+
+# --- VERSIÓN DE DATOS ---
+# Número guardado en version_datos que sube, en la misma transacción, con cada
+# escritura de datos (las operaciones que añaden _bump_data_version a
+# despues). Sirve para invalidar cachés (dashboard, escaneo, vistas de años
+# archivados) y generar ETags. Al estar en la BD también cuentan las
+# escrituras de otros procesos: import_script.py, "python database.py
+# archivar"...
+#
+# Para no leerlo en cada petición, una conexión vigía consulta PRAGMA
+# data_version, que solo cambia cuando otra conexión confirma algo; entonces
+# se lee version_datos. Si es mayor que la última escrita por este proceso,
+# ha escrito otro y se llama a las funciones de _al_cambiar_fuera.
+
+_data_version = 0        # última versión vista por este proceso
+_version_propia = 0      # última versión escrita por este proceso
+_data_version_time = time.time()  # instante del último cambio visto (Last-Modified)
+_data_version_lock = threading.Lock()
+_BOOT_ID = f'{int(time.time()):x}'  # distingue ETags de arranques anteriores
+_vigia = None            # [ruta, conexión, último PRAGMA data_version]
+_vigia_lock = threading.Lock()
+_vigia_gen = 0           # sube si cambia DB_NAME: otra BD, otros ETags
+_al_cambiar_fuera = []   # funciones sin argumentos
+
+def _leer_version(conn):
+    try:
+        return conn.execute('SELECT version FROM version_datos').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0  # BD todavía sin migrar
+
+def _ver_version(version):
+    """Anota una versión leída de la BD; si la escribió otro proceso, lo avisa."""
+    global _data_version, _data_version_time
+    with _data_version_lock:
+        if version <= _data_version:
+            return
+        externa = version > _version_propia
+        _data_version = version
+        _data_version_time = time.time()
+    if externa:
+        for fn in list(_al_cambiar_fuera):
+            try:
+                fn()
+            except Exception as e:
+                print(f"Error tras un cambio de otro proceso: {e}")
+
+def _subir_version(conn):
+    """Dentro de la transacción de una escritura de datos; devuelve la versión anterior."""
+    global _version_propia
+    anterior = _leer_version(conn)
+    _ver_version(anterior)  # lo que otro proceso haya confirmado antes que nosotros
+    try:
+        conn.execute('UPDATE version_datos SET version = version + 1')
+    except sqlite3.OperationalError:
+        return None
+    with _data_version_lock:
+        _version_propia = anterior + 1
+    return anterior
+
+def _deshacer_version(anterior):
+    # Falló el commit: la versión anterior + 1 no llegó a escribirse
+    global _version_propia
+    if anterior is not None:
+        with _data_version_lock:
+            if _version_propia == anterior + 1:
+                _version_propia = anterior
+
+def _bump_data_version():
+    # Tras el commit de una escritura propia
+    global _data_version, _data_version_time
+    with _data_version_lock:
+        _data_version = max(_data_version, _version_propia)
+        _data_version_time = time.time()
+
+def _comprobar_version():
+    """Lee version_datos si alguien ha confirmado algo desde la última comprobación."""
+    global _vigia, _vigia_gen, _data_version, _version_propia
+    with _vigia_lock:
+        if _vigia is None or _vigia[0] != DB_NAME:
+            if _vigia is not None:
+                _vigia[1].close()
+                with _data_version_lock:
+                    _data_version = _version_propia = 0
+                _vigia_gen += 1
+            _vigia = [DB_NAME, sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None), None]
+        conn = _vigia[1]
+        cambios = conn.execute('PRAGMA data_version').fetchone()[0]
+        if cambios == _vigia[2]:
+            return
+        _vigia[2] = cambios
+        version = _leer_version(conn)
+    _ver_version(version)
+
+def _cerrar_vigia():
+    global _vigia
+    with _vigia_lock:
+        if _vigia is not None:
+            _vigia[1].close()
+            _vigia = None
+
+atexit.register(_cerrar_vigia)
+
+def get_data_version():
+    _comprobar_version()
+    return _data_version
+
+def get_data_version_time():
+    _comprobar_version()
+    return _data_version_time
+
+def get_data_etag():
+    # "Hoy" forma parte de la clave: a medianoche cambian ventas_hoy/gastos_hoy
+    return f'{_BOOT_ID}.{_vigia_gen}-{get_data_version()}-{datetime.date.today().isoformat()}'
+
+# --- AVISOS DE CAMBIOS ---
+# Tras confirmar cada escritura se avisa a los suscriptores con un delta
+# compacto (app.py lo reenvía a los terminales por SSE en /api/events).
+# Tipos: "venta", "producto", "stock" y "gasto".
+
+_change_listeners = []
+
+def add_change_listener(fn):
+    """Registra fn(tipo, datos); se llama tras cada commit, fuera de la transacción."""
+    _change_listeners.append(fn)
+
+def _notificar(tipo, datos):
+    for fn in list(_change_listeners):
+        try:
+            fn(tipo, datos)
+        except Exception as e:
+            print(f"Error avisando del cambio ({tipo}): {e}")
+
+def _aviso(tipo, datos):
+    # Para la lista despues de una escritura: avisar una vez confirmada
+    return lambda: _notificar(tipo, datos)
+
+def _leer_fecha(texto):
+    # ISO 8601 ('T' o espacio, 'Z' u otra zona) -> datetime en UTC; sin zona se toma como UTC
+    if not isinstance(texto, str):
+        raise ValueError(f"Fecha no válida: {texto!r}")
+    limpio = texto.strip()
+    if limpio[-1:] in ('Z', 'z'):
+        limpio = limpio[:-1] + '+00:00'
+    try:
+        valor = datetime.datetime.fromisoformat(limpio)
+    except ValueError:
+        raise ValueError(f"Fecha no válida: {texto!r}") from None
+    if valor.tzinfo is None:
+        return valor.replace(tzinfo=datetime.timezone.utc)
+    return valor.astimezone(datetime.timezone.utc)
+
+def _dia_local(fecha_utc):
+    # fecha de la BD (UTC, 'YYYY-MM-DD HH:MM:SS') -> día local, como resumen_diario
+    return _leer_fecha(fecha_utc).astimezone().date().isoformat()
+
+def _fecha_utc(fecha=None):
+    """Fecha de un ticket -> 'YYYY-MM-DD HH:MM:SS' en UTC (como CURRENT_TIMESTAMP).
+
+    Todas las fechas guardadas tienen el mismo formato, así que el orden
+    (fecha, id) y los filtros desde/hasta pueden comparar texto.
+    ValueError si no es una fecha ISO 8601.
+    """
+    if not fecha:
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return _leer_fecha(fecha).strftime('%Y-%m-%d %H:%M:%S')
+
+def _stock_actual(conn, codigos):
+    rows = conn.execute('''
+        SELECT id, codigo, nombre, stock, stock_minimo FROM productos
+        WHERE codigo IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(codigos)),)).fetchall()
+    return [dict(r) for r in rows]
+
+# --- ESQUEMA Y MIGRACIONES ---
+# Cada migración lleva la base de datos a la versión indicada y se guarda en
+# PRAGMA user_version. Si la versión ya es la actual init_db no ejecuta DDL.
+# Las migraciones usan IF NOT EXISTS: las bases creadas antes del versionado
+# (user_version = 0) ya pueden tener parte de las tablas.
+
+def _migracion_1_tablas_base(conn):
+    # Tabla Productos
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS productos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codigo TEXT UNIQUE NOT NULL,
+            nombre TEXT NOT NULL,
+            costo REAL NOT NULL,
+            venta REAL NOT NULL,
+            stock INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Tabla Ventas/Tickets
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ventas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total REAL NOT NULL,
+            items TEXT NOT NULL
+        )
+    ''')
+
+    # Tabla Gastos
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS gastos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            concepto TEXT NOT NULL,
+            monto REAL NOT NULL,
+            categoria TEXT
+        )
+    ''')
+
+    # Migración simple: Verificar si existe columna stock en productos
+    cursor = conn.execute("PRAGMA table_info(productos)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'stock' not in columns:
+        print("Migrando base de datos: añadiendo columna stock...")
+        conn.execute('ALTER TABLE productos ADD COLUMN stock INTEGER DEFAULT 0')
+
+def _migracion_2_venta_lineas(conn):
+    # Líneas de venta normalizadas (sustituyen al JSON de ventas.items).
+    # fecha se duplica de la venta para agregar por producto y periodo sin JOIN.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS venta_lineas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            venta_id INTEGER NOT NULL REFERENCES ventas(id) ON DELETE CASCADE,
+            producto_id INTEGER,
+            codigo TEXT NOT NULL,
+            nombre TEXT,
+            cantidad INTEGER NOT NULL,
+            precio REAL NOT NULL,
+            fecha TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_venta ON venta_lineas(venta_id)')
+    # Cubre "más vendidos" (GROUP BY codigo) y ventas de un producto por fechas
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_producto ON venta_lineas(codigo, fecha, cantidad, precio)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_fecha ON venta_lineas(fecha)')
+    # Índice parcial de tickets con JSON pendiente de migrar: comprobar si
+    # queda alguno al arrancar es inmediato aunque haya años de ventas.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ventas_items_pendientes ON ventas(id) WHERE items != ''")
+
+def _migracion_3_resumen_diario(conn):
+    # Totales diarios (día local) mantenidos en la misma transacción que cada
+    # venta/gasto. Los informes y el dashboard leen de aquí, no de ventas/gastos.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            dia TEXT PRIMARY KEY,
+            ventas_total REAL NOT NULL DEFAULT 0,
+            num_ventas INTEGER NOT NULL DEFAULT 0,
+            gastos_total REAL NOT NULL DEFAULT 0,
+            num_gastos INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_resumen(conn)
+
+def _migracion_4_movimientos_stock(conn):
+    # Diario de movimientos de stock (ajustes e inventarios físicos)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS movimientos_stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            producto_id INTEGER NOT NULL,
+            codigo TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            stock_resultante INTEGER NOT NULL,
+            motivo TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movimientos_producto ON movimientos_stock(producto_id, fecha)')
 
-        # Tabla Gastos
+def _migracion_5_fts(conn):
+    """Índice FTS5 sobre nombre/código, sincronizado con triggers.
+
+    Si el SQLite instalado no trae FTS5 se omite y la búsqueda usa LIKE.
+    """
+    try:
+        # remove_diacritics: "portatil" encuentra "Portátil"
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS gastos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                concepto TEXT NOT NULL,
-                monto REAL NOT NULL,
-                categoria TEXT
+            CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(
+                nombre, codigo,
+                content='productos', content_rowid='id',
+                tokenize="unicode61 remove_diacritics 2",
+                prefix='2 3'
             )
         ''')
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 no disponible, búsqueda con LIKE: {e}")
+        return
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS productos_fts_ai AFTER INSERT ON productos BEGIN
+            INSERT INTO productos_fts(rowid, nombre, codigo) VALUES (new.id, new.nombre, new.codigo);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS productos_fts_ad AFTER DELETE ON productos BEGIN
+            INSERT INTO productos_fts(productos_fts, rowid, nombre, codigo) VALUES ('delete', old.id, old.nombre, old.codigo);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS productos_fts_au AFTER UPDATE OF nombre, codigo ON productos BEGIN
+            INSERT INTO productos_fts(productos_fts, rowid, nombre, codigo) VALUES ('delete', old.id, old.nombre, old.codigo);
+            INSERT INTO productos_fts(rowid, nombre, codigo) VALUES (new.id, new.nombre, new.codigo);
+        END
+    ''')
+    conn.execute("INSERT INTO productos_fts(productos_fts) VALUES ('rebuild')")
+
+def _migracion_6_cache_extracciones(conn):
+    """Resultados de extracción de albaranes por hash del contenido del fichero."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_extracciones (
+            clave TEXT PRIMARY KEY,
+            resultado TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            creado TEXT NOT NULL,
+            usado TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_extracciones_usado ON cache_extracciones(usado)')
+
+def _migracion_7_indices_historial(conn):
+    # Historial paginado por (fecha, id) y exportación por periodo sin ordenar
+    # la tabla entera. venta_lineas ya tiene idx_venta_lineas_fecha.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ventas_fecha ON ventas(fecha, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_gastos_fecha ON gastos(fecha, id)')
+
+def _migracion_8_inventario(conn):
+    """Stock mínimo por producto y totales del inventario mantenidos con triggers."""
+    columnas = [c[1] for c in conn.execute('PRAGMA table_info(productos)')]
+    if 'stock_minimo' not in columnas:
+        conn.execute(f'ALTER TABLE productos ADD COLUMN stock_minimo INTEGER NOT NULL DEFAULT {STOCK_MINIMO}')
+    # Índice parcial: solo entran los productos en o por debajo de su mínimo
+    # (pocos), y ya ordenados por stock para el dashboard y las reposiciones
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_productos_stock_bajo ON productos(stock) WHERE stock <= stock_minimo')
+
+    # Una sola fila con las sumas del catálogo; los triggers aplican la
+    # diferencia de cada alta, baja o cambio de stock/precios
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventario_resumen (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            productos INTEGER NOT NULL DEFAULT 0,
+            total_items INTEGER NOT NULL DEFAULT 0,
+            valor_costo REAL NOT NULL DEFAULT 0,
+            valor_venta REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS inventario_ai AFTER INSERT ON productos BEGIN
+            UPDATE inventario_resumen SET
+                productos = productos + 1,
+                total_items = total_items + ifnull(new.stock, 0),
+                valor_costo = valor_costo + ifnull(new.stock, 0) * new.costo,
+                valor_venta = valor_venta + ifnull(new.stock, 0) * new.venta
+            WHERE id = 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS inventario_ad AFTER DELETE ON productos BEGIN
+            UPDATE inventario_resumen SET
+                productos = productos - 1,
+                total_items = total_items - ifnull(old.stock, 0),
+                valor_costo = valor_costo - ifnull(old.stock, 0) * old.costo,
+                valor_venta = valor_venta - ifnull(old.stock, 0) * old.venta
+            WHERE id = 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS inventario_au AFTER UPDATE OF stock, costo, venta ON productos BEGIN
+            UPDATE inventario_resumen SET
+                total_items = total_items + ifnull(new.stock, 0) - ifnull(old.stock, 0),
+                valor_costo = valor_costo + ifnull(new.stock, 0) * new.costo - ifnull(old.stock, 0) * old.costo,
+                valor_venta = valor_venta + ifnull(new.stock, 0) * new.venta - ifnull(old.stock, 0) * old.venta
+            WHERE id = 1;
+        END
+    ''')
+    _rebuild_inventario(conn)
+
+def _migracion_9_version_datos(conn):
+    # Versión de los datos compartida por todos los procesos (ver VERSIÓN DE DATOS)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS version_datos (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO version_datos (id, version) VALUES (1, 0)')
+
+MIGRACIONES = [
+    (1, _migracion_1_tablas_base),
+    (2, _migracion_2_venta_lineas),
+    (3, _migracion_3_resumen_diario),
+    (4, _migracion_4_movimientos_stock),
+    (5, _migracion_5_fts),
+    (6, _migracion_6_cache_extracciones),
+    (7, _migracion_7_indices_historial),
+    (8, _migracion_8_inventario),
+    (9, _migracion_9_version_datos),
+]
+SCHEMA_VERSION = MIGRACIONES[-1][0]
 
-        # Migración simple: Verificar si existe columna stock en productos
-        cursor = conn.execute("PRAGMA table_info(productos)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'stock' not in columns:
-            print("Migrando base de datos: añadiendo columna stock...")
-            conn.execute('ALTER TABLE productos ADD COLUMN stock INTEGER DEFAULT 0')
+def _migrar(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for numero, migracion in MIGRACIONES:
+        if numero <= version:
+            continue
+        print(f"Migrando base de datos a la versión {numero} ({migracion.__name__})...")
+        # Cada migración y su número de versión en la misma transacción
+        conn.execute('BEGIN IMMEDIATE')
+        anterior = None
+        try:
+            migracion(conn)
+            conn.execute(f'PRAGMA user_version = {numero}')
+            anterior = _subir_version(conn)
+            conn.commit()
+        except Exception:
+            _deshacer_version(anterior)
+            conn.rollback()
+            raise
+        _bump_data_version()
+    return version
 
+def init_db():
+    global HAS_FTS
+    conn = get_db_connection()
+    try:
+        _migrar(conn)
+        HAS_FTS = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'productos_fts'").fetchone() is not None
+        pendientes = conn.execute("SELECT EXISTS(SELECT 1 FROM ventas WHERE items != '')").fetchone()[0]
         print("Base de datos inicializada y verificada.")
     finally:
         conn.close()
 
-# --- PRODUCTOS ---
+    # La caché de escaneo se llena en segundo plano: mientras, se consulta SQLite
+    threading.Thread(target=warm_scan_cache, name='warm-scan-cache', daemon=True).start()
 
-def add_or_update_product(codigo, nombre, costo, venta, cantidad_a_sumar=0):
-    conn = get_db_connection()
+    if pendientes:
+        # Migración online: la caja puede cobrar mientras se rellenan las líneas
+        threading.Thread(target=migrar_venta_lineas, name='migrar-venta-lineas', daemon=True).start()
+
+_initialized_db = None
+_init_lock = threading.Lock()
+
+def ensure_initialized():
+    """Ejecuta init_db la primera vez que se necesita (una vez por DB_NAME)."""
+    global _initialized_db
+    if _initialized_db == DB_NAME:
+        return False
+    with _init_lock:
+        if _initialized_db == DB_NAME:
+            return False
+        init_db()
+        _initialized_db = DB_NAME
+    return True
+
+def _parse_items_blob(texto):
+    # Los tickets antiguos se guardaron con repr() de Python en vez de JSON
     try:
-        prod = conn.execute('SELECT * FROM productos WHERE codigo = ?', (codigo,)).fetchone()
+        return json.loads(texto)
+    except ValueError:
+        return ast.literal_eval(texto)
+
+def migrar_venta_lineas(lote=500):
+    """Rellena venta_lineas a partir de los JSON de ventas.items, por lotes.
+
+    Cada lote es una transacción corta; al migrar una venta se vacía su
+    columna items, así que el proceso es reanudable. Los blobs ilegibles se
+    dejan intactos. Devuelve (ventas migradas, ventas con error).
+    """
+    migradas = 0
+    fallidas = 0
+    ultimo_id = 0
+    while True:
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT id, fecha, items FROM ventas
+                WHERE id > ? AND items != ''
+                ORDER BY id LIMIT ?
+            ''', (ultimo_id, lote)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+
+        lineas = []
+        ok_ids = []
+        for r in rows:
+            try:
+                items = _parse_items_blob(r['items'])
+                lineas.extend(
+                    (r['id'], it.get('codigo'), it['codigo'], it.get('nombre'),
+                     int(it.get('cantidad', 1)), float(it.get('precio', 0)), r['fecha'])
+                    for it in items
+                )
+                ok_ids.append((r['id'],))
+            except Exception as e:
+                print(f"No se pudo migrar la venta {r['id']}: {e}")
+                fallidas += 1
+        ultimo_id = rows[-1]['id']
+
+        def escribir(conn, despues, lineas=lineas, ok_ids=ok_ids):
+            # Solo las ventas que siguen sin migrar (la lectura fue fuera de la transacción)
+            pendientes = {r[0] for r in conn.execute(
+                "SELECT id FROM ventas WHERE id IN (SELECT value FROM json_each(?)) AND items != ''",
+                (json.dumps([i for (i,) in ok_ids]),))}
+            conn.executemany('''
+                INSERT INTO venta_lineas (venta_id, producto_id, codigo, nombre, cantidad, precio, fecha)
+                VALUES (?, (SELECT id FROM productos WHERE codigo = ?), ?, ?, ?, ?, ?)
+            ''', [l for l in lineas if l[0] in pendientes])
+            conn.executemany("UPDATE ventas SET items = '' WHERE id = ?", [(i,) for i in pendientes])
+            despues.append(_bump_data_version)
+            return len(pendientes)
+
+        migradas += _escribir(escribir)
+
+    if migradas or fallidas:
+        print(f"Líneas de venta migradas: {migradas} ventas ({fallidas} con error).")
+    return migradas, fallidas
+
+# --- PRODUCTOS ---
+
+def add_or_update_product(codigo, nombre, costo, venta, cantidad_a_sumar=0, stock_minimo=None):
+    # stock_minimo=None: el producto conserva el suyo (o STOCK_MINIMO si es nuevo)
+    def escribir(conn, despues):
+        prod = conn.execute('SELECT id FROM productos WHERE codigo = ?', (codigo,)).fetchone()
         
         if prod:
-            nuevo_stock = prod['stock'] + cantidad_a_sumar
+            # Suma atómica en SQL: no se pierden actualizaciones concurrentes
             conn.execute('''
                 UPDATE productos 
-                SET nombre = ?, costo = ?, venta = ?, stock = ?
+                SET nombre = ?, costo = ?, venta = ?, stock = stock + ?,
+                    stock_minimo = COALESCE(?, stock_minimo)
                 WHERE codigo = ?
-            ''', (nombre, costo, venta, nuevo_stock, codigo))
+            ''', (nombre, costo, venta, cantidad_a_sumar, stock_minimo, codigo))
             action = "updated"
         else:
             conn.execute('''
-                INSERT INTO productos (codigo, nombre, costo, venta, stock) 
-                VALUES (?, ?, ?, ?, ?)
-            ''', (codigo, nombre, costo, venta, cantidad_a_sumar))
+                INSERT INTO productos (codigo, nombre, costo, venta, stock, stock_minimo) 
+                VALUES (?, ?, ?, ?, ?, COALESCE(?, ?))
+            ''', (codigo, nombre, costo, venta, cantidad_a_sumar, stock_minimo, STOCK_MINIMO))
             action = "created"
-            
-        conn.commit()
+
+        despues.append(lambda: _invalidate_products([codigo]))
+        despues.append(_bump_data_version)
+        if _change_listeners:
+            prod = dict(conn.execute('SELECT id, codigo, nombre, costo, venta, stock, stock_minimo FROM productos '
+                                     'WHERE codigo = ?', (codigo,)).fetchone())
+            despues.append(_aviso('producto', {"accion": "guardado", "producto": prod}))
         return {"success": True, "action": action}
+
+    try:
+        return _escribir(escribir)
     except Exception as e:
         return {"success": False, "error": str(e)}
+
+# --- CACHÉ DE ESCANEO ---
+# Índice código -> producto en memoria para /api/producto/scan. Cada fila se
+# guarda como tupla (mucho más compacta que un dict) y se descarta por LRU al
+# superar SCAN_CACHE_SIZE. Toda escritura invalida los códigos afectados.
+
+SCAN_CACHE_SIZE = int(os.environ.get('TPV_SCAN_CACHE_SIZE', 50000))
+_SCAN_COLUMNS = ('id', 'codigo', 'nombre', 'costo', 'venta', 'stock')
+
+
+class ProductCache:
+    def __init__(self, max_size=SCAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Cambia con cada invalidación: una lectura de BD que empezó antes de
+        # una escritura no puede volver a meter el valor antiguo en la caché.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, codigo):
+        with self._lock:
+            row = self._data.get(codigo)
+            if row is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(codigo)
+            self.hits += 1
+        return dict(zip(_SCAN_COLUMNS, row))
+
+    def put(self, row, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[row[1]] = tuple(row)
+            self._data.move_to_end(row[1])
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, codigos):
+        with self._lock:
+            self.generation += 1
+            for codigo in codigos:
+                self._data.pop(codigo, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions,
+            }
+
+
+_scan_cache = ProductCache()
+
+def warm_scan_cache():
+    """Carga en caché los productos más recientes (hasta el tamaño máximo)."""
+    gen = _scan_cache.generation
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT {', '.join(_SCAN_COLUMNS)} FROM productos ORDER BY id DESC LIMIT ?
+        ''', (_scan_cache.max_size,)).fetchall()
     finally:
         conn.close()
+    # Del más antiguo al más reciente: los últimos quedan al final del LRU
+    for r in reversed(rows):
+        _scan_cache.put(r, gen)
+    return len(rows)
+
+def get_scan_cache_stats():
+    return _scan_cache.stats()
+
+def _invalidate_products(codigos):
+    _scan_cache.invalidate(codigos)
+
+# Otro proceso (p. ej. import_script.py) no sabe qué productos tenemos en caché
+_al_cambiar_fuera.append(lambda: _scan_cache.clear())
 
 def get_product_by_code(codigo):
+    # Antes de la caché: si otro proceso ha cambiado precios, se vacía aquí
+    _comprobar_version()
+    prod = _scan_cache.get(codigo)
+    if prod: return prod
+
+    gen = _scan_cache.generation
     conn = get_db_connection()
-    prod = conn.execute('SELECT * FROM productos WHERE codigo = ?', (codigo,)).fetchone()
-    conn.close()
-    if prod: return dict(prod)
+    try:
+        row = conn.execute(f'SELECT {", ".join(_SCAN_COLUMNS)} FROM productos WHERE codigo = ?', (codigo,)).fetchone()
+    finally:
+        conn.close()
+    if row:
+        _scan_cache.put(row, gen)
+        return dict(row)
     return None
 
-def get_all_products(search=None):
+# Columnas que se pueden pedir con fields=
+PRODUCT_FIELDS = ('id', 'codigo', 'nombre', 'costo', 'venta', 'stock', 'stock_minimo')
+MAX_PAGE_SIZE = 1000
+SEARCH_LIMIT = 50  # resultados por defecto de una búsqueda
+
+HAS_FTS = False  # init_db lo activa si existe el índice FTS5
+
+def _product_columns(fields, alias=''):
+    prefijo = f'{alias}.' if alias else ''
+    if not fields:
+        return f'{prefijo}*'
+    invalidos = [f for f in fields if f not in PRODUCT_FIELDS]
+    if invalidos:
+        raise ValueError(f"Campos no válidos: {', '.join(invalidos)}")
+    # id siempre va incluido: es el cursor de paginación
+    return ', '.join(prefijo + c for c in ['id'] + [f for f in fields if f != 'id'])
+
+def _fts_query(search):
+    # Cada palabra como prefijo y todas obligatorias: "cable cat" -> "cable"* "cat"*
+    tokens = re.findall(r'\w+', search)
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+def get_all_products(search=None, limit=None, cursor=None, fields=None):
+    """Productos ordenados por id descendente.
+
+    Sin limit devuelve todo el catálogo (comportamiento original). Con limit
+    pagina por cursor: pasar como cursor el id del último producto recibido.
+    fields restringe las columnas devueltas. Con search (FTS5) los resultados
+    van ordenados por relevancia, limitados y sin cursor.
+    """
+    if search and HAS_FTS and _fts_query(search):
+        return _search_products(search, limit or SEARCH_LIMIT, fields)
+
     conn = get_db_connection()
-    query = 'SELECT * FROM productos'
+    query = f'SELECT {_product_columns(fields)} FROM productos'
+    where = []
     params = []
     if search:
-        query += ' WHERE nombre LIKE ? OR codigo LIKE ?'
+        where.append('(nombre LIKE ? OR codigo LIKE ?)')
         st = f'%{search}%'
-        params = [st, st]
+        params += [st, st]
+    if cursor is not None:
+        where.append('id < ?')
+        params.append(cursor)
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
     query += ' ORDER BY id DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(max(1, min(limit, MAX_PAGE_SIZE)))  # LIMIT -1 en SQLite es sin límite
     
-    productos = conn.execute(query, params).fetchall()
-    conn.close()
+    try:
+        productos = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
     return [dict(p) for p in productos]
 
-def delete_product(id):
+def _search_products(search, limit, fields=None):
+    conn = get_db_connection()
+    try:
+        # bm25 con más peso para el código: un escaneo parcial debe salir primero
+        productos = conn.execute(f'''
+            SELECT {_product_columns(fields, 'p')} FROM productos_fts f
+            JOIN productos p ON p.id = f.rowid
+            WHERE productos_fts MATCH ?
+            ORDER BY bm25(productos_fts, 1.0, 5.0)
+            LIMIT ?
+        ''', (_fts_query(search), max(1, min(limit, MAX_PAGE_SIZE)))).fetchall()
+    finally:
+        conn.close()
+    return [dict(p) for p in productos]
+
+def count_products(search=None):
+    conn = get_db_connection()
+    query = 'SELECT COUNT(*) FROM productos'
+    params = []
+    if search and HAS_FTS and _fts_query(search):
+        query = 'SELECT COUNT(*) FROM productos_fts WHERE productos_fts MATCH ?'
+        params = [_fts_query(search)]
+    elif search:
+        query += ' WHERE nombre LIKE ? OR codigo LIKE ?'
+        st = f'%{search}%'
+        params = [st, st]
+    try:
+        return conn.execute(query, params).fetchone()[0]
+    finally:
+        conn.close()
+
+def get_product_by_id(id, fields=None):
     conn = get_db_connection()
-    with conn:
+    try:
+        prod = conn.execute(f'SELECT {_product_columns(fields)} FROM productos WHERE id = ?', (id,)).fetchone()
+    finally:
+        conn.close()
+    if prod: return dict(prod)
+    return None
+
+BULK_CHUNK_SIZE = 1000
+
+def _normalizar_producto(p):
+    # Mismas reglas que la ruta POST /api/productos
+    codigo = str(p.get('codigo') or '').strip()
+    nombre = str(p.get('nombre') or '').strip()
+    if not (codigo and nombre):
+        raise ValueError('Faltan código o nombre')
+    stock = p.get('stock', p.get('unidades', 0))
+    return (codigo, nombre, float(p.get('costo') or 0), float(p.get('venta') or 0), int(stock or 0))
+
+def bulk_upsert_products(productos, detalle=True, por_bloques=False):
+    """Alta/actualización masiva en una sola transacción.
+
+    Acepta cualquier iterable (también generadores) de dicts con codigo,
+    nombre, costo, venta y stock/unidades a sumar. Se procesa por bloques de
+    BULK_CHUNK_SIZE con INSERT ... ON CONFLICT(codigo) DO UPDATE, igual que
+    add_or_update_product: se sobrescriben nombre y precios y se suma el stock.
+    Con detalle=True devuelve el resultado de cada fila; si no, solo los
+    contadores y los errores. Con por_bloques=True se confirma cada bloque
+    por separado, para que una importación larga desde un generador no
+    bloquee las ventas mientras se lee el fichero; si un bloque falla, los
+    anteriores ya están guardados y el resultado lleva "error", lo
+    confirmado hasta entonces y la línea donde se paró (linea_fallo).
+    """
+    resultados = []
+    errores = []
+    cont = {"creados": 0, "actualizados": 0}
+    vistos = set()  # códigos ya tratados en este lote (duplicados => update)
+    leidas = [0]    # primera línea sin confirmar
+
+    def bloques():
+        # Lectura y validación en el hilo del llamador: el escritor solo ejecuta SQL
+        idx = 0
+        for bloque in _chunks(productos, BULK_CHUNK_SIZE):
+            inicio = idx
+            filas = []
+            for p in bloque:
+                try:
+                    filas.append((idx, _normalizar_producto(p)))
+                except (AttributeError, TypeError, ValueError) as e:
+                    codigo = p.get('codigo') if isinstance(p, dict) else None
+                    errores.append({"linea": idx, "codigo": codigo, "error": str(e)})
+                idx += 1
+            leidas[0] = inicio
+            yield filas
+            leidas[0] = idx  # bloque confirmado: si falla la lectura del siguiente, empieza aquí
+
+    def upsert(lista_bloques):
+        # Los contadores se anotan tras el commit (confirmar): si la
+        # transacción falla no cuentan filas que no se han guardado
+        def escribir(conn, despues):
+            tocados = set()
+            vistos_op = set(vistos)
+            hechos = []  # (linea, codigo, action)
+            for filas in lista_bloques:
+                nuevos = [f[0] for _, f in filas if f[0] not in vistos_op]
+                existentes = {r[0] for r in conn.execute(
+                    'SELECT codigo FROM productos WHERE codigo IN (SELECT value FROM json_each(?))',
+                    (json.dumps(nuevos),))}
+
+                conn.executemany('''
+                    INSERT INTO productos (codigo, nombre, costo, venta, stock)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(codigo) DO UPDATE SET
+                        nombre = excluded.nombre,
+                        costo = excluded.costo,
+                        venta = excluded.venta,
+                        stock = stock + excluded.stock
+                ''', [f for _, f in filas])
+
+                for linea, f in filas:
+                    codigo = f[0]
+                    hechos.append((linea, codigo, "updated" if codigo in vistos_op or codigo in existentes else "created"))
+                    vistos_op.add(codigo)
+                tocados.update(f[0] for _, f in filas)
+            despues.append(lambda: _invalidate_products(tocados))
+            despues.append(_bump_data_version)
+            return hechos
+        return escribir
+
+    def confirmar(hechos):
+        for linea, codigo, action in hechos:
+            vistos.add(codigo)
+            cont["creados" if action == "created" else "actualizados"] += 1
+            if detalle:
+                resultados.append({"linea": linea, "codigo": codigo, "action": action})
+
+    fallo = None
+    try:
+        if por_bloques:
+            # Cada bloque es una operación del escritor: entre uno y otro entran las ventas
+            for filas in bloques():
+                confirmar(_escribir(upsert([filas])))
+        else:
+            confirmar(_escribir(upsert(list(bloques()))))
+    except Exception as e:
+        if not por_bloques:
+            return {"success": False, "error": str(e)}
+        fallo = str(e)
+
+    creados, actualizados = cont["creados"], cont["actualizados"]
+    if creados or actualizados:
+        # Un aviso por importación, no por producto: los terminales recargan la vista
+        _notificar('producto', {"accion": "importados", "creados": creados, "actualizados": actualizados})
+    res = {
+        "success": not errores and fallo is None,
+        "creados": creados,
+        "actualizados": actualizados,
+        "errores": errores
+    }
+    if fallo is not None:
+        res["error"] = fallo
+        res["linea_fallo"] = leidas[0]
+    if detalle:
+        res["resultados"] = resultados
+    return res
+
+def _chunks(iterable, size):
+    bloque = []
+    for x in iterable:
+        bloque.append(x)
+        if len(bloque) >= size:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+def delete_product(id):
+    def escribir(conn, despues):
+        prod = conn.execute('SELECT codigo FROM productos WHERE id = ?', (id,)).fetchone()
         conn.execute('DELETE FROM productos WHERE id = ?', (id,))
-    conn.close()
+        if prod:
+            codigo = prod['codigo']
+            despues.append(lambda: _invalidate_products([codigo]))
+            despues.append(_aviso('producto', {"accion": "borrado", "id": id, "codigo": codigo}))
+        despues.append(_bump_data_version)
 
-# --- VENTAS ---
+    _escribir(escribir)
 
-def procesar_venta(items):
+# --- STOCK ---
+
+STOCK_MINIMO = 5  # mínimo de los productos nuevos (DEFAULT de la columna stock_minimo)
+REPONER_DIAS_VENTAS = int(os.environ.get('TPV_REORDER_SALES_DAYS', 30))  # días de ventas para el ritmo de venta
+REPONER_COBERTURA = int(os.environ.get('TPV_REORDER_COVER_DAYS', 14))    # días de venta que cubre un pedido
+
+def ajustar_stock(movimientos, motivo='ajuste', atomico=False):
+    """Aplica ajustes de stock en una sola transacción y los anota en movimientos_stock.
+
+    Cada movimiento identifica el producto con "codigo" o "id" y lleva
+    "delta" (suma/resta) o "stock" (recuento físico absoluto). Todas las
+    escrituras son "stock = stock + ?" para no pisar ventas concurrentes.
+    Los movimientos con errores se omiten; con atomico=True anulan todo.
+    """
+    def escribir(conn, despues):
+        # Resolver todos los productos de una vez
+        claves = [m.get('codigo') if m.get('codigo') is not None else m.get('id')
+                  for m in movimientos if isinstance(m, dict)]
+        rows = conn.execute('''
+            SELECT p.id, p.codigo, p.nombre, p.stock, p.stock_minimo FROM productos p
+            WHERE p.codigo IN (SELECT value FROM json_each(?))
+               OR p.id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps([c for c in claves if isinstance(c, str)]),
+              json.dumps([c for c in claves if isinstance(c, int)]))).fetchall()
+        por_codigo = {r['codigo']: r for r in rows}
+        por_id = {r['id']: r for r in rows}
+        stock = {r['id']: r['stock'] or 0 for r in rows}
+
+        aplicados = []  # (producto_id, codigo, delta, stock_resultante)
+        errores = []
+        for idx, m in enumerate(movimientos):
+            if not isinstance(m, dict):
+                errores.append({"linea": idx, "error": "Movimiento no válido"})
+                continue
+            prod = por_codigo.get(m.get('codigo')) if m.get('codigo') is not None else por_id.get(m.get('id'))
+            ref = m.get('codigo', m.get('id'))
+            if not prod:
+                errores.append({"linea": idx, "codigo": ref, "error": "Producto no encontrado"})
+                continue
+            try:
+                if m.get('stock') is not None:
+                    delta = int(m['stock']) - stock[prod['id']]
+                else:
+                    delta = int(m['delta'])
+            except (KeyError, TypeError, ValueError):
+                errores.append({"linea": idx, "codigo": ref, "error": "Indica delta o stock numérico"})
+                continue
+            stock[prod['id']] += delta
+            aplicados.append((prod['id'], prod['codigo'], delta, stock[prod['id']]))
+
+        if errores and atomico:
+            return {"success": False, "errores": errores, "error": _resumen_errores(errores)}
+
+        conn.executemany('UPDATE productos SET stock = stock + ? WHERE id = ?',
+                         [(delta, pid) for pid, _, delta, _ in aplicados if delta])
+        conn.executemany('''
+            INSERT INTO movimientos_stock (producto_id, codigo, delta, stock_resultante, motivo)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(pid, codigo, delta, resultante, motivo) for pid, codigo, delta, resultante in aplicados])
+        despues.append(lambda: _invalidate_products([codigo for _, codigo, _, _ in aplicados]))
+        despues.append(_bump_data_version)
+        if aplicados:
+            filas = {r['id']: r for r in rows}
+            final = {}  # stock final de cada producto (puede venir varias veces)
+            for pid, codigo, _, resultante in aplicados:
+                final[pid] = {"id": pid, "codigo": codigo, "nombre": filas[pid]['nombre'], "stock": resultante,
+                              "stock_minimo": filas[pid]['stock_minimo']}
+            despues.append(_aviso('stock', {"motivo": motivo, "stock": list(final.values())}))
+        return {
+            "success": not errores,
+            "aplicados": len(aplicados),
+            "errores": errores,
+            "stock": {codigo: resultante for _, codigo, _, resultante in aplicados}
+        }
+
+    try:
+        return _escribir(escribir)
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+def get_stock_movements(codigo=None, limit=100):
+    conn = get_db_connection()
+    query = 'SELECT * FROM movimientos_stock'
+    params = []
+    if codigo:
+        query += ' WHERE producto_id = (SELECT id FROM productos WHERE codigo = ?)'
+        params.append(codigo)
+    query += ' ORDER BY id DESC LIMIT ?'
+    params.append(max(1, min(limit or 100, MAX_PAGE_SIZE)))
+    try:
+        movs = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    return [dict(m) for m in movs]
+
+def set_stock_minimo(id, stock_minimo):
+    """Fija el stock mínimo de un producto; devuelve el producto o None si no existe."""
+    def escribir(conn, despues):
+        if not conn.execute('UPDATE productos SET stock_minimo = ? WHERE id = ?', (stock_minimo, id)).rowcount:
+            return None
+        prod = dict(conn.execute('SELECT id, codigo, nombre, costo, venta, stock, stock_minimo FROM productos '
+                                 'WHERE id = ?', (id,)).fetchone())
+        despues.append(_bump_data_version)
+        despues.append(_aviso('producto', {"accion": "guardado", "producto": prod}))
+        return prod
+
+    return _escribir(escribir)
+
+def get_reorder_suggestions(limit=100, dias_ventas=REPONER_DIAS_VENTAS, cobertura=REPONER_COBERTURA):
+    """Productos en o por debajo de su stock mínimo, con la cantidad a pedir.
+
+    Se propone llegar al mínimo más lo que se vende en cobertura días al
+    ritmo de los últimos dias_ventas días (al menos una unidad por encima
+    del mínimo). Los productos salen de idx_productos_stock_bajo, ya
+    ordenados por stock, y el ritmo de idx_venta_lineas_producto.
+    """
+    limit = max(1, min(limit or 100, MAX_PAGE_SIZE))
+    dias_ventas = max(1, dias_ventas or REPONER_DIAS_VENTAS)
+    cobertura = max(0, cobertura if cobertura is not None else REPONER_COBERTURA)
+    conn = get_db_connection()
+    try:
+        productos = conn.execute('''
+            SELECT id, codigo, nombre, stock, stock_minimo, costo FROM productos
+            WHERE stock <= stock_minimo ORDER BY stock ASC LIMIT ?
+        ''', (limit,)).fetchall()
+        # Solo tpv.db: los días recientes nunca están archivados
+        vendidas = {r[0]: r[1] for r in conn.execute('''
+            SELECT codigo, SUM(cantidad) FROM venta_lineas
+            WHERE codigo IN (SELECT value FROM json_each(?)) AND fecha >= datetime('now', ?)
+            GROUP BY codigo
+        ''', (json.dumps([p['codigo'] for p in productos]), f'-{int(dias_ventas)} days'))}
+    finally:
+        conn.close()
+
+    sugerencias = []
+    for p in productos:
+        d = dict(p)
+        diaria = vendidas.get(d['codigo'], 0) / dias_ventas
+        objetivo = d['stock_minimo'] + max(1, math.ceil(diaria * cobertura))
+        d['venta_diaria'] = round(diaria, 2)
+        d['dias_restantes'] = round(max(d['stock'] or 0, 0) / diaria, 1) if diaria else None
+        d['sugerido'] = objetivo - (d['stock'] or 0)
+        d['coste_pedido'] = round(d['sugerido'] * d['costo'], 2)
+        sugerencias.append(d)
+    return sugerencias
+
+# --- CACHÉ DE EXTRACCIONES (albaranes) ---
+# Volver a subir la misma foto o CSV no repite la llamada al modelo. La clave la
+# calcula ocr_service (hash del contenido + modelo/prompt); aquí solo se guarda
+# y se expulsa lo más antiguo por edad y por tamaño total.
+
+EXTRACT_CACHE_MAX_BYTES = int(float(os.environ.get('TPV_OCR_CACHE_MB', 64)) * 1024 * 1024)
+EXTRACT_CACHE_MAX_DAYS = float(os.environ.get('TPV_OCR_CACHE_DAYS', 30))
+
+def get_cached_extraction(clave):
     conn = get_db_connection()
-    total_ticket = 0
-    items_json = json.dumps(items) # Usamos JSON DE VERDAD ahora via json lib
-    
     try:
-        conn.execute('BEGIN TRANSACTION')
-        for item in items:
-            codigo = item['codigo']
+        row = conn.execute('SELECT resultado FROM cache_extracciones WHERE clave = ? AND usado >= ?',
+                           (clave, _limite_cache_extracciones())).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    ahora = _ahora_utc()
+    _escribir(lambda c, despues: c.execute(
+        "UPDATE cache_extracciones SET usado = ?, hits = hits + 1 WHERE clave = ?", (ahora, clave)))
+    return json.loads(row['resultado'])
+
+def save_cached_extraction(clave, resultado):
+    texto = json.dumps(resultado, ensure_ascii=False)
+    tam = len(texto.encode('utf-8'))
+    if tam > EXTRACT_CACHE_MAX_BYTES:
+        return False  # no cabe: mejor no vaciar la caché entera por un solo fichero
+    ahora = _ahora_utc()
+
+    def escribir(conn, despues):
+        conn.execute('''
+            INSERT INTO cache_extracciones (clave, resultado, bytes, creado, usado) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(clave) DO UPDATE SET resultado = excluded.resultado, bytes = excluded.bytes,
+                creado = excluded.creado, usado = excluded.usado
+        ''', (clave, texto, tam, ahora, ahora))
+        _purgar_cache_extracciones(conn)
+
+    _escribir(escribir)
+    return True
+
+def _ahora_utc(delta=None):
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    if delta:
+        ahora -= delta
+    return ahora.strftime('%Y-%m-%d %H:%M:%S.%f')  # con microsegundos: ordena bien las subidas seguidas
+
+def _limite_cache_extracciones():
+    return _ahora_utc(datetime.timedelta(days=EXTRACT_CACHE_MAX_DAYS))
+
+def _purgar_cache_extracciones(conn):
+    conn.execute('DELETE FROM cache_extracciones WHERE usado < ?', (_limite_cache_extracciones(),))
+    # Tamaño: se conservan las más recientes hasta llenar el cupo
+    conn.execute('''
+        DELETE FROM cache_extracciones WHERE clave IN (
+            SELECT clave FROM (
+                SELECT clave, SUM(bytes) OVER (ORDER BY usado DESC, clave) AS acumulado
+                FROM cache_extracciones
+            ) WHERE acumulado > ?
+        )
+    ''', (EXTRACT_CACHE_MAX_BYTES,))
+
+def clear_extraction_cache():
+    return _escribir(lambda conn, despues: conn.execute('DELETE FROM cache_extracciones').rowcount)
+
+def get_extraction_cache_stats():
+    conn = get_db_connection()
+    try:
+        row = conn.execute('''
+            SELECT COUNT(*) AS entradas, COALESCE(SUM(bytes), 0) AS bytes, COALESCE(SUM(hits), 0) AS hits
+            FROM cache_extracciones
+        ''').fetchone()
+    finally:
+        conn.close()
+    return {**dict(row), "max_bytes": EXTRACT_CACHE_MAX_BYTES, "max_dias": EXTRACT_CACHE_MAX_DAYS}
+
+# --- VENTAS ---
+
+# Permitir vender por debajo de 0 (inventario no cargado todavía en la tienda)
+PERMITIR_STOCK_NEGATIVO = os.environ.get('TPV_ALLOW_NEGATIVE_STOCK', '0') == '1'
+
+def _validar_ticket(conn, items):
+    """Resuelve todos los códigos del ticket de una vez y valida cantidades y stock.
+
+    Devuelve (lineas, errores). Cada línea válida es
+    (producto_id, codigo, nombre, cantidad, precio).
+    """
+    lineas = []
+    errores = []
+    pedidos = {}  # codigo -> unidades totales pedidas en el ticket
+
+    for idx, item in enumerate(items):
+        codigo = item.get('codigo') if isinstance(item, dict) else None
+        if not codigo:
+            errores.append({"linea": idx, "codigo": codigo, "error": "Falta el código"})
+            continue
+        try:
             cantidad = int(item.get('cantidad', 1))
-            
-            # Verificar stock
-            curr = conn.execute('SELECT stock FROM productos WHERE codigo = ?', (codigo,)).fetchone()
-            if not curr: continue # O error
-            
-            # Restar venta
-            conn.execute('UPDATE productos SET stock = stock - ? WHERE codigo = ?', (cantidad, codigo))
-            total_ticket += item['precio'] * cantidad
-
-        conn.execute('INSERT INTO ventas (total, items) VALUES (?, ?)', (total_ticket, items_json))
-        conn.commit()
-        return {"success": True, "total": total_ticket}
+            precio = float(item['precio'])
+        except (KeyError, TypeError, ValueError):
+            errores.append({"linea": idx, "codigo": codigo, "error": "Cantidad o precio no válidos"})
+            continue
+        if cantidad <= 0:
+            errores.append({"linea": idx, "codigo": codigo, "error": "La cantidad debe ser positiva"})
+            continue
+        lineas.append((idx, codigo, cantidad, precio))
+        pedidos[codigo] = pedidos.get(codigo, 0) + cantidad
+
+    # Una sola consulta para todos los códigos (json_each evita el límite de parámetros)
+    productos = {}
+    stock = {}
+    if pedidos:
+        rows = conn.execute('''
+            SELECT p.id, p.codigo, p.nombre, p.stock FROM productos p
+            JOIN json_each(?) j ON p.codigo = j.value
+        ''', (json.dumps(list(pedidos)),)).fetchall()
+        productos = {r['codigo']: r for r in rows}
+        stock = {c: r['stock'] or 0 for c, r in productos.items()}
+
+    validas = []
+    for idx, codigo, cantidad, precio in lineas:
+        if codigo not in productos:
+            errores.append({"linea": idx, "codigo": codigo, "error": "Producto no encontrado"})
+        elif not PERMITIR_STOCK_NEGATIVO and pedidos[codigo] > stock[codigo]:
+            errores.append({"linea": idx, "codigo": codigo,
+                            "error": f"Stock insuficiente (disponible {stock[codigo]}, solicitado {pedidos[codigo]})"})
+        else:
+            prod = productos[codigo]
+            nombre = items[idx].get('nombre') or prod['nombre']
+            validas.append((prod['id'], codigo, nombre, cantidad, precio))
+
+    errores.sort(key=lambda e: e['linea'])
+    return validas, errores
+
+def _registrar_venta(conn, items, fecha=None, eventos=None):
+    """Valida y aplica un ticket dentro de una transacción ya abierta.
+
+    No hace commit ni rollback: si hay errores no escribe nada. Si se pasa
+    la lista eventos se le añade el aviso de la venta, que el llamador
+    publica tras el commit.
+    """
+    try:
+        fecha = _fecha_utc(fecha)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    lineas, errores = _validar_ticket(conn, items)
+    if errores:
+        return {"success": False, "errores": errores, "error": _resumen_errores(errores)}
+
+    conn.executemany('UPDATE productos SET stock = stock - ? WHERE codigo = ?',
+                     [(cantidad, codigo) for _, codigo, _, cantidad, _ in lineas])
+    total_ticket = sum(cantidad * precio for _, _, _, cantidad, precio in lineas)
+    # Las líneas van a venta_lineas; items queda vacío (solo lo usan tickets antiguos)
+    cur = conn.execute("INSERT INTO ventas (fecha, total, items) VALUES (?, ?, '')", (fecha, total_ticket))
+    venta_id = cur.lastrowid
+    conn.executemany('''
+        INSERT INTO venta_lineas (venta_id, producto_id, codigo, nombre, cantidad, precio, fecha)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(venta_id, pid, codigo, nombre, cantidad, precio, fecha)
+          for pid, codigo, nombre, cantidad, precio in lineas])
+    _acumular_resumen(conn, fecha, ventas=total_ticket, num_ventas=1)
+    if eventos is not None:
+        # El aviso es secundario: si no se puede preparar, la venta sigue adelante
+        try:
+            eventos.append({
+                "id": venta_id, "fecha": fecha, "dia": _dia_local(fecha), "total": total_ticket,
+                "items": [{"codigo": codigo, "nombre": nombre, "cantidad": cantidad, "precio": precio}
+                          for _, codigo, nombre, cantidad, precio in lineas],
+                "stock": _stock_actual(conn, {codigo for _, codigo, _, _, _ in lineas}),
+            })
+        except Exception as e:
+            print(f"Error preparando el aviso de la venta {venta_id}: {e}")
+    return {"success": True, "id": venta_id, "total": total_ticket}
+
+def _codigos_tickets(tickets):
+    return {it.get('codigo') for items in tickets for it in items if isinstance(it, dict)}
+
+def _resumen_errores(errores):
+    return '; '.join(f"Línea {e['linea'] + 1} ({e.get('codigo')}): {e['error']}" for e in errores)
+
+def procesar_venta(items, fecha=None):
+    def escribir(conn, despues):
+        # La transacción del escritor ya tiene el bloqueo antes de leer el stock
+        eventos = [] if _change_listeners else None
+        res = _registrar_venta(conn, items, fecha, eventos)
+        if res['success']:
+            despues.append(lambda: _invalidate_products(_codigos_tickets([items])))
+            despues.append(_bump_data_version)
+            despues.extend(_aviso('venta', evento) for evento in eventos or [])
+        return res
+
+    try:
+        return _escribir(escribir)
     except Exception as e:
-        conn.rollback()
         return {"success": False, "error": str(e)}
+
+def procesar_ventas_batch(tickets, atomico=False):
+    """Registra muchos tickets en una sola transacción (p. ej. cola offline de un terminal).
+
+    Cada ticket es {"items": [...], "fecha": opcional}. Por defecto los tickets
+    con errores se descartan y el resto se confirma; con atomico=True cualquier
+    error anula todo el lote.
+    """
+    def escribir(conn, despues):
+        resultados = []
+        eventos = [] if _change_listeners else None
+        for idx, ticket in enumerate(tickets):
+            items = ticket.get('items') if isinstance(ticket, dict) else None
+            if not items:
+                res = {"success": False, "error": "Ticket vacío"}
+            else:
+                # SAVEPOINT por ticket: un fallo inesperado no arrastra al resto
+                conn.execute('SAVEPOINT ticket')
+                n_eventos = len(eventos) if eventos is not None else 0
+                try:
+                    res = _registrar_venta(conn, items, ticket.get('fecha'), eventos)
+                    conn.execute('RELEASE SAVEPOINT ticket')
+                except Exception as e:
+                    if eventos is not None:
+                        del eventos[n_eventos:]
+                    conn.execute('ROLLBACK TO SAVEPOINT ticket')
+                    conn.execute('RELEASE SAVEPOINT ticket')
+                    res = {"success": False, "error": str(e)}
+            res['ticket'] = idx
+            resultados.append(res)
+
+        fallidos = sum(1 for r in resultados if not r['success'])
+        if atomico and fallidos:
+            # Nada del lote se guarda: los tickets válidos tampoco tienen venta
+            for r in resultados:
+                if r['success']:
+                    r.pop('id', None)
+                    r.pop('total', None)
+                    r.update(success=False, error="Anulado por el lote")
+            raise _Anular({"success": False, "error": f"{fallidos} tickets con errores, lote anulado",
+                           "procesados": 0, "fallidos": len(resultados), "total": 0,
+                           "resultados": resultados})
+        despues.append(lambda: _invalidate_products(
+            _codigos_tickets(t.get('items') or [] for t in tickets if isinstance(t, dict))))
+        despues.append(_bump_data_version)
+        despues.extend(_aviso('venta', evento) for evento in eventos or [])
+        return {
+            "success": fallidos == 0,
+            "procesados": len(resultados) - fallidos,
+            "fallidos": fallidos,
+            "total": sum(r['total'] for r in resultados if r['success']),
+            "resultados": resultados
+        }
+
+    try:
+        return _escribir(escribir)
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+# --- HISTORIAL Y EXPORTACIÓN ---
+# Ventas y gastos se recorren por (fecha, id) con cursor (keyset), nunca con
+# OFFSET: cada página cuesta lo mismo aunque haya años de tickets. Los filtros
+# desde/hasta son días locales inclusivos; las fechas se guardan en UTC.
+# Con años archivados se lee de las vistas historico_* (ver _historico).
+
+HISTORIAL_PAGE_SIZE = 50
+EXPORT_LOTE = 1000  # filas por consulta al exportar (memoria constante)
+
+def _limites_utc(desde, hasta):
+    """('YYYY-MM-DD', 'YYYY-MM-DD') locales -> [inicio, fin) en UTC, como la columna fecha."""
+    def medianoche_utc(dia, dias=0):
+        local = datetime.datetime.combine(datetime.date.fromisoformat(dia) + datetime.timedelta(days=dias),
+                                          datetime.time())
+        return local.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        return (medianoche_utc(desde) if desde else None,
+                medianoche_utc(hasta, 1) if hasta else None)
+    except ValueError:
+        raise ValueError('Fechas en formato YYYY-MM-DD')
+
+def _codificar_cursor(fila):
+    return base64.urlsafe_b64encode(json.dumps([fila['fecha'], fila['id']]).encode()).decode()
+
+def _decodificar_cursor(cursor):
+    try:
+        fecha, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(fecha), int(id)
+    except (ValueError, TypeError):
+        raise ValueError('Cursor no válido')
+
+def _where_fecha(desde, hasta, despues_de=None, antes_de=None):
+    inicio, fin = _limites_utc(desde, hasta)
+    where, params = [], []
+    if inicio:
+        where.append('fecha >= ?')
+        params.append(inicio)
+    if fin:
+        where.append('fecha < ?')
+        params.append(fin)
+    if antes_de:
+        where.append('(fecha, id) < (?, ?)')
+        params += list(antes_de)
+    if despues_de:
+        where.append('(fecha, id) > (?, ?)')
+        params += list(despues_de)
+    return (' WHERE ' + ' AND '.join(where)) if where else '', params
+
+def _pagina(tabla, columnas, desde, hasta, limit, cursor):
+    limit = max(1, min(limit or HISTORIAL_PAGE_SIZE, MAX_PAGE_SIZE))
+    where, params = _where_fecha(desde, hasta, antes_de=_decodificar_cursor(cursor) if cursor else None)
+    conn = get_db_connection()
+    try:
+        # Una fila de más para saber si hay otra página
+        filas = conn.execute(f'SELECT {columnas} FROM {_historico(conn, tabla)}{where} '
+                             f'ORDER BY fecha DESC, id DESC LIMIT ?', params + [limit + 1]).fetchall()
+        hay_mas = len(filas) > limit
+        filas = filas[:limit]
+        filas = _con_items(conn, filas) if tabla == 'ventas' else [dict(f) for f in filas]
     finally:
         conn.close()
+    return filas, _codificar_cursor(filas[-1]) if hay_mas else None
+
+def get_sales_page(desde=None, hasta=None, limit=HISTORIAL_PAGE_SIZE, cursor=None):
+    """Ventas de más reciente a más antigua con sus líneas; devuelve (ventas, cursor siguiente)."""
+    return _pagina('ventas', 'id, fecha, total, items', desde, hasta, limit, cursor)
+
+def get_expenses_page(desde=None, hasta=None, limit=HISTORIAL_PAGE_SIZE, cursor=None):
+    """Gastos de más reciente a más antiguo; devuelve (gastos, cursor siguiente)."""
+    return _pagina('gastos', '*', desde, hasta, limit, cursor)
+
+EXPORTACIONES = {
+    # tipo -> (tabla, columnas SQL, columnas exportadas)
+    'ventas': ('ventas', 'id, fecha, total', ('id', 'fecha', 'dia', 'total', 'lineas')),
+    'lineas': ('venta_lineas', 'id, venta_id, fecha, codigo, nombre, cantidad, precio',
+               ('venta_id', 'fecha', 'dia', 'codigo', 'nombre', 'cantidad', 'precio', 'importe')),
+    'gastos': ('gastos', 'id, fecha, concepto, categoria, monto',
+               ('id', 'fecha', 'dia', 'concepto', 'categoria', 'monto')),
+}
+
+def iter_export(tipo, desde=None, hasta=None, lote=EXPORT_LOTE):
+    """Generador de filas (dicts) de ventas, lineas o gastos en orden cronológico.
+
+    Valida tipo y fechas al llamarla (ValueError) y después lee por lotes con
+    cursor, con una conexión del pool por lote: ni la memoria ni la conexión
+    dependen del tamaño del periodo. fecha es UTC (como se guarda) y dia el
+    día local.
+    """
+    if tipo not in EXPORTACIONES:
+        raise ValueError(f"Tipo de exportación desconocido: {tipo}")
+    tabla, columnas, salida = EXPORTACIONES[tipo]
+    _limites_utc(desde, hasta)
+
+    def generar():
+        ultimo = None
+        while True:
+            where, params = _where_fecha(desde, hasta, despues_de=ultimo)
+            conn = get_db_connection()
+            try:
+                filas = conn.execute(f'SELECT {columnas} FROM {_historico(conn, tabla)}{where} ORDER BY fecha, id LIMIT ?',
+                                     params + [lote]).fetchall()
+                if tipo == 'ventas':
+                    # Líneas por ticket del lote en una consulta (una subconsulta
+                    # correlacionada no entra en las vistas de años archivados)
+                    lineas = Counter(r[0] for r in conn.execute(
+                        f'SELECT venta_id FROM {_historico(conn, "venta_lineas")} '
+                        f'WHERE venta_id IN (SELECT value FROM json_each(?))',
+                        (json.dumps([f['id'] for f in filas]),)))
+            finally:
+                conn.close()
+            for f in filas:
+                d = dict(f)
+                d['dia'] = _dia_local(d['fecha'])
+                if tipo == 'ventas':
+                    d['lineas'] = lineas[d['id']]
+                elif tipo == 'lineas':
+                    d['importe'] = round(d['cantidad'] * d['precio'], 2)
+                yield {k: d[k] for k in salida}
+            if len(filas) < lote:
+                return
+            ultimo = (filas[-1]['fecha'], filas[-1]['id'])
+
+    return generar()
 
 def get_recent_sales(limit=50):
-    conn = get_db_connection()
-    sales = conn.execute('SELECT * FROM ventas ORDER BY fecha DESC LIMIT ?', (limit,)).fetchall()
-    conn.close()
-    
-    # Parsear items JSON para frontend
+    return get_sales_page(limit=limit)[0]
+
+def _con_items(conn, sales):
+    # Sin ORDER BY en SQL: así el filtro por venta_id llega a cada año de la vista
+    lineas = conn.execute(f'''
+        SELECT id, venta_id, codigo, nombre, cantidad, precio FROM {_historico(conn, 'venta_lineas')}
+        WHERE venta_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps([s['id'] for s in sales]),)).fetchall()
+
+    # Reconstruir la lista de items para el frontend
+    por_venta = {}
+    for l in sorted(lineas, key=lambda l: l['id']):
+        d = dict(l)
+        del d['id']
+        por_venta.setdefault(d.pop('venta_id'), []).append(d)
+
     res = []
     for s in sales:
         d = dict(s)
-        try: d['items'] = json.loads(d['items'])
-        except: d['items'] = []
+        blob = d.pop('items')
+        d['items'] = por_venta.get(d['id'], [])
+        if blob and not d['items']:
+            # Ticket aún no migrado a venta_lineas
+            try: d['items'] = _parse_items_blob(blob)
+            except Exception: d['items'] = []
         res.append(d)
     return res
 
+def get_product_sales(codigo, desde=None, hasta=None):
+    """Unidades e importe vendidos de un producto, total y por día local (fechas 'YYYY-MM-DD').
+
+    Mismos días que resumen_diario y get_report: desde/hasta son días locales
+    inclusivos y las fechas guardadas están en UTC.
+    """
+    inicio, fin = _limites_utc(desde, hasta)
+    where = 'codigo = ?'
+    params = [codigo]
+    if inicio:
+        where += ' AND fecha >= ?'
+        params.append(inicio)
+    if fin:
+        where += ' AND fecha < ?'
+        params.append(fin)
+
+    conn = get_db_connection()
+    try:
+        dias = conn.execute(f'''
+            SELECT date(fecha, 'localtime') as dia, SUM(cantidad) as cantidad, SUM(cantidad * precio) as importe
+            FROM {_historico(conn, 'venta_lineas')} WHERE {where}
+            GROUP BY dia ORDER BY dia ASC
+        ''', params).fetchall()
+    finally:
+        conn.close()
+
+    dias = [dict(d) for d in dias]
+    return {
+        "codigo": codigo,
+        "cantidad": sum(d['cantidad'] for d in dias),
+        "importe": sum(d['importe'] for d in dias),
+        "dias": dias
+    }
+
 # --- GASTOS ---
 
 def add_expense(concepto, monto, categoria="General"):
-    conn = get_db_connection()
+    def escribir(conn, despues):
+        cur = conn.execute('INSERT INTO gastos (concepto, monto, categoria) VALUES (?, ?, ?)',
+                           (concepto, monto, categoria))
+        gasto = conn.execute('SELECT * FROM gastos WHERE id = ?', (cur.lastrowid,)).fetchone()
+        _acumular_resumen(conn, gasto['fecha'], gastos=monto, num_gastos=1)
+        despues.append(_bump_data_version)
+        despues.append(_aviso('gasto', {"accion": "nuevo", "gasto": dict(gasto), "dia": _dia_local(gasto['fecha'])}))
+
     try:
-        with conn:
-            conn.execute('INSERT INTO gastos (concepto, monto, categoria) VALUES (?, ?, ?)',
-                         (concepto, monto, categoria))
+        _escribir(escribir)
         return True
     except:
         return False
+
+def get_expenses(limit=50):
+    return get_expenses_page(limit=limit)[0]
+
+def delete_expense(id):
+    def escribir(conn, despues):
+        despues.append(_bump_data_version)
+        gasto = conn.execute('SELECT fecha, monto FROM gastos WHERE id = ?', (id,)).fetchone()
+        if gasto:
+            conn.execute('DELETE FROM gastos WHERE id = ?', (id,))
+            _acumular_resumen(conn, gasto['fecha'], gastos=-gasto['monto'], num_gastos=-1)
+            despues.append(_aviso('gasto', {"accion": "borrado", "id": id, "monto": gasto['monto'],
+                                            "dia": _dia_local(gasto['fecha'])}))
+
+    _escribir(escribir)
+
+# --- RESUMEN DIARIO / INFORMES ---
+
+def _acumular_resumen(conn, fecha, ventas=0.0, num_ventas=0, gastos=0.0, num_gastos=0):
+    # fecha en UTC (como CURRENT_TIMESTAMP); el resumen se agrupa por día local
+    conn.execute('''
+        INSERT INTO resumen_diario (dia, ventas_total, num_ventas, gastos_total, num_gastos)
+        VALUES (date(?, 'localtime'), ?, ?, ?, ?)
+        ON CONFLICT(dia) DO UPDATE SET
+            ventas_total = ventas_total + excluded.ventas_total,
+            num_ventas = num_ventas + excluded.num_ventas,
+            gastos_total = gastos_total + excluded.gastos_total,
+            num_gastos = num_gastos + excluded.num_gastos
+    ''', (fecha, ventas, num_ventas, gastos, num_gastos))
+
+def _rebuild_resumen(conn, archivados=()):
+    # archivados: filas (dia, ventas, num_ventas, gastos, num_gastos) de los
+    # años archivados, que la conexión del escritor no ve (ver _resumen_archivos)
+    conn.execute('DELETE FROM resumen_diario')
+    conn.execute('''
+        INSERT INTO resumen_diario (dia, ventas_total, num_ventas, gastos_total, num_gastos)
+        SELECT dia, SUM(vt), SUM(nv), SUM(gt), SUM(ng) FROM (
+            SELECT date(fecha, 'localtime') as dia, total as vt, 1 as nv, 0 as gt, 0 as ng FROM ventas
+            UNION ALL
+            SELECT date(fecha, 'localtime'), 0, 0, monto, 1 FROM gastos
+        )
+        GROUP BY dia
+    ''')
+    conn.executemany('''
+        INSERT INTO resumen_diario (dia, ventas_total, num_ventas, gastos_total, num_gastos)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(dia) DO UPDATE SET
+            ventas_total = ventas_total + excluded.ventas_total,
+            num_ventas = num_ventas + excluded.num_ventas,
+            gastos_total = gastos_total + excluded.gastos_total,
+            num_gastos = num_gastos + excluded.num_gastos
+    ''', archivados)
+    return conn.execute('SELECT COUNT(*) FROM resumen_diario').fetchone()[0]
+
+def rebuild_resumen_diario():
+    """Regenera resumen_diario desde ventas y gastos (también los archivados) en una sola transacción."""
+    def escribir(conn, despues):
+        despues.append(_bump_data_version)
+        return _rebuild_resumen(conn, archivados)
+
+    # Sin archivar a la vez: una venta movida entre las dos lecturas no contaría
+    with _mantenimiento_lock:
+        archivados = _resumen_archivos()
+        dias = _escribir(escribir)
+    print(f"Resumen diario regenerado: {dias} días.")
+    return dias
+
+def _rebuild_inventario(conn):
+    conn.execute('''
+        INSERT OR REPLACE INTO inventario_resumen (id, productos, total_items, valor_costo, valor_venta)
+        SELECT 1, COUNT(*), ifnull(SUM(stock), 0), ifnull(SUM(stock * costo), 0), ifnull(SUM(stock * venta), 0)
+        FROM productos
+    ''')
+
+def rebuild_inventario():
+    """Recalcula inventario_resumen desde productos (los triggers lo mantienen al día)."""
+    def escribir(conn, despues):
+        despues.append(_bump_data_version)
+        _rebuild_inventario(conn)
+
+    _escribir(escribir)
+    print("Resumen de inventario regenerado.")
+
+# Expresión SQL que agrupa un día 'YYYY-MM-DD' en cada periodo
+_AGRUPACIONES = {
+    'dia': "dia",
+    'semana': "strftime('%Y-S%W', dia)",
+    'mes': "substr(dia, 1, 7)",
+    'trimestre': "substr(dia, 1, 4) || '-T' || ((CAST(substr(dia, 6, 2) AS INTEGER) + 2) / 3)",
+    'año': "substr(dia, 1, 4)",
+}
+
+def rango_periodo(periodo, referencia=None):
+    """Devuelve (desde, hasta) inclusivos del periodo que contiene la fecha de referencia."""
+    ref = datetime.date.fromisoformat(referencia) if referencia else datetime.date.today()
+    if periodo == 'dia':
+        return ref.isoformat(), ref.isoformat()
+    if periodo == 'semana':
+        inicio = ref - datetime.timedelta(days=ref.weekday())
+        return inicio.isoformat(), (inicio + datetime.timedelta(days=6)).isoformat()
+    if periodo == 'mes':
+        inicio = ref.replace(day=1)
+    elif periodo == 'trimestre':
+        inicio = ref.replace(month=3 * ((ref.month - 1) // 3) + 1, day=1)
+    elif periodo == 'año':
+        inicio = ref.replace(month=1, day=1)
+    else:
+        raise ValueError(f"Periodo desconocido: {periodo}")
+    meses = {'mes': 1, 'trimestre': 3, 'año': 12}[periodo]
+    y, m = divmod(inicio.month - 1 + meses, 12)
+    fin = inicio.replace(year=inicio.year + y, month=m + 1) - datetime.timedelta(days=1)
+    return inicio.isoformat(), fin.isoformat()
+
+def get_report(desde, hasta, agrupar='dia'):
+    """Cuenta de resultados entre dos días locales (inclusive), solo desde resumen_diario."""
+    if agrupar not in _AGRUPACIONES:
+        raise ValueError(f"Agrupación desconocida: {agrupar}")
+    clave = _AGRUPACIONES[agrupar]
+
+    conn = get_db_connection()
+    try:
+        filas = conn.execute(f'''
+            SELECT {clave} as periodo,
+                SUM(ventas_total) as ventas, SUM(num_ventas) as num_ventas,
+                SUM(gastos_total) as gastos, SUM(num_gastos) as num_gastos
+            FROM resumen_diario
+            WHERE dia BETWEEN ? AND ?
+            GROUP BY periodo ORDER BY periodo ASC
+        ''', (desde, hasta)).fetchall()
     finally:
         conn.close()
 
-def get_expenses(limit=50):
+    serie = []
+    for f in filas:
+        d = dict(f)
+        d['beneficio'] = d['ventas'] - d['gastos']
+        serie.append(d)
+    ventas = sum(d['ventas'] for d in serie)
+    gastos = sum(d['gastos'] for d in serie)
+    return {
+        "desde": desde,
+        "hasta": hasta,
+        "agrupar": agrupar,
+        "ventas": ventas,
+        "gastos": gastos,
+        "beneficio": ventas - gastos,
+        "num_ventas": sum(d['num_ventas'] for d in serie),
+        "num_gastos": sum(d['num_gastos'] for d in serie),
+        "serie": serie
+    }
+
+# --- ARCHIVO POR AÑOS, VACUUM Y COPIAS DE SEGURIDAD ---
+# Los años cerrados de ventas (con sus líneas) y gastos se mueven a un fichero
+# por año junto a la BD (tpv_archivo_2023.db...). tpv.db se queda con los años
+# recientes: pequeño y en caché. Las conexiones del pool adjuntan los archivos
+# con ATTACH y crean vistas TEMP historico_ventas/_venta_lineas/_gastos (main
+# UNION ALL cada año); historial, exportación, ventas por producto y "más
+# vendidos" leen de ellas, así que los años archivados siguen apareciendo.
+# resumen_diario no se archiva: informes y dashboard no cambian.
+#
+# Mover un lote: se copia al archivo (commit en el archivo) y después se borra
+# de tpv.db por el escritor. Si el proceso se corta entre los dos pasos las
+# filas quedan repetidas hasta la siguiente ejecución, que vuelve a copiarlas
+# (INSERT OR REPLACE) y termina de borrarlas.
+
+ARCHIVO_AÑOS_CALIENTES = int(os.environ.get('TPV_ARCHIVE_KEEP_YEARS', 1))  # años cerrados que siguen en tpv.db además del actual
+ARCHIVO_LOTE = int(os.environ.get('TPV_ARCHIVE_BATCH', 2000))             # ventas o gastos por transacción al mover
+ARCHIVO_CACHE_KB = int(os.environ.get('TPV_ARCHIVE_CACHE_KB', 2048))      # caché por archivo adjunto: no desplaza a tpv.db
+ARCHIVO_MAX_ADJUNTOS = 10  # SQLITE_MAX_ATTACHED por defecto
+VACUUM_PASO = int(os.environ.get('TPV_VACUUM_PAGES', 1000))               # páginas liberadas por transacción
+BACKUP_DIR = os.environ.get('TPV_BACKUP_DIR') or os.path.join(BASE_DIR, 'copias')
+BACKUP_PASO = int(os.environ.get('TPV_BACKUP_PAGES', 256))                # páginas copiadas por paso
+BACKUP_PAUSA_MS = float(os.environ.get('TPV_BACKUP_PAUSE_MS', 5))         # pausa entre pasos
+BACKUP_CONSERVAR = int(os.environ.get('TPV_BACKUP_KEEP', 14))             # copias de tpv.db que se guardan
+
+# Columnas en el orden de las tablas de tpv.db
+_TABLAS_ARCHIVO = {
+    'ventas': 'id, fecha, total, items',
+    'venta_lineas': 'id, venta_id, producto_id, codigo, nombre, cantidad, precio, fecha',
+    'gastos': 'id, fecha, concepto, monto, categoria',
+}
+
+_archivos = ()         # ((año, ruta), ...) de DB_NAME, del más antiguo al más reciente
+_archivos_db = None
+_archivos_gen = 0      # sube cuando cambia la lista; las conexiones comparan con la suya
+_archivos_lock = threading.Lock()
+_mantenimiento_lock = threading.Lock()  # archivar y regenerar el resumen, de uno en uno
+
+def _ruta_archivo(año):
+    return f'{os.path.splitext(DB_NAME)[0]}_archivo_{año}.db'
+
+def _buscar_archivos():
+    global _archivos, _archivos_db, _archivos_gen
+    base = os.path.splitext(DB_NAME)[0]
+    carpeta = os.path.dirname(base) or '.'
+    patron = re.compile(re.escape(os.path.basename(base)) + r'_archivo_(\d{4})\.db$')
+    encontrados = []
+    for nombre in os.listdir(carpeta):
+        m = patron.match(nombre)
+        if m:
+            encontrados.append((int(m.group(1)), os.path.join(carpeta, nombre)))
+    encontrados = tuple(sorted(encontrados))
+    with _archivos_lock:
+        if _archivos_db == DB_NAME and encontrados == _archivos:
+            return _archivos
+        _archivos = encontrados
+        _archivos_db = DB_NAME
+        _archivos_gen += 1
+        if len(_archivos) > ARCHIVO_MAX_ADJUNTOS:
+            print(f"Hay {len(_archivos)} años archivados y SQLite adjunta {ARCHIVO_MAX_ADJUNTOS}: "
+                  f"el historial no incluirá los más antiguos")
+        return _archivos
+
+# "python database.py archivar" en otro proceso: sus borrados suben la versión
+# de datos y aquí se vuelven a buscar los ficheros antes de usar las vistas
+_al_cambiar_fuera.append(lambda: _buscar_archivos())
+
+def get_archivos():
+    """Años archivados de la BD actual: ((año, ruta), ...)."""
+    if _archivos_db != DB_NAME:
+        return _buscar_archivos()
+    return _archivos
+
+def _preparar_archivos(conn):
+    """Adjunta a conn los archivos que le falten y rehace sus vistas historico_*."""
+    gen = _archivos_gen  # antes que la lista: si cambia mientras, se repite en el siguiente uso
+    archivos = get_archivos()[-ARCHIVO_MAX_ADJUNTOS:]
+    adjuntos = {r['name'] for r in conn.execute('PRAGMA database_list')}
+    esquemas = []
+    for año, ruta in archivos:
+        esquema = f'archivo_{año}'
+        if esquema not in adjuntos:
+            conn.execute(f'ATTACH DATABASE ? AS {esquema}', (ruta,))
+            conn.execute(f'PRAGMA {esquema}.cache_size=-{ARCHIVO_CACHE_KB}')
+        esquemas.append(esquema)
+    for tabla, columnas in _TABLAS_ARCHIVO.items():
+        conn.execute(f'DROP VIEW IF EXISTS temp.historico_{tabla}')
+        if esquemas:
+            conn.execute(f'CREATE TEMP VIEW historico_{tabla} AS ' + ' UNION ALL '.join(
+                f'SELECT {columnas} FROM {e}.{tabla}' for e in ['main'] + esquemas))
+    conn.archivos = tuple(esquemas)
+    conn.archivos_gen = gen
+
+def _historico(conn, tabla):
+    # Sin años archivados se lee la tabla directamente, sin vista
+    return f'historico_{tabla}' if conn.archivos else tabla
+
+def _crear_esquema_archivo(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ventas (
+            id INTEGER PRIMARY KEY,
+            fecha TIMESTAMP NOT NULL,
+            total REAL NOT NULL,
+            items TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS venta_lineas (
+            id INTEGER PRIMARY KEY,
+            venta_id INTEGER NOT NULL,
+            producto_id INTEGER,
+            codigo TEXT NOT NULL,
+            nombre TEXT,
+            cantidad INTEGER NOT NULL,
+            precio REAL NOT NULL,
+            fecha TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS gastos (
+            id INTEGER PRIMARY KEY,
+            fecha TIMESTAMP NOT NULL,
+            concepto TEXT NOT NULL,
+            monto REAL NOT NULL,
+            categoria TEXT
+        )
+    ''')
+    # Los mismos índices que usan las consultas de historial en tpv.db
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ventas_fecha ON ventas(fecha, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_gastos_fecha ON gastos(fecha, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_venta ON venta_lineas(venta_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_producto ON venta_lineas(codigo, fecha, cantidad, precio)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_venta_lineas_fecha ON venta_lineas(fecha)')
+    conn.commit()
+
+def _resumen_archivos():
+    """Totales por día local de los años archivados, para _rebuild_resumen."""
     conn = get_db_connection()
-    gastos = conn.execute('SELECT * FROM gastos ORDER BY fecha DESC LIMIT ?', (limit,)).fetchall()
-    conn.close()
-    return [dict(g) for g in gastos]
+    try:
+        if not conn.archivos:
+            return []
+        partes = []
+        for e in conn.archivos:
+            partes.append(f"SELECT date(fecha, 'localtime') as dia, total as vt, 1 as nv, 0 as gt, 0 as ng FROM {e}.ventas")
+            partes.append(f"SELECT date(fecha, 'localtime'), 0, 0, monto, 1 FROM {e}.gastos")
+        return [tuple(r) for r in conn.execute(
+            f"SELECT dia, SUM(vt), SUM(nv), SUM(gt), SUM(ng) FROM ({' UNION ALL '.join(partes)}) GROUP BY dia")]
+    finally:
+        conn.close()
 
-def delete_expense(id):
+def _mover_lote(destino, tabla, inicio, fin, lote):
+    """Copia a destino el siguiente lote del periodo y lo borra de tpv.db; devuelve las filas movidas."""
     conn = get_db_connection()
-    with conn:
-        conn.execute('DELETE FROM gastos WHERE id = ?', (id,))
-    conn.close()
+    try:
+        filas = conn.execute(f'''
+            SELECT {_TABLAS_ARCHIVO[tabla]} FROM main.{tabla}
+            WHERE fecha >= ? AND fecha < ? ORDER BY fecha, id LIMIT ?
+        ''', (inicio, fin, lote)).fetchall()
+        ids = json.dumps([f['id'] for f in filas])
+        lineas = conn.execute(f'''
+            SELECT {_TABLAS_ARCHIVO['venta_lineas']} FROM main.venta_lineas
+            WHERE venta_id IN (SELECT value FROM json_each(?))
+        ''', (ids,)).fetchall() if tabla == 'ventas' else []
+    finally:
+        conn.close()
+    if not filas:
+        return 0
+
+    def insertar(t, rows):
+        if rows:
+            marcas = ', '.join('?' * len(rows[0]))
+            destino.executemany(f'INSERT OR REPLACE INTO {t} ({_TABLAS_ARCHIVO[t]}) VALUES ({marcas})',
+                                [tuple(r) for r in rows])
+
+    destino.execute('BEGIN IMMEDIATE')
+    try:
+        insertar(tabla, filas)
+        insertar('venta_lineas', lineas)
+        destino.commit()
+    except Exception:
+        destino.rollback()
+        raise
+
+    def borrar(conn, despues):
+        # Solo las que siguen en tpv.db (p. ej. un gasto borrado mientras tanto)
+        quedan = [r[0] for r in conn.execute(
+            f'SELECT id FROM {tabla} WHERE id IN (SELECT value FROM json_each(?))', (ids,))]
+        if tabla == 'ventas':
+            conn.execute('DELETE FROM venta_lineas WHERE venta_id IN (SELECT value FROM json_each(?))', (ids,))
+        conn.execute(f'DELETE FROM {tabla} WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+        despues.append(_bump_data_version)
+        return quedan
+
+    quedan = _escribir(borrar)
+    sobran = json.dumps(sorted({f['id'] for f in filas} - set(quedan)))
+    if sobran != '[]':
+        if tabla == 'ventas':
+            destino.execute('DELETE FROM venta_lineas WHERE venta_id IN (SELECT value FROM json_each(?))', (sobran,))
+        destino.execute(f'DELETE FROM {tabla} WHERE id IN (SELECT value FROM json_each(?))', (sobran,))
+        destino.commit()
+    return len(quedan)
+
+def _años_en_principal(hasta_año):
+    conn = get_db_connection()
+    try:
+        primeras = [conn.execute(f'SELECT MIN(fecha) FROM main.{t}').fetchone()[0] for t in ('ventas', 'gastos')]
+    finally:
+        conn.close()
+    primeras = [f for f in primeras if f]
+    if not primeras:
+        return []
+    return list(range(int(_dia_local(min(primeras))[:4]), hasta_año + 1))
+
+def archivar(hasta_año=None, lote=ARCHIVO_LOTE):
+    """Mueve ventas (con sus líneas) y gastos de los años cerrados a su archivo.
+
+    Por defecto se archiva hasta el año actual menos 1 + ARCHIVO_AÑOS_CALIENTES.
+    La caja sigue cobrando: cada lote es una transacción corta del escritor.
+    Al terminar se devuelve el espacio libre con vacuum_incremental.
+    """
+    actual = datetime.date.today().year
+    if hasta_año is None:
+        hasta_año = actual - 1 - ARCHIVO_AÑOS_CALIENTES
+    if hasta_año >= actual:
+        raise ValueError('Solo se pueden archivar años cerrados')
+
+    resultado = {"success": True, "años": []}
+    with _mantenimiento_lock:
+        for año in _años_en_principal(hasta_año):
+            inicio, fin = _limites_utc(f'{año}-01-01', f'{año}-12-31')
+            conn = get_db_connection()
+            try:
+                hay = any(conn.execute(f'SELECT 1 FROM main.{t} WHERE fecha >= ? AND fecha < ? LIMIT 1',
+                                       (inicio, fin)).fetchone() for t in ('ventas', 'gastos'))
+            finally:
+                conn.close()
+            if not hay:
+                continue
+
+            ruta = _ruta_archivo(año)
+            nuevo = not os.path.exists(ruta)
+            destino = _abrir_conexion(ruta)
+            try:
+                _crear_esquema_archivo(destino)
+                if nuevo:
+                    # Adjuntarlo antes de borrar nada de tpv.db
+                    _buscar_archivos()
+                movidas = {}
+                for tabla in ('ventas', 'gastos'):
+                    movidas[tabla] = 0
+                    while True:
+                        n = _mover_lote(destino, tabla, inicio, fin, lote)
+                        if not n:
+                            break
+                        movidas[tabla] += n
+                destino.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                destino.close()
+            print(f"Archivado {año}: {movidas['ventas']} ventas y {movidas['gastos']} gastos en {ruta}")
+            resultado["años"].append({"año": año, "ruta": ruta, **movidas})
+
+    if resultado["años"]:
+        resultado["vacuum"] = vacuum_incremental()
+    return resultado
+
+def vacuum_incremental(paso=VACUUM_PASO):
+    """Devuelve al sistema las páginas libres de tpv.db, paso páginas por transacción."""
+    conn = get_db_connection()
+    try:
+        modo = conn.execute('PRAGMA main.auto_vacuum').fetchone()[0]
+        page_size = conn.execute('PRAGMA main.page_size').fetchone()[0]
+    finally:
+        conn.close()
+    if modo != 2:
+        return {"success": False,
+                "error": "La base de datos no tiene auto_vacuum incremental: "
+                         "ejecuta 'python database.py vacuum --completo' con el TPV cerrado"}
+
+    def escribir(conn, despues):
+        libres = conn.execute('PRAGMA main.freelist_count').fetchone()[0]
+        # El módulo sqlite3 hace un solo paso de la sentencia y cada paso
+        # libera una página: incremental_vacuum(N) liberaría solo una
+        for _ in range(min(paso, libres)):
+            conn.execute('PRAGMA main.incremental_vacuum(1)')
+        return libres - conn.execute('PRAGMA main.freelist_count').fetchone()[0]
+
+    liberadas = 0
+    while True:
+        n = _escribir(escribir)
+        liberadas += n
+        if n < paso:
+            break
+    return {"success": True, "paginas_liberadas": liberadas, "bytes_liberados": liberadas * page_size}
+
+def vacuum_completo():
+    """VACUUM de tpv.db; además activa auto_vacuum incremental en BD creadas sin él.
+
+    Reescribe el fichero entero y bloquea las escrituras mientras dura: solo
+    con el TPV cerrado (python database.py vacuum --completo).
+    """
+    conn = _abrir_conexion(DB_NAME)
+    try:
+        conn.isolation_level = None
+        antes = os.path.getsize(DB_NAME)
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return {"success": True, "bytes_antes": antes, "bytes_despues": os.path.getsize(DB_NAME)}
+
+def _copiar(ruta, destino, paso, pausa_ms, progreso=None):
+    """Copia ruta en destino con la API de backup, paso páginas cada vez."""
+    origen = _abrir_conexion(ruta)
+    temporal = destino + '.tmp'
+    try:
+        # La copia sale de una única instantánea (transacción de lectura): con
+        # WAL no bloquea a nadie y las ventas que entren mientras no la obligan
+        # a empezar de nuevo, como pasaría entre pasos sin transacción abierta
+        origen.execute('BEGIN')
+        origen.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        copia = sqlite3.connect(temporal)
+        try:
+            def avance(_estado, restantes, total):
+                if progreso:
+                    progreso(total - restantes, total)
+                time.sleep(pausa_ms / 1000)
+            origen.backup(copia, pages=paso, progress=avance)
+            ok = copia.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            copia.close()
+        origen.rollback()
+    finally:
+        origen.close()
+    if ok != 'ok':
+        os.remove(temporal)
+        raise sqlite3.DatabaseError(f'La copia de {ruta} no pasa quick_check: {ok}')
+    os.replace(temporal, destino)
+    return os.path.getsize(destino)
+
+def copia_seguridad(carpeta=None, paso=BACKUP_PASO, pausa_ms=BACKUP_PAUSA_MS, conservar=BACKUP_CONSERVAR,
+                    progreso=None):
+    """Copia en caliente de tpv.db (y de los archivos por año que hayan cambiado).
+
+    La copia va por pasos de paso páginas con una pausa entre ellos: la caja
+    sigue cobrando mientras dura. Se guardan las conservar copias más
+    recientes de tpv.db; de cada archivo por año, la última.
+    """
+    carpeta = carpeta or BACKUP_DIR
+    os.makedirs(os.path.join(carpeta, 'archivos'), exist_ok=True)
+    nombre = os.path.splitext(os.path.basename(DB_NAME))[0]
+    destino = os.path.join(carpeta, f"{nombre}_{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    t = time.perf_counter()
+    try:
+        resultado = {"success": True, "destino": destino,
+                     "bytes": _copiar(DB_NAME, destino, paso, pausa_ms, progreso), "archivos": []}
+        # Los archivos solo cambian al archivar: se copian si son más nuevos que su copia.
+        # La lista se vuelve a leer del disco por si se archivó desde otro proceso
+        for año, ruta in _buscar_archivos():
+            copia = os.path.join(carpeta, 'archivos', os.path.basename(ruta))
+            if not os.path.exists(copia) or os.path.getmtime(ruta) > os.path.getmtime(copia):
+                _copiar(ruta, copia, paso, pausa_ms)
+                resultado["archivos"].append(copia)
+    except (sqlite3.Error, OSError) as e:
+        return {"success": False, "error": str(e)}
+
+    copias = sorted(f for f in os.listdir(carpeta) if re.fullmatch(re.escape(nombre) + r'_\d{8}-\d{6}\.db', f))
+    for viejo in copias[:-conservar] if conservar else []:
+        os.remove(os.path.join(carpeta, viejo))
+    resultado["segundos"] = round(time.perf_counter() - t, 2)
+    return resultado
+
+def get_storage_stats():
+    """Tamaño de tpv.db, páginas libres y años archivados."""
+    conn = get_db_connection()
+    try:
+        pragmas = {p: conn.execute(f'PRAGMA main.{p}').fetchone()[0]
+                   for p in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')}
+    finally:
+        conn.close()
+
+    def tamaño(ruta):
+        return sum(os.path.getsize(r) for r in (ruta, ruta + '-wal') if os.path.exists(r))
+
+    return {
+        "principal": {"ruta": DB_NAME, "bytes": tamaño(DB_NAME),
+                      "paginas": pragmas['page_count'], "paginas_libres": pragmas['freelist_count'],
+                      "auto_vacuum": {0: 'none', 1: 'full', 2: 'incremental'}.get(pragmas['auto_vacuum'])},
+        "archivos": [{"año": año, "ruta": ruta, "bytes": tamaño(ruta)} for año, ruta in get_archivos()],
+        "archivar_hasta": datetime.date.today().year - 1 - ARCHIVO_AÑOS_CALIENTES,
+        "copias": BACKUP_DIR,
+    }
 
 # --- ESTADISTICAS / DASHBOARD ---
 
+_dashboard_cache = None  # (clave, stats)
+_dashboard_cache_lock = threading.Lock()
+
 def get_dashboard_stats():
+    """Estadísticas del dashboard, cacheadas hasta la siguiente escritura."""
+    global _dashboard_cache
+    # La clave se toma ANTES de calcular: si hay una escritura a mitad, la
+    # siguiente llamada verá otra clave y recalculará.
+    clave = get_data_etag()
+    with _dashboard_cache_lock:
+        if _dashboard_cache and _dashboard_cache[0] == clave:
+            return _dashboard_cache[1]
+    stats = _calcular_dashboard_stats()
+    with _dashboard_cache_lock:
+        _dashboard_cache = (clave, stats)
+    return stats
+
+def _calcular_dashboard_stats():
     conn = get_db_connection()
     
-    # 1. Ventas de HOY
-    ventas_hoy = conn.execute('''
-        SELECT SUM(total) as total FROM ventas 
-        WHERE date(fecha) = date('now', 'localtime')
-    ''').fetchone()['total'] or 0.0
-
-    # 2. Gastos de HOY
-    gastos_hoy = conn.execute('''
-        SELECT SUM(monto) as total FROM gastos 
-        WHERE date(fecha) = date('now', 'localtime')
-    ''').fetchone()['total'] or 0.0
+    try:
+        # 1-2. Ventas y gastos de HOY (resumen diario)
+        hoy = conn.execute('''
+            SELECT ventas_total, gastos_total FROM resumen_diario
+            WHERE dia = date('now', 'localtime')
+        ''').fetchone()
+        ventas_hoy = hoy['ventas_total'] if hoy else 0.0
+        gastos_hoy = hoy['gastos_total'] if hoy else 0.0
     
-    # 3. Productos con stock BAJO (< 5)
-    low_stock = conn.execute('SELECT * FROM productos WHERE stock <= 5 ORDER BY stock ASC LIMIT 5').fetchall()
-
-    # 4. Historial de ventas últimos 7 días para gráfico
-    ventas_7_dias = conn.execute('''
-        SELECT date(fecha) as dia, SUM(total) as total 
-        FROM ventas 
-        WHERE fecha >= date('now', '-7 days')
-        GROUP BY dia
-        ORDER BY dia ASC
-    ''').fetchall()
-
-    # 5. Valor del inventario
-    stats_inv = conn.execute('''
-        SELECT 
-            SUM(stock) as total_items, 
-            SUM(stock * costo) as valor_costo,
-            SUM(stock * venta) as valor_venta
-        FROM productos
-    ''').fetchone()
+        # 3. Productos en o por debajo de su stock mínimo (índice parcial idx_productos_stock_bajo)
+        low_stock = conn.execute('SELECT * FROM productos WHERE stock <= stock_minimo ORDER BY stock ASC LIMIT 5').fetchall()
 
-    # 6. Top 5 productos más vendidos
-    top_ventas = conn.execute('''
-        WITH split_items AS (
-            SELECT value as item_json 
-            FROM ventas, json_each(items)
-        )
-        SELECT 
-            json_extract(item_json, '$.nombre') as nombre,
-            SUM(json_extract(item_json, '$.cantidad')) as cantidad
-        FROM split_items
-        GROUP BY nombre
-        ORDER BY cantidad DESC
-        LIMIT 5
-    ''').fetchall()
-    
-    conn.close()
+        # 4. Historial de ventas últimos 7 días para gráfico
+        ventas_7_dias = conn.execute('''
+            SELECT dia, ventas_total as total 
+            FROM resumen_diario 
+            WHERE dia >= date('now', 'localtime', '-7 days') AND num_ventas > 0
+            ORDER BY dia ASC
+        ''').fetchall()
+
+        # 5. Valor del inventario (fila mantenida por triggers, sin recorrer productos)
+        stats_inv = conn.execute('''
+            SELECT total_items, round(valor_costo, 2) as valor_costo, round(valor_venta, 2) as valor_venta
+            FROM inventario_resumen WHERE id = 1
+        ''').fetchone()
+
+        # 6. Top 5 productos más vendidos
+        top_ventas = conn.execute(f'''
+            SELECT 
+                COALESCE(p.nombre, (SELECT nombre FROM venta_lineas WHERE codigo = t.codigo LIMIT 1)) as nombre,
+                t.codigo,
+                t.cantidad
+            FROM (
+                SELECT codigo, SUM(cantidad) as cantidad
+                FROM {_historico(conn, 'venta_lineas')}
+                GROUP BY codigo
+                ORDER BY cantidad DESC
+                LIMIT 5
+            ) t
+            LEFT JOIN productos p ON p.codigo = t.codigo
+            ORDER BY t.cantidad DESC
+        ''').fetchall()
+    finally:
+        conn.close()
     
     return {
         "ventas_hoy": ventas_hoy,
@@ -258,3 +2645,36 @@ def get_dashboard_stats():
         "inventory": dict(stats_inv) if stats_inv else {"total_items": 0, "valor_costo": 0, "valor_venta": 0},
         "top_selling": [dict(t) for t in top_ventas]
     }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mantenimiento de la base de datos del TPV')
+    sub = parser.add_subparsers(dest='comando', required=True)
+    sub.add_parser('migrate', help='Crear/actualizar el esquema (PRAGMA user_version)')
+    sub.add_parser('rebuild-resumen', help='Regenerar resumen_diario e inventario_resumen')
+    p_archivar = sub.add_parser('archivar', help='Mover los años cerrados de ventas y gastos a su archivo')
+    p_archivar.add_argument('--hasta-año', type=int, help='último año que se archiva')
+    p_vacuum = sub.add_parser('vacuum', help='Devolver al disco el espacio libre de la base de datos')
+    p_vacuum.add_argument('--completo', action='store_true',
+                          help='VACUUM completo (activa el modo incremental); solo con el TPV cerrado')
+    p_copia = sub.add_parser('copia', help='Copia de seguridad en caliente')
+    p_copia.add_argument('--carpeta', help=f'carpeta destino (por defecto {BACKUP_DIR})')
+    args = parser.parse_args()
+
+    if args.comando == 'vacuum' and args.completo:
+        # Sin init_db: ninguna otra conexión abierta mientras se reescribe el fichero
+        print(vacuum_completo())
+        sys.exit()
+
+    init_db()
+    if args.comando == 'rebuild-resumen':
+        rebuild_resumen_diario()
+        rebuild_inventario()
+    elif args.comando == 'archivar':
+        print(archivar(args.hasta_año))
+    elif args.comando == 'vacuum':
+        print(vacuum_incremental())
+    elif args.comando == 'copia':
+        print(copia_seguridad(args.carpeta))
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Canal de eventos de cambios (ventas, stock, productos, gastos) para /api/events.
+# database.py publica un delta tras cada escritura; cada terminal conectado por
+# SSE lo recibe y actualiza sus vistas sin volver a pedir las listas enteras.
+# Se guardan los últimos eventos para que un terminal que se reconecta con
+# Last-Event-ID recupere lo que se perdió.
+
+CAPACIDAD = int(os.environ.get('TPV_EVENTS_BUFFER', 1000))
+MAX_CLIENTES = int(os.environ.get('TPV_EVENTS_MAX_CLIENTS', 8))       # cada cliente ocupa un hilo del servidor
+DURACION_MAX = int(os.environ.get('TPV_EVENTS_MAX_SECONDS', 300))     # luego el navegador se reconecta solo
+# Seguimiento de albaranes (/api/jobs|lotes/<id>/events y long polling): también
+# ocupan un hilo cada uno. Con los valores por defecto 8 + 4 de los 16 hilos del
+# servidor, así que siempre quedan hilos para cobrar.
+MAX_ESPERAS_TRABAJOS = int(os.environ.get('TPV_JOB_STREAMS_MAX', 4))
+ARRANQUE = f'{int(time.time()):x}'  # prefijo de los ids: tras reiniciar, los ids viejos no valen
+
+
+class Cupo:
+    """Respuestas largas abiertas a la vez como máximo (cada una ocupa un hilo)."""
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.en_uso = 0
+        self._lock = threading.Lock()
+
+    def tomar(self):
+        with self._lock:
+            if self.en_uso >= self.maximo:
+                return False
+            self.en_uso += 1
+            return True
+
+    def soltar(self):
+        with self._lock:
+            self.en_uso -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"en_uso": self.en_uso, "maximo": self.maximo}
+
+
+class CanalEventos:
+    def __init__(self, capacidad=CAPACIDAD, max_clientes=MAX_CLIENTES):
+        self._eventos = deque(maxlen=capacidad)  # (id, tipo, datos)
+        self._ultimo_id = 0
+        self._cond = threading.Condition()
+        self.max_clientes = max_clientes
+        self.clientes = 0
+
+    def publicar(self, tipo, datos):
+        with self._cond:
+            self._ultimo_id += 1
+            self._eventos.append((self._ultimo_id, tipo, datos))
+            self._cond.notify_all()
+
+    @property
+    def ultimo_id(self):
+        return self._ultimo_id
+
+    def desde(self, ultimo_id):
+        """Eventos posteriores a ultimo_id, o None si ya no están en el buffer."""
+        with self._cond:
+            return self._desde(ultimo_id)
+
+    def _desde(self, ultimo_id):
+        if ultimo_id >= self._ultimo_id:
+            return []
+        if not self._eventos or self._eventos[0][0] > ultimo_id + 1:
+            return None
+        return [e for e in self._eventos if e[0] > ultimo_id]
+
+    def esperar(self, ultimo_id, timeout=15):
+        """Bloquea hasta que haya eventos nuevos o pase el timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._ultimo_id > ultimo_id, timeout)
+            return self._desde(ultimo_id)
+
+    def conectar(self):
+        with self._cond:
+            if self.clientes >= self.max_clientes:
+                return False
+            self.clientes += 1
+            return True
+
+    def desconectar(self):
+        with self._cond:
+            self.clientes -= 1
+
+    def id_evento(self, n):
+        return f'{ARRANQUE}-{n}'
+
+    def parse_id(self, texto):
+        """Last-Event-ID -> número, o None si es de otro arranque o no es válido."""
+        arranque, _, n = (texto or '').partition('-')
+        if arranque != ARRANQUE or not n.isdigit():
+            return None
+        return int(n)
+
+    def stats(self):
+        with self._cond:
+            return {"ultimo_id": self._ultimo_id, "en_buffer": len(self._eventos),
+                    "clientes": self.clientes, "max_clientes": self.max_clientes}
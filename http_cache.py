@@ -0,0 +1,181 @@
+import datetime
+import gzip
+import hashlib
+import os
+import threading
+
+from flask import request, g, url_for
+
+import database
+
+# Compresión de respuestas y cabeceras de caché HTTP.
+# - Lecturas de la API: ETag débil y Last-Modified a partir de la versión de
+#   datos de database.py; si el cliente ya tiene la última versión se responde
+#   304 antes de ejecutar la vista (sin tocar SQLite).
+# - Estáticos: URL con la huella del contenido (?v=...) servida como immutable.
+# - gzip (o brotli si está instalado) para respuestas de texto a partir de
+#   COMPRESS_MIN_BYTES; el móvil va por Wi-Fi y el catálogo en JSON pesa.
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+COMPRESS_MIN_BYTES = int(os.environ.get('TPV_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # calidades altas son demasiado lentas para respuestas dinámicas
+COMPRESSIBLE_TYPES = {
+    'application/json', 'text/html', 'text/css', 'text/javascript',
+    'application/javascript', 'text/csv', 'text/plain', 'image/svg+xml',
+}
+STATIC_MAX_AGE = 31536000  # un año: la URL cambia con el contenido
+
+# Vistas de solo lectura cuyo resultado depende únicamente de la BD (y de la fecha)
+LECTURAS_VERSIONADAS = {
+    'get_dashboard', 'get_informe', 'get_historial_ventas', 'get_ventas_producto',
+    'get_gastos', 'get_productos', 'get_producto', 'get_movimientos_stock', 'scan_producto',
+    'get_reposicion',
+}
+
+_huellas = {}     # ruta -> (mtime, huella)
+_comprimidos = {}  # (ruta, mtime, codificación) -> bytes; solo estáticos
+_lock = threading.Lock()
+
+
+def static_url(filename):
+    """URL de un estático con la huella de su contenido (cambia al modificarlo)."""
+    return url_for('static', filename=filename, v=_huella(filename))
+
+
+def _ruta_estatico(filename):
+    from flask import current_app
+    return os.path.join(current_app.static_folder, filename)
+
+
+def _huella(filename):
+    ruta = _ruta_estatico(filename)
+    try:
+        mtime = os.path.getmtime(ruta)
+    except OSError:
+        return None
+    with _lock:
+        guardada = _huellas.get(ruta)
+        if guardada and guardada[0] == mtime:
+            return guardada[1]
+    with open(ruta, 'rb') as f:
+        huella = hashlib.sha1(f.read()).hexdigest()[:12]
+    with _lock:
+        _huellas[ruta] = (mtime, huella)
+    return huella
+
+
+def _antes():
+    if request.method != 'GET' or request.endpoint not in LECTURAS_VERSIONADAS:
+        return None
+    etag = database.get_data_etag()
+    g.etag_datos = etag
+    # If-None-Match manda sobre If-Modified-Since (RFC 9110)
+    if request.if_none_match:
+        no_cambiado = request.if_none_match.contains_weak(etag)
+    else:
+        no_cambiado = (request.if_modified_since is not None
+                       and int(_ultima_modificacion()) <= request.if_modified_since.timestamp())
+    if no_cambiado:
+        from flask import current_app
+        return current_app.response_class(status=304)
+    return None
+
+
+def _ultima_modificacion():
+    # A medianoche cambian los datos "de hoy" aunque nadie haya escrito
+    medianoche = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    return max(database.get_data_version_time(), medianoche)
+
+
+def _cabeceras_cache(resp):
+    etag = g.pop('etag_datos', None)
+    if etag is not None and resp.status_code in (200, 304):
+        resp.set_etag(etag, weak=True)
+        resp.last_modified = _ultima_modificacion()
+        resp.headers['Cache-Control'] = 'no-cache'  # revalidar siempre: el 304 es barato
+    elif request.endpoint == 'static' and resp.status_code in (200, 304):
+        filename = (request.view_args or {}).get('filename')
+        if filename and request.args.get('v') and request.args.get('v') == _huella(filename):
+            resp.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+        else:
+            resp.headers['Cache-Control'] = 'no-cache'
+    elif request.endpoint == 'index':
+        resp.headers['Cache-Control'] = 'no-cache'
+        if resp.status_code == 200:
+            resp.add_etag()
+            resp.make_conditional(request)
+
+
+def _elegir_codificacion():
+    aceptadas = request.accept_encodings
+    if HAS_BROTLI and aceptadas['br']:
+        return 'br'
+    if aceptadas['gzip']:
+        return 'gzip'
+    return None
+
+
+def _comprimir(datos, codificacion):
+    if codificacion == 'br':
+        return brotli.compress(datos, quality=BROTLI_QUALITY)
+    return gzip.compress(datos, compresslevel=GZIP_LEVEL)
+
+
+def _comprimir_respuesta(resp):
+    if (resp.status_code != 200 or (resp.is_streamed and not resp.direct_passthrough)
+            or 'Content-Encoding' in resp.headers or resp.mimetype not in COMPRESSIBLE_TYPES):
+        return
+    resp.vary.add('Accept-Encoding')
+    codificacion = _elegir_codificacion()
+    if codificacion is None:
+        return
+
+    if resp.direct_passthrough:
+        # Estático (send_file): se comprime una vez por versión del fichero
+        filename = (request.view_args or {}).get('filename')
+        if request.endpoint != 'static' or not filename:
+            return
+        ruta = _ruta_estatico(filename)
+        clave = (ruta, os.path.getmtime(ruta), codificacion)
+        with _lock:
+            datos = _comprimidos.get(clave)
+        if datos is None:
+            with open(ruta, 'rb') as f:
+                original = f.read()
+            if len(original) < COMPRESS_MIN_BYTES:
+                return
+            datos = _comprimir(original, codificacion)
+            with _lock:
+                _comprimidos[clave] = datos
+        resp.direct_passthrough = False
+        resp.response.close()
+    else:
+        original = resp.get_data()
+        if len(original) < COMPRESS_MIN_BYTES:
+            return
+        datos = _comprimir(original, codificacion)
+
+    resp.set_data(datos)
+    resp.headers['Content-Encoding'] = codificacion
+    # Un ETag fuerte identifica los bytes sin comprimir; débil sigue valiendo
+    # para If-None-Match (comparación débil) en cualquier codificación
+    etag, debil = resp.get_etag()
+    if etag and not debil:
+        resp.set_etag(etag, weak=True)
+
+
+def _despues(resp):
+    _cabeceras_cache(resp)
+    _comprimir_respuesta(resp)
+    return resp
+
+
+def init_app(app):
+    app.before_request(_antes)
+    app.after_request(_despues)
+    app.jinja_env.globals['static_url'] = static_url
@@ -10,42 +10,42 @@ if not os.path.exists(csv_path):
     exit()
 
 print("--- Iniciando importación masiva ---")
+database.ensure_initialized()
+
+def mostrar_progreso(stats):
+    pct = 100 * stats['bytes'] / stats['total_bytes'] if stats['total_bytes'] else 100
+    print(f"  {stats['filas']} filas leídas ({pct:.0f}%), {stats['rechazadas']} rechazadas")
+
+# 1. Leer el CSV por bloques (generador: memoria acotada aunque tenga cientos de miles de líneas)
+stats = {}
+try:
+    productos = ocr_service.iter_csv_productos(csv_path, stats=stats, progreso=mostrar_progreso)
+except ValueError as e:
+    print(f"Error procesando CSV: {e}")
+    exit()
 
-# 1. Procesar CSV usando la lógica que ya creamos
-resultado = ocr_service.procesar_csv(csv_path)
+# 2. Insertar en Base de Datos a medida que se lee (suma stock si ya existe).
+#    Se confirma por bloques para no bloquear la caja durante la importación.
+res = database.bulk_upsert_products(productos, detalle=False, por_bloques=True)
 
-if not resultado['success']:
-    print(f"Error procesando CSV: {resultado.get('error')}")
+if 'errores' not in res:
+    print(f"ERROR: {res['error']}")
     exit()
 
-productos = resultado['productos']
-print(f"Se encontraron {len(productos)} productos en el albarán.")
-
-# 2. Insertar en Base de Datos
-count_ok = 0
-count_err = 0
-
-for p in productos:
-    # Preparar datos
-    codigo = p['codigo']
-    nombre = p['nombre']
-    costo = p['costo']
-    venta = p['venta']
-    unidades = p.get('unidades', 1)
-    
-    print(f"Procesando: {codigo} | {unidades} uds... ", end='')
-    
-    # Llamar a la función de BD que suma stock si ya existe
-    res = database.add_or_update_product(codigo, nombre, costo, venta, unidades)
-    
-    if res['success']:
-        print(f"OK ({res['action']})")
-        count_ok += 1
-    else:
-        print(f"ERROR: {res['error']}")
-        count_err += 1
+for e in res['errores']:
+    print(f"ERROR línea {e['linea'] + 1} ({e['codigo']}): {e['error']}")
+
+if 'error' in res:
+    # Los bloques anteriores ya están guardados: el resumen cuenta solo esos
+    print(f"ERROR: la importación se detuvo en la línea {res['linea_fallo'] + 1}: {res['error']}")
 
 print("\n--- Resumen ---")
-print(f"Importados/Actualizados: {count_ok}")
-print(f"Errores: {count_err}")
-print("El stock ha sido actualizado en la base de datos.")
+print(f"Filas leídas: {stats['filas']}")
+print(f"Filas rechazadas (sin código o nombre): {stats['rechazadas']}")
+print(f"Creados: {res['creados']}")
+print(f"Actualizados: {res['actualizados']}")
+print(f"Errores: {len(res['errores'])}")
+if 'error' in res:
+    print("Importación incompleta: vuelve a lanzarla desde la línea indicada.")
+else:
+    print("El stock ha sido actualizado en la base de datos.")
@@ -0,0 +1,328 @@
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# Cola de trabajos en segundo plano para el OCR de albaranes.
+# La llamada al modelo puede tardar decenas de segundos: /api/upload encola el
+# trabajo y responde al momento; el frontend sigue el progreso con
+# /api/jobs/<id> (o su stream SSE) y puede cancelarlo.
+
+WORKERS = int(os.environ.get('TPV_OCR_WORKERS', 2))
+MAX_PENDIENTES = int(os.environ.get('TPV_OCR_MAX_PENDING', 50))
+TIMEOUT = float(os.environ.get('TPV_OCR_TIMEOUT', 90))            # segundos por intento
+MAX_INTENTOS = int(os.environ.get('TPV_OCR_MAX_ATTEMPTS', 3))
+BACKOFF_BASE = float(os.environ.get('TPV_OCR_BACKOFF', 2.0))      # segundos; se dobla en cada reintento
+RETENCION = 3600                                                  # segundos que se guardan los terminados
+
+PENDIENTE = 'pendiente'
+PROCESANDO = 'procesando'
+COMPLETADO = 'completado'
+ERROR = 'error'
+CANCELADO = 'cancelado'
+ESTADOS_FINALES = (COMPLETADO, ERROR, CANCELADO)
+
+
+class ColaLlenaError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, fn, descripcion='', on_finish=None):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.descripcion = descripcion
+        self.on_finish = on_finish
+        self.estado = PENDIENTE
+        self.mensaje = 'En cola'
+        self.intentos = 0
+        self.hilo = None            # hilo del intento en curso
+        self.fin_pendiente = False  # on_finish espera a que acabe ese hilo
+        self.resultado = None
+        self.creado = time.time()
+        self.actualizado = self.creado
+        self.version = 0  # sube con cada cambio; lo usa wait() para avisar de novedades
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "descripcion": self.descripcion,
+            "estado": self.estado,
+            "mensaje": self.mensaje,
+            "intentos": self.intentos,
+            "resultado": self.resultado,
+            "creado": self.creado,
+            "actualizado": self.actualizado,
+            "version": self.version,
+        }
+
+
+class JobQueue:
+    """Cola acotada con un número fijo de workers, timeout por intento y
+    reintentos con backoff exponencial.
+
+    fn debe devolver un dict {"success": ...}; si falla con "reintentable"
+    distinto de False se reintenta hasta max_intentos.
+    """
+
+    def __init__(self, workers=WORKERS, max_pendientes=MAX_PENDIENTES, timeout=TIMEOUT,
+                 max_intentos=MAX_INTENTOS, backoff=BACKOFF_BASE):
+        self.num_workers = workers
+        self.max_pendientes = max_pendientes
+        self.timeout = timeout
+        self.max_intentos = max_intentos
+        self.backoff = backoff
+        self._jobs = OrderedDict()
+        self._lotes = OrderedDict()  # lote_id -> [job_id, ...]
+        self._cola = deque()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._completados = 0
+        self._fallidos = 0
+
+    # --- API pública ---
+    def submit(self, fn, descripcion='', on_finish=None):
+        with self._cond:
+            self._reservar(1)
+            job = self._encolar(fn, descripcion, on_finish)
+            return job.to_dict()
+
+    def submit_lote(self, tareas):
+        """Encola varias tareas [(fn, descripcion, on_finish), ...] como un lote.
+
+        Se aceptan todas o ninguna; el lote se sigue con get_lote/wait_lote.
+        """
+        with self._cond:
+            self._reservar(len(tareas))
+            jobs = [self._encolar(fn, descripcion, on_finish) for fn, descripcion, on_finish in tareas]
+            lote_id = uuid.uuid4().hex
+            self._lotes[lote_id] = [j.id for j in jobs]
+            return self._lote_dict(lote_id)
+
+    def get_lote(self, lote_id):
+        with self._cond:
+            return self._lote_dict(lote_id) if lote_id in self._lotes else None
+
+    def cancel_lote(self, lote_id):
+        with self._cond:
+            if lote_id not in self._lotes:
+                return None
+            for job_id in self._lotes[lote_id]:
+                job = self._jobs.get(job_id)
+                if job and job.estado not in ESTADOS_FINALES:
+                    self._finalizar(job, CANCELADO, 'Cancelado por el usuario')
+            return self._lote_dict(lote_id)
+
+    def wait_lote(self, lote_id, version=-1, timeout=15):
+        """Como wait(), pero despierta cuando cambia cualquier trabajo del lote."""
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if lote_id not in self._lotes:
+                    return None
+                lote = self._lote_dict(lote_id)
+                if lote['version'] != version:
+                    return lote
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return lote
+                self._cond.wait(restante)
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def cancel(self, job_id):
+        """Cancela un trabajo. Si ya se está ejecutando, su resultado se descarta."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.estado not in ESTADOS_FINALES:
+                self._finalizar(job, CANCELADO, 'Cancelado por el usuario')
+            return job.to_dict()
+
+    def wait(self, job_id, version=-1, timeout=15):
+        """Bloquea hasta que el trabajo cambie respecto a `version` o pase el timeout."""
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job.version != version:
+                    return job.to_dict() if job else None
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return job.to_dict()
+                self._cond.wait(restante)
+
+    def list(self):
+        with self._cond:
+            return [j.to_dict() for j in reversed(self._jobs.values())]
+
+    def stats(self):
+        with self._cond:
+            por_estado = {}
+            for j in self._jobs.values():
+                por_estado[j.estado] = por_estado.get(j.estado, 0) + 1
+            return {
+                "workers": self.num_workers,
+                "en_cola": len(self._cola),
+                "por_estado": por_estado,
+                "completados": self._completados,
+                "fallidos": self._fallidos,
+            }
+
+    # --- Internos (siempre con self._cond adquirido salvo _worker/_ejecutar) ---
+    def _reservar(self, n):
+        self._purgar()
+        activos = sum(1 for j in self._jobs.values() if j.estado not in ESTADOS_FINALES)
+        if activos + n > self.max_pendientes:
+            raise ColaLlenaError("Demasiados trabajos en cola, inténtalo en unos segundos")
+
+    def _encolar(self, fn, descripcion, on_finish):
+        job = Job(fn, descripcion, on_finish)
+        self._jobs[job.id] = job
+        self._cola.append(job)
+        self._arrancar_workers()
+        self._cond.notify_all()
+        return job
+
+    def _lote_dict(self, lote_id):
+        jobs = [self._jobs[j].to_dict() for j in self._lotes[lote_id] if j in self._jobs]
+        terminados = sum(1 for j in jobs if j['estado'] in ESTADOS_FINALES)
+        return {
+            "id": lote_id,
+            "jobs": jobs,
+            "total": len(jobs),
+            "terminados": terminados,
+            "estado": COMPLETADO if terminados == len(jobs) else PROCESANDO,
+            "version": sum(j['version'] for j in jobs),
+        }
+
+    def _arrancar_workers(self):
+        self._workers = [w for w in self._workers if w.is_alive()]
+        while len(self._workers) < self.num_workers:
+            w = threading.Thread(target=self._worker, name='ocr-worker', daemon=True)
+            w.start()
+            self._workers.append(w)
+
+    def _actualizar(self, job, estado=None, mensaje=None):
+        if estado is not None:
+            job.estado = estado
+        if mensaje is not None:
+            job.mensaje = mensaje
+        job.actualizado = time.time()
+        job.version += 1
+        self._cond.notify_all()
+
+    def _finalizar(self, job, estado, mensaje, resultado=None):
+        self._actualizar(job, estado, mensaje)
+        job.resultado = resultado
+        # fn puede llevar capturados los datos subidos (fotos del móvil): no
+        # se guardan durante la RETENCION del trabajo terminado
+        job.fn = None
+        if estado == COMPLETADO:
+            self._completados += 1
+        elif estado == ERROR:
+            self._fallidos += 1
+        if job in self._cola:
+            self._cola.remove(job)
+        if job.on_finish:
+            if job.hilo is not None:
+                # El intento sigue usando sus datos (p. ej. el fichero que borra on_finish)
+                job.fin_pendiente = True
+            else:
+                self._lanzar_on_finish(job)
+
+    def _lanzar_on_finish(self, job):
+        # Fuera del lock: on_finish puede tocar disco
+        threading.Thread(target=self._llamar_on_finish, args=(job,), daemon=True).start()
+
+    @staticmethod
+    def _llamar_on_finish(job):
+        try:
+            job.on_finish(job.to_dict())
+        except Exception as e:
+            print(f"Error en on_finish del trabajo {job.id}: {e}")
+
+    def _purgar(self):
+        limite = time.time() - RETENCION
+        for job_id in [j.id for j in self._jobs.values()
+                       if j.estado in ESTADOS_FINALES and j.actualizado < limite]:
+            del self._jobs[job_id]
+        for lote_id in [l for l, ids in self._lotes.items() if not any(j in self._jobs for j in ids)]:
+            del self._lotes[lote_id]
+
+    def _reencolar(self, job):
+        with self._cond:
+            if job.estado in ESTADOS_FINALES:
+                return
+            self._actualizar(job, PENDIENTE, f'En cola (intento {job.intentos + 1} de {self.max_intentos})')
+            self._cola.append(job)
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._cola:
+                    self._cond.wait()
+                job = self._cola.popleft()
+                if job.estado in ESTADOS_FINALES:
+                    continue
+                job.intentos += 1
+                self._actualizar(job, PROCESANDO, f'Procesando (intento {job.intentos})')
+            self._ejecutar(job)
+
+    def _ejecutar(self, job):
+        salida = {}
+        fn = job.fn
+
+        def objetivo():
+            try:
+                salida['resultado'] = fn()
+            except Exception as e:
+                salida['resultado'] = {"success": False, "error": str(e)}
+
+        # El intento corre en su propio hilo para poder dar el timeout por
+        # vencido y avisar al usuario (que puede cancelar). Aun así, ni se
+        # reintenta ni se llama a on_finish hasta que el hilo termina: los
+        # intentos simultáneos no pasan de workers y el fichero sigue ahí
+        # mientras se lee. La llamada al modelo tiene su propio timeout.
+        hilo = threading.Thread(target=objetivo, daemon=True)
+        with self._cond:
+            if job.estado in ESTADOS_FINALES:
+                return
+            job.hilo = hilo
+        hilo.start()
+        hilo.join(self.timeout)
+        if hilo.is_alive():
+            with self._cond:
+                if job.estado not in ESTADOS_FINALES:
+                    self._actualizar(job, mensaje=f'Tiempo de espera agotado ({self.timeout:g}s), '
+                                                  f'esperando a que termine el intento')
+            hilo.join()
+            resultado = {"success": False, "error": f"Tiempo de espera agotado ({self.timeout:g}s)"}
+        else:
+            resultado = salida['resultado']
+
+        with self._cond:
+            job.hilo = None
+            if job.fin_pendiente:
+                job.fin_pendiente = False
+                self._lanzar_on_finish(job)
+            if job.estado == CANCELADO:
+                return
+            if resultado.get("success"):
+                self._finalizar(job, COMPLETADO, 'Completado', resultado)
+                return
+            if resultado.get("reintentable", True) and job.intentos < self.max_intentos:
+                espera = self.backoff * (2 ** (job.intentos - 1)) * random.uniform(0.8, 1.2)
+                self._actualizar(job, PENDIENTE, f'{resultado.get("error")}. Reintentando en {espera:.0f}s')
+                t = threading.Timer(espera, self._reencolar, args=(job,))
+                t.daemon = True
+                t.start()
+                return
+            self._finalizar(job, ERROR, resultado.get("error") or 'Error desconocido', resultado)
@@ -1,27 +1,31 @@
-import os
+import sys
 import threading
-import webview
+import app as tpv_app
 from app import app
+import server
 
-def start_flask():
-    # Desactivar reloader para que no interfiera con hilos
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+def start_server():
+    # El socket se abre aquí (los errores de puerto ocupado salen antes de abrir
+    # la ventana); la BD se prepara en otro hilo mientras se abre la ventana.
+    servidor = server.crear_servidor(app)
+    servidor.iniciar()
+    threading.Thread(target=tpv_app.preparar_bd, daemon=True).start()
+    return servidor
 
 if __name__ == '__main__':
-    # Asegurar que el directorio de subidas existe en la ubicación correcta
-    upload_dir = app.config['UPLOAD_FOLDER']
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
+    # --headless: solo el servidor, sin ventana (mismas opciones que server.py)
+    if '--headless' in sys.argv:
+        server.main([a for a in sys.argv[1:] if a != '--headless'])
+        sys.exit(0)
 
-    # Iniciar Flask en un hilo separado
-    t = threading.Thread(target=start_flask)
-    t.daemon = True
-    t.start()
+    import webview
+
+    servidor = start_server()
 
     # Crear la ventana nativa
     webview.create_window(
         'Nexus ERP - Punto de Venta', 
-        'http://127.0.0.1:5000',
+        f'http://127.0.0.1:{server.PORT}',
         width=1200,
         height=800,
         min_size=(1000, 700),
@@ -29,3 +33,6 @@ if __name__ == '__main__':
     )
     
     webview.start()
+
+    # Ventana cerrada: terminar las peticiones en curso (p. ej. del móvil) antes de salir
+    servidor.cerrar()
@@ -0,0 +1,422 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+# Métricas internas para saber dónde se va el tiempo cuando la caja va lenta:
+# - duración de cada ruta de app.py (before/after_request)
+# - duración y filas de cada sentencia SQL (CursorMedido, desde PooledConnection)
+# - registro de consultas y peticiones lentas
+# - duración de las extracciones de albaranes (preprocesado, modelo, CSV)
+# Todo se publica en formato Prometheus en /api/metrics.
+#
+# El perfilado con cProfile por petición se activa en caliente desde
+# /api/metrics/perfilado, sin reiniciar.
+
+ACTIVO = os.environ.get('TPV_METRICS', '1') != '0'
+SQL_LENTA_MS = float(os.environ.get('TPV_SLOW_QUERY_MS', 100))
+PETICION_LENTA_MS = float(os.environ.get('TPV_SLOW_REQUEST_MS', 1000))
+MAX_LENTAS = 200           # entradas guardadas del registro de lentas
+MAX_CONSULTAS = 500        # sentencias distintas con etiqueta propia; el resto va a "otras"
+MAX_PERFILES = 20
+
+BUCKETS_HTTP = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_SQL = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+BUCKETS_OCR = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BUCKETS_GRUPO = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas, buckets):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series = {}  # valores de etiquetas -> [cuentas por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *valores_etiquetas):
+        with self._lock:
+            serie = self._series.get(valores_etiquetas)
+            if serie is None:
+                serie = self._series[valores_etiquetas] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def exportar(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for valores, serie in series:
+            base = _etiquetas(self.etiquetas, valores)
+            for limite, cuenta in zip(self.buckets, serie):
+                lineas.append(f'{self.nombre}_bucket{{{base}{"," if base else ""}le="{limite:g}"}} {cuenta}')
+            lineas.append(f'{self.nombre}_bucket{{{base}{"," if base else ""}le="+Inf"}} {serie[-1]}')
+            lineas.append(f'{self.nombre}_sum{_llaves(base)} {serie[-2]:.6f}')
+            lineas.append(f'{self.nombre}_count{_llaves(base)} {serie[-1]}')
+        return lineas
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, n=1, *valores_etiquetas):
+        with self._lock:
+            self._series[valores_etiquetas] = self._series.get(valores_etiquetas, 0) + n
+
+    def exportar(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} counter']
+        with self._lock:
+            series = list(self._series.items())
+        for valores, n in series:
+            lineas.append(f'{self.nombre}{_llaves(_etiquetas(self.etiquetas, valores))} {n}')
+        return lineas
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(nombres, valores):
+    return ','.join(f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores))
+
+
+def _llaves(base):
+    return f'{{{base}}}' if base else ''
+
+
+http_duracion = Histograma('tpv_http_request_duration_seconds', 'Duración de las peticiones por ruta',
+                           ('endpoint', 'method', 'status'), BUCKETS_HTTP)
+sql_duracion = Histograma('tpv_db_query_duration_seconds', 'Duración de cada sentencia SQL (ejecución y lectura)',
+                          ('consulta',), BUCKETS_SQL)
+sql_filas = Contador('tpv_db_query_rows_total', 'Filas devueltas o modificadas por sentencia', ('consulta',))
+sql_errores = Contador('tpv_db_query_errors_total', 'Sentencias SQL que lanzaron una excepción', ('consulta',))
+sql_lentas = Contador('tpv_db_slow_queries_total', 'Sentencias más lentas que TPV_SLOW_QUERY_MS', ('consulta',))
+peticiones_lentas = Contador('tpv_http_slow_requests_total', 'Peticiones más lentas que TPV_SLOW_REQUEST_MS',
+                             ('endpoint',))
+ocr_duracion = Histograma('tpv_ocr_duration_seconds', 'Duración de las etapas de extracción de albaranes',
+                          ('etapa', 'backend', 'resultado'), BUCKETS_OCR)
+ocr_cache = Contador('tpv_ocr_cache_total', 'Consultas a la caché de extracciones', ('resultado',))
+escritor_grupo = Histograma('tpv_db_write_group_size', 'Operaciones confirmadas en cada transacción del escritor',
+                            (), BUCKETS_GRUPO)
+escritor_espera = Histograma('tpv_db_write_wait_seconds', 'Tiempo en cola de cada escritura hasta su transacción',
+                             (), BUCKETS_SQL)
+
+_METRICAS = [http_duracion, peticiones_lentas, sql_duracion, sql_filas, sql_errores, sql_lentas,
+             escritor_grupo, escritor_espera, ocr_duracion, ocr_cache]
+_indicadores = []  # (nombre, ayuda, fn) -> valor actual, leídos al exportar
+
+
+def registrar_indicador(nombre, ayuda, fn):
+    """Añade un gauge cuyo valor se obtiene llamando a fn() en cada exportación."""
+    _indicadores.append((nombre, ayuda, fn))
+
+
+def exportar():
+    """Texto en formato de exposición de Prometheus (0.0.4)."""
+    lineas = []
+    for metrica in _METRICAS:
+        lineas.extend(metrica.exportar())
+    for nombre, ayuda, fn in _indicadores:
+        try:
+            valor = fn()
+        except Exception as e:
+            print(f"No se pudo leer la métrica {nombre}: {e}")
+            continue
+        if valor is None:
+            continue
+        lineas.append(f'# HELP {nombre} {ayuda}')
+        lineas.append(f'# TYPE {nombre} gauge')
+        lineas.append(f'{nombre} {float(valor):g}')
+    return '\n'.join(lineas) + '\n'
+
+
+# --- SQL ---
+
+_consultas = {}  # texto SQL -> etiqueta normalizada
+_consultas_lock = threading.Lock()
+_lentas = deque(maxlen=MAX_LENTAS)
+_contexto = threading.local()  # petición en curso en este hilo (endpoint, consultas, segundos)
+
+
+def _etiqueta_sql(sql):
+    etiqueta = _consultas.get(sql)
+    if etiqueta is None:
+        with _consultas_lock:
+            if len(_consultas) >= MAX_CONSULTAS:
+                return 'otras'
+            etiqueta = _consultas[sql] = ' '.join(sql.split())[:200]
+    return etiqueta
+
+
+def observar_sql(sql, segundos, filas, error=False):
+    etiqueta = _etiqueta_sql(sql)
+    sql_duracion.observar(segundos, etiqueta)
+    if filas:
+        sql_filas.incrementar(filas, etiqueta)
+    if error:
+        sql_errores.incrementar(1, etiqueta)
+
+    ctx = getattr(_contexto, 'peticion', None)
+    if ctx is not None:
+        ctx['consultas'] += 1
+        ctx['sql_s'] += segundos
+
+    ms = segundos * 1000
+    if ms >= SQL_LENTA_MS:
+        sql_lentas.incrementar(1, etiqueta)
+        entrada = {
+            "tipo": "sql",
+            "fecha": time.time(),
+            "ms": round(ms, 2),
+            "filas": filas,
+            "sql": etiqueta,
+            "endpoint": ctx['endpoint'] if ctx else threading.current_thread().name,
+        }
+        _lentas.append(entrada)
+        print(f"Consulta lenta ({entrada['ms']} ms, {filas} filas, {entrada['endpoint']}): {etiqueta[:120]}")
+
+
+class CursorMedido(sqlite3.Cursor):
+    """Cursor que mide cada sentencia hasta leer su última fila.
+
+    En un SELECT la mayor parte del trabajo ocurre al ir leyendo, así que la
+    medida se cierra al agotar el cursor, al cerrarlo o al liberarlo.
+    """
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        return self._medir(sql, super().execute, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._medir(sql, super().executemany, seq_of_parameters)
+
+    def _medir(self, sql, ejecutar, parametros):
+        self._terminar()
+        self._sql = sql
+        self._filas = 0
+        t = time.perf_counter()
+        try:
+            ejecutar(sql, parametros)
+        except Exception:
+            self._segundos = time.perf_counter() - t
+            self._terminar(error=True)
+            raise
+        self._segundos = time.perf_counter() - t
+        if self.description is None:
+            # INSERT/UPDATE/DELETE/DDL: no hay filas que leer
+            self._filas = max(self.rowcount, 0)
+            self._terminar()
+        return self
+
+    def _terminar(self, error=False):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            observar_sql(sql, self._segundos, self._filas, error)
+
+    def fetchone(self):
+        t = time.perf_counter()
+        fila = super().fetchone()
+        if self._sql is not None:
+            self._segundos += time.perf_counter() - t
+            if fila is None:
+                self._terminar()
+            else:
+                self._filas += 1
+        return fila
+
+    def fetchmany(self, size=None):
+        t = time.perf_counter()
+        filas = super().fetchmany(self.arraysize if size is None else size)
+        if self._sql is not None:
+            self._segundos += time.perf_counter() - t
+            self._filas += len(filas)
+            if not filas:
+                self._terminar()
+        return filas
+
+    def fetchall(self):
+        t = time.perf_counter()
+        filas = super().fetchall()
+        if self._sql is not None:
+            self._segundos += time.perf_counter() - t
+            self._filas += len(filas)
+            self._terminar()
+        return filas
+
+    def __next__(self):
+        t = time.perf_counter()
+        try:
+            fila = super().__next__()
+        except StopIteration:
+            if self._sql is not None:
+                self._segundos += time.perf_counter() - t
+                self._terminar()
+            raise
+        if self._sql is not None:
+            self._segundos += time.perf_counter() - t
+            self._filas += 1
+        return fila
+
+    def close(self):
+        self._terminar()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._terminar()
+        except Exception:
+            pass  # al cerrar el intérprete los módulos ya pueden no existir
+
+
+def anotar_escritura(segundos):
+    # Tiempo que la petición esperó al hilo escritor (su SQL se mide en ese hilo)
+    ctx = getattr(_contexto, 'peticion', None)
+    if ctx is not None:
+        ctx['escritura_s'] += segundos
+
+
+def get_lentas(limit=50):
+    return list(_lentas)[-limit:][::-1]
+
+
+# --- PETICIONES ---
+
+def iniciar_peticion(endpoint):
+    _contexto.peticion = {"endpoint": endpoint, "inicio": time.perf_counter(), "consultas": 0, "sql_s": 0.0,
+                          "escritura_s": 0.0}
+    perfil = _perfilado.iniciar(endpoint)
+    if perfil is not None:
+        _contexto.peticion["perfil"] = perfil
+
+
+def terminar_peticion(endpoint, metodo, estado, ruta=''):
+    """Registra la petición del hilo actual; devuelve su contexto (o None)."""
+    ctx = getattr(_contexto, 'peticion', None)
+    if ctx is None:
+        return None
+    _contexto.peticion = None
+    segundos = time.perf_counter() - ctx['inicio']
+    ctx['segundos'] = segundos
+    endpoint = endpoint or 'sin_ruta'
+    http_duracion.observar(segundos, endpoint, metodo, str(estado))
+    if 'perfil' in ctx:
+        ctx['perfil_id'] = _perfilado.terminar(ctx.pop('perfil'), endpoint, metodo, ruta, segundos, ctx)
+
+    ms = segundos * 1000
+    if ms >= PETICION_LENTA_MS:
+        peticiones_lentas.incrementar(1, endpoint)
+        _lentas.append({
+            "tipo": "peticion",
+            "fecha": time.time(),
+            "ms": round(ms, 2),
+            "endpoint": endpoint,
+            "ruta": ruta,
+            "consultas": ctx['consultas'],
+            "sql_ms": round(ctx['sql_s'] * 1000, 2),
+            "escritura_ms": round(ctx['escritura_s'] * 1000, 2),
+        })
+        print(f"Petición lenta: {metodo} {ruta} {ms:.0f} ms (SQL: {ctx['consultas']} consultas, "
+              f"{ctx['sql_s'] * 1000:.0f} ms; escritor: {ctx['escritura_s'] * 1000:.0f} ms)")
+    return ctx
+
+
+# --- OCR ---
+
+def observar_ocr(etapa, segundos, backend='', ok=True):
+    ocr_duracion.observar(segundos, etapa, backend, 'ok' if ok else 'error')
+
+
+# --- PERFILADO ---
+
+class Perfilado:
+    """cProfile de las peticiones que coincidan con el filtro mientras esté activo.
+
+    Solo se perfila el hilo de la petición (cProfile es por hilo). Los
+    informes se guardan en memoria y se consultan desde /api/metrics/perfiles.
+    """
+
+    def __init__(self):
+        self.activo = os.environ.get('TPV_PROFILE', '0') == '1'
+        self.endpoint = None   # solo este endpoint (None = todos)
+        self.restantes = None  # se desactiva solo tras N peticiones (None = sin límite)
+        self._perfiles = deque(maxlen=MAX_PERFILES)
+        self._lock = threading.Lock()
+
+    def configurar(self, activo, endpoint=None, peticiones=None):
+        with self._lock:
+            self.activo = bool(activo)
+            self.endpoint = endpoint or None
+            self.restantes = peticiones
+
+    def estado(self):
+        with self._lock:
+            return {"activo": self.activo, "endpoint": self.endpoint, "restantes": self.restantes,
+                    "guardados": len(self._perfiles)}
+
+    def iniciar(self, endpoint):
+        if not self.activo:
+            return None
+        with self._lock:
+            if not self.activo or (self.endpoint and endpoint != self.endpoint):
+                return None
+            if self.restantes is not None:
+                self.restantes -= 1
+                if self.restantes <= 0:
+                    self.activo = False
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            return None  # ya hay otro perfilador en este hilo
+        return perfil
+
+    def terminar(self, perfil, endpoint, metodo, ruta, segundos, ctx, lineas=40):
+        perfil.disable()
+        texto = io.StringIO()
+        stats = pstats.Stats(perfil, stream=texto)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(lineas)
+        informe = {
+            "id": uuid.uuid4().hex[:12],
+            "fecha": time.time(),
+            "endpoint": endpoint,
+            "metodo": metodo,
+            "ruta": ruta,
+            "ms": round(segundos * 1000, 2),
+            "consultas": ctx['consultas'],
+            "sql_ms": round(ctx['sql_s'] * 1000, 2),
+            "escritura_ms": round(ctx['escritura_s'] * 1000, 2),
+            "perfil": re.sub(r'\n{3,}', '\n\n', texto.getvalue()).strip(),
+        }
+        with self._lock:
+            self._perfiles.append(informe)
+        return informe['id']
+
+    def listar(self):
+        with self._lock:
+            return [{k: v for k, v in p.items() if k != 'perfil'} for p in reversed(self._perfiles)]
+
+    def get(self, perfil_id):
+        with self._lock:
+            return next((p for p in self._perfiles if p['id'] == perfil_id), None)
+
+
+_perfilado = Perfilado()
+
+def get_perfilado():
+    return _perfilado
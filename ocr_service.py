@@ -1,122 +1,279 @@
-try:
-    import google.generativeai as genai
-    HAS_GENAI = True
-except ImportError:
-    HAS_GENAI = False
-
 import os
 import json
-import PIL.Image
-import pandas as pd
 import io
+import threading
+import time
+import hashlib
+
+import database
+import metricas
+import preprocesado
+
+# pandas, PIL y google-generativeai tardan en importarse (sobre todo dentro del
+# .exe de PyInstaller), así que se cargan la primera vez que hacen falta y no
+# al arrancar el TPV.
+genai = None
+HAS_GENAI = None  # None = aún no se ha intentado importar
+_genai_lock = threading.Lock()
 
 # Intentar configurar API Key desde entorno
 API_KEY = os.environ.get("GEMINI_API_KEY")
 
-if API_KEY and HAS_GENAI:
-    try:
-        genai.configure(api_key=API_KEY)
-    except:
-        pass
+def _cargar_genai():
+    global genai, HAS_GENAI
+    with _genai_lock:
+        if HAS_GENAI is None:
+            try:
+                import google.generativeai as _genai
+                genai = _genai
+                HAS_GENAI = True
+                if API_KEY:
+                    try:
+                        genai.configure(api_key=API_KEY)
+                    except:
+                        pass
+            except ImportError:
+                HAS_GENAI = False
+    return HAS_GENAI
 
 def configure_api_key(key):
     global API_KEY
     API_KEY = key
+    # Si la librería aún no está cargada se configurará al cargarla
     if HAS_GENAI:
         try:
             genai.configure(api_key=key)
         except:
             pass
 
-def procesar_albaran(file_path):
-    ext = file_path.rsplit('.', 1)[1].lower()
-    
+# --- CACHÉ DE RESULTADOS ---
+# La clave es el hash del contenido más la versión de quien extrae (parser CSV o
+# modelo + prompt): cambiar cualquiera de los dos invalida lo guardado.
+CACHE_ACTIVA = os.environ.get('TPV_OCR_CACHE', '1') != '0'
+CSV_PARSER_VERSION = 1  # subir si cambia lo que devuelve procesar_csv
+
+def _hash_fichero(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def _clave_cache(huella, ext):
     if ext == 'csv':
-        return procesar_csv(file_path)
+        version = f'csv-v{CSV_PARSER_VERSION}'
     else:
-        return procesar_imagen_gemini(file_path)
+        version = f'img-{get_backend().version}-p{preprocesado.VERSION}'
+    return f'{version}:{huella}'
 
-def procesar_csv(file_path):
-    try:
-        # Intentar leer con pandas detectando formato europeo
-        # sep=; decimal=,
+def _con_cache(clave, extraer):
+    if clave:
         try:
-            df = pd.read_csv(file_path, sep=';', decimal=',', encoding='utf-8')
-        except:
-            # Fallback a formato estandar si falla
-            df = pd.read_csv(file_path)
-            
-        productos = []
-        
-        # Mapeo de columnas flexible (normalizar nombres)
-        cols = {c.strip().lower(): c for c in df.columns}
-        
-        # Buscar columnas clave
-        col_sku = next((cols[c] for c in cols if 'sku' in c or 'cod' in c or 'ref' in c), None)
-        col_nom = next((cols[c] for c in cols if 'desc' in c or 'prod' in c or 'nom' in c), None)
-        col_cant = next((cols[c] for c in cols if 'cant' in c or 'uni' in c or 'qty' in c), None)
-        col_costo = next((cols[c] for c in cols if 'cost' in c or 'precio' in c), None)
-        
-        if not (col_sku and col_nom):
-            return {"success": False, "error": "No se encontraron columnas de Código/SKU o Nombre en el CSV"}
-            
-        for _, row in df.iterrows():
-            try:
-                # Limpieza básica
-                sku = str(row[col_sku]).strip()
-                nombre = str(row[col_nom]).strip()
-                
-                # Cantidad
-                cant = 1
+            guardado = database.get_cached_extraction(clave)
+            metricas.ocr_cache.incrementar(1, 'acierto' if guardado is not None else 'fallo')
+            if guardado is not None:
+                guardado["cache"] = True
+                return guardado
+        except Exception as e:
+            # La caché es una optimización: si falla se extrae igualmente
+            print(f"Caché de extracciones no disponible: {e}")
+            clave = None
+
+    resultado = extraer()
+
+    # Solo se guardan los éxitos: un fallo puntual del modelo no debe quedarse fijo
+    if clave and resultado.get("success"):
+        try:
+            database.save_cached_extraction(clave, resultado)
+        except Exception as e:
+            print(f"No se pudo guardar en la caché de extracciones: {e}")
+    return resultado
+
+def procesar_albaran(file_path, usar_cache=CACHE_ACTIVA):
+    ext = file_path.rsplit('.', 1)[1].lower()
+    if ext != 'csv':
+        with open(file_path, 'rb') as f:
+            return procesar_albaran_datos(f.read(), file_path, usar_cache)
+
+    clave = _clave_cache(_hash_fichero(file_path), ext) if usar_cache else None
+    return _con_cache(clave, lambda: procesar_csv(file_path))
+
+def procesar_albaran_datos(datos, nombre, usar_cache=CACHE_ACTIVA):
+    """Como procesar_albaran, para una imagen que ya está en memoria (la subida)."""
+    ext = nombre.rsplit('.', 1)[-1].lower()
+    clave = _clave_cache(hashlib.sha256(datos).hexdigest(), ext) if usar_cache else None
+    return _con_cache(clave, lambda: procesar_imagen(datos, ext=ext))
+
+CSV_CHUNK_SIZE = 20000  # filas por bloque: limita la memoria con CSV enormes
+
+def _detectar_columnas(columnas):
+    # Mapeo de columnas flexible (normalizar nombres)
+    cols = {c.strip().lower(): c for c in columnas}
+    
+    # Buscar columnas clave
+    col_sku = next((cols[c] for c in cols if 'sku' in c or 'cod' in c or 'ref' in c), None)
+    col_nom = next((cols[c] for c in cols if 'desc' in c or 'prod' in c or 'nom' in c), None)
+    col_cant = next((cols[c] for c in cols if 'cant' in c or 'uni' in c or 'qty' in c), None)
+    col_costo = next((cols[c] for c in cols if 'cost' in c or 'precio' in c), None)
+    return col_sku, col_nom, col_cant, col_costo
+
+_SIMBOLOS = {c: None for c in '€$£ \xa0\t'}
+# Tabla de traducción según quién sea el separador decimal: una sola pasada
+# por celda quita moneda, espacios y miles y deja el decimal como punto.
+_TRADUCCION = {
+    True: str.maketrans({**_SIMBOLOS, '.': None, ',': '.'}),   # 1.234,56
+    False: str.maketrans({**_SIMBOLOS, ',': None}),            # 1,234.56
+}
+
+def _es_decimal_coma(serie):
+    """Decide con una muestra si la columna usa coma decimal (formato europeo)."""
+    coma = punto = 0
+    for x in serie.dropna().head(1000):
+        c, p = x.rfind(','), x.rfind('.')
+        if c > p: coma += 1
+        elif p > c: punto += 1
+    return coma >= punto
+
+def _limpiar_numeros(serie, decimal_coma):
+    """Convierte una columna de texto a número de forma vectorizada (NaN si no se puede).
+
+    inf y los valores que no caben en un int64 también quedan en NaN: cuentan
+    como vacíos en vez de hacer fallar el albarán entero.
+    """
+    import numpy as np
+    import pandas as pd
+    numeros = pd.to_numeric(serie.str.translate(_TRADUCCION[decimal_coma]), errors='coerce')
+    return numeros.where(np.isfinite(numeros) & (numeros.abs() < 2**63))
+
+def _abrir_csv(file_path):
+    # utf-8 (con o sin BOM) y, si falla, latin-1 (típico de exportaciones de Windows)
+    for encoding in ('utf-8-sig', 'latin-1'):
+        try:
+            with open(file_path, encoding=encoding) as f:
+                cabecera = f.readline()
+            return encoding, cabecera
+        except UnicodeDecodeError:
+            continue
+
+def iter_csv_productos(file_path, chunksize=CSV_CHUNK_SIZE, stats=None, progreso=None):
+    """Lee un albarán CSV por bloques y devuelve un generador de productos.
+
+    La detección de separador y columnas se hace una vez, al llamar a la
+    función (lanza ValueError si faltan columnas) y el formato numérico de
+    cada columna con el primer bloque. Cada bloque se limpia de forma
+    vectorizada. stats (dict) se va actualizando con filas, validas y
+    rechazadas; progreso(stats) se llama tras cada bloque.
+    """
+    import pandas as pd
+
+    encoding, cabecera = _abrir_csv(file_path)
+    sep = ';' if cabecera.count(';') >= cabecera.count(',') else ','
+    columnas = pd.read_csv(io.StringIO(cabecera), sep=sep, nrows=0).columns
+    col_sku, col_nom, col_cant, col_costo = _detectar_columnas(columnas)
+
+    if not (col_sku and col_nom):
+        raise ValueError("No se encontraron columnas de Código/SKU o Nombre en el CSV")
+
+    if stats is None:
+        stats = {}
+    stats.update(filas=0, validas=0, rechazadas=0, bytes=0, total_bytes=os.path.getsize(file_path))
+    usecols = [c for c in (col_sku, col_nom, col_cant, col_costo) if c]
+
+    def generar():
+        formato = {}  # columna -> usa coma decimal; se decide con el primer bloque
+        with open(file_path, encoding=encoding, newline='') as f:
+            lector = pd.read_csv(f, sep=sep, dtype=str, usecols=usecols, chunksize=chunksize,
+                                 skipinitialspace=True)
+            for df in lector:
+                if not formato:
+                    formato = {c: _es_decimal_coma(df[c]) for c in (col_cant, col_costo) if c}
+                sku = df[col_sku].str.strip()
+                nombre = df[col_nom].str.strip()
+                validas = sku.notna() & (sku != '') & nombre.notna() & (nombre != '')
+
+                # Cantidad (1 si falta o no es numérica)
                 if col_cant:
-                    try: cant = int(float(str(row[col_cant]).replace(',', '.'))) 
-                    except: pass
-                    
-                # Costo
-                costo = 0.0
+                    cant = _limpiar_numeros(df[col_cant], formato[col_cant]).fillna(1).astype('int64')
+                else:
+                    cant = pd.Series(1, index=df.index)
+
+                # Costo (0 si falta)
                 if col_costo:
-                    try: costo = float(str(row[col_costo]).replace('€', '').replace(',', '.').strip())
-                    except: pass
-                
+                    costo = _limpiar_numeros(df[col_costo], formato[col_costo]).fillna(0.0)
+                else:
+                    costo = pd.Series(0.0, index=df.index)
+
                 # Venta sugerida (30% margen si no hay columna venta)
-                venta = round(costo * 1.3, 2)
-                
-                if sku and nombre:
-                    productos.append({
-                        "codigo": sku,
-                        "nombre": nombre,
-                        "costo": costo,
-                        "venta": venta,
-                        "unidades": cant
-                    })
-            except Exception as ex:
-                print(f"Error fila: {ex}")
-                continue
-                
-        return {"success": True, "productos": productos}
-        
-    except Exception as e:
-        return {"success": False, "error": f"Error procesando CSV: {str(e)}"}
+                venta = (costo * 1.3).round(2)
 
-def procesar_imagen_gemini(image_path):
-    if not HAS_GENAI:
-        return {
-            "success": False, 
-            "error": "La librería de IA no está instalada (google-generativeai)."
-        }
-
-    if not API_KEY:
-        return {
-            "success": False, 
-            "error": "Falta la API Key de Gemini. Configúrala en el sistema."
-        }
+                stats['filas'] += len(df)
+                stats['validas'] += int(validas.sum())
+                stats['rechazadas'] += int((~validas).sum())
+                stats['bytes'] = f.tell()
+
+                m = validas.to_numpy()
+                for codigo, nom, c, cs, v in zip(sku[m], nombre[m], cant[m], costo[m], venta[m]):
+                    yield {
+                        "codigo": codigo,
+                        "nombre": nom,
+                        "costo": float(cs),
+                        "venta": float(v),
+                        "unidades": int(c)
+                    }
+                if progreso:
+                    progreso(stats)
 
+    return generar()
+
+def procesar_csv(file_path):
+    t = time.perf_counter()
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        img = PIL.Image.open(image_path)
-        
-        prompt = """
+        stats = {}
+        productos = list(iter_csv_productos(file_path, stats=stats))
+        res = {"success": True, "productos": productos, "rechazadas": stats['rechazadas']}
+    except ValueError as e:
+        # Columnas que no se reconocen, formato no válido...: repetir no sirve
+        res = {"success": False, "error": str(e), "reintentable": False}
+    except Exception as e:
+        res = {"success": False, "error": f"Error procesando CSV: {str(e)}"}
+    metricas.observar_ocr('csv', time.perf_counter() - t, 'csv', res['success'])
+    return res
+
+def combinar_productos(listas):
+    """Une los productos de varios albaranes (o páginas) en una sola lista.
+
+    Los SKU repetidos se juntan sumando unidades; del resto de campos manda la
+    primera aparición. Las líneas sin código se agrupan por nombre.
+    """
+    combinados = {}
+    for productos in listas:
+        for p in productos or []:
+            codigo = str(p.get("codigo") or '').strip()
+            clave = codigo or 'nombre:' + str(p.get("nombre") or '').strip().lower()
+            try:
+                unidades = int(p.get("unidades") or 1)
+            except (TypeError, ValueError):
+                unidades = 1
+            if clave in combinados:
+                combinados[clave]["unidades"] += unidades
+            else:
+                combinados[clave] = {**p, "codigo": codigo, "unidades": unidades}
+    return list(combinados.values())
+
+# --- EXTRACCIÓN DE IMÁGENES (modelo intercambiable) ---
+# El modelo se elige con set_backend() o con TPV_OCR_BACKEND=fake (modelo local
+# sin red para pruebas y benchmarks). Un backend expone extraer(imagen, mime_type),
+# que recibe los bytes ya preprocesados y devuelve la lista de productos o
+# lanza ExtraccionError.
+
+class ExtraccionError(Exception):
+    def __init__(self, mensaje, reintentable=True):
+        super().__init__(mensaje)
+        self.reintentable = reintentable
+
+
+class GeminiBackend:
+    PROMPT = """
         Analiza esta imagen y extrae la lista de productos en formato JSON estricto.
         Para cada item devuelve:
         - "codigo": SKU o referencia.
@@ -128,15 +285,101 @@ def procesar_imagen_gemini(image_path):
         Responde SOLO el JSON:
         {"productos": [...]}
         """
+
+    def __init__(self, modelo='gemini-1.5-flash', timeout=60):
+        self.nombre = modelo
+        self.timeout = timeout
+        # Identifica modelo + prompt en la clave de la caché de resultados
+        self.version = f'{modelo}-{hashlib.sha1(self.PROMPT.encode()).hexdigest()[:8]}'
+
+    def extraer(self, imagen, mime_type='image/jpeg'):
+        if not _cargar_genai():
+            raise ExtraccionError("La librería de IA no está instalada (google-generativeai).", reintentable=False)
+        if not API_KEY:
+            raise ExtraccionError("Falta la API Key de Gemini. Configúrala en el sistema.", reintentable=False)
+
+        model = genai.GenerativeModel(self.nombre)
         
-        response = model.generate_content([prompt, img])
+        # Los bytes van directos como parte inline: no hace falta abrirlos con PIL
+        img = {"mime_type": mime_type, "data": imagen}
+        
+        response = model.generate_content([self.PROMPT, img], request_options={"timeout": self.timeout})
         text_resp = response.text.strip()
         
         if text_resp.startswith("```json"):
             text_resp = text_resp.replace("```json", "").replace("```", "")
         
         data = json.loads(text_resp)
-        return {"success": True, "productos": data.get("productos", [])}
-        
+        return data.get("productos", [])
+
+
+class FakeBackend:
+    """Modelo local: devuelve productos fijos tras un retardo, sin llamar a la red.
+
+    fallos hace que las primeras N llamadas fallen (para probar reintentos).
+    """
+
+    nombre = 'fake'
+    version = 'fake'
+
+    def __init__(self, retardo=0.5, productos=None, fallos=0):
+        self.retardo = retardo
+        self.productos = productos or [
+            {"codigo": "FAKE-001", "nombre": "Producto de prueba 1", "unidades": 2, "costo": 10.0, "venta": 15.0},
+            {"codigo": "FAKE-002", "nombre": "Producto de prueba 2", "unidades": 1, "costo": 4.5, "venta": 6.75},
+        ]
+        self._fallos = fallos
+        self._lock = threading.Lock()
+
+    def extraer(self, imagen, mime_type='image/jpeg'):
+        time.sleep(self.retardo)
+        with self._lock:
+            if self._fallos > 0:
+                self._fallos -= 1
+                raise ExtraccionError("Fallo simulado del modelo")
+        return [dict(p) for p in self.productos]
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = FakeBackend() if os.environ.get('TPV_OCR_BACKEND') == 'fake' else GeminiBackend()
+    return _backend
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+def procesar_imagen(imagen, backend=None, ext=None):
+    """Preprocesa una imagen (ruta o bytes) y extrae los productos con el backend.
+
+    Los fallos devuelven "reintentable": False cuando repetir no sirve
+    (falta la librería o la API key, o el fichero no es una imagen).
+    """
+    backend = backend or get_backend()
+    if isinstance(imagen, str):
+        ext = ext or imagen.rsplit('.', 1)[-1].lower()
+        with open(imagen, 'rb') as f:
+            imagen = f.read()
+    t = time.perf_counter()
+    try:
+        datos, mime_type, informe = preprocesado.preprocesar(imagen, ext or 'jpg')
+    except ValueError as e:
+        metricas.observar_ocr('preprocesado', time.perf_counter() - t, backend.nombre, ok=False)
+        return {"success": False, "error": str(e), "reintentable": False}
+    metricas.observar_ocr('preprocesado', time.perf_counter() - t, backend.nombre)
+
+    t = time.perf_counter()
+    try:
+        res = {"success": True, "productos": backend.extraer(datos, mime_type), "preprocesado": informe}
+    except ExtraccionError as e:
+        res = {"success": False, "error": str(e), "reintentable": e.reintentable}
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        res = {"success": False, "error": str(e), "reintentable": True}
+    metricas.observar_ocr('modelo', time.perf_counter() - t, backend.nombre, res['success'])
+    return res
+
+def procesar_imagen_gemini(image_path):
+    return procesar_imagen(image_path, GeminiBackend())
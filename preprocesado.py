@@ -0,0 +1,150 @@
+import io
+import os
+import threading
+import time
+
+# Preprocesado de fotos de albaranes antes de mandarlas al modelo.
+# Una foto de móvil pesa 3-6 MB y tiene 12 Mpx; al modelo le basta un JPEG en
+# grises de ~1600 px recortado al documento, que ocupa una fracción y se sube
+# y procesa mucho antes. Todo se hace en memoria, sin ficheros temporales.
+#
+# OpenCV se carga la primera vez que hace falta (tarda en importarse). Si no
+# está instalado la imagen se manda tal cual.
+
+MAX_LADO = int(os.environ.get('TPV_IMG_MAX_SIDE', 1600))          # píxeles del lado mayor
+CALIDAD_JPEG = int(os.environ.get('TPV_IMG_JPEG_QUALITY', 80))
+VERSION = 1  # subir si cambia el resultado del preprocesado (forma parte de la clave de caché)
+
+cv2 = None
+np = None
+HAS_CV2 = None  # None = aún no se ha intentado importar
+_cv2_lock = threading.Lock()
+
+MIME_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+
+
+def _cargar_cv2():
+    global cv2, np, HAS_CV2
+    with _cv2_lock:
+        if HAS_CV2 is None:
+            try:
+                import cv2 as _cv2
+                import numpy as _np
+                cv2, np = _cv2, _np
+                HAS_CV2 = True
+            except ImportError:
+                HAS_CV2 = False
+    return HAS_CV2
+
+
+def _orientacion_exif(datos):
+    # Solo lee la cabecera: Pillow no decodifica la imagen para esto
+    try:
+        from PIL import Image
+        return Image.open(io.BytesIO(datos)).getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+
+def _aplicar_orientacion(img, orientacion):
+    if orientacion in (2, 4, 5, 7):
+        img = cv2.flip(img, 1 if orientacion in (2, 5, 7) else 0)
+    rotacion = {3: cv2.ROTATE_180, 5: cv2.ROTATE_90_COUNTERCLOCKWISE, 6: cv2.ROTATE_90_CLOCKWISE,
+                7: cv2.ROTATE_90_CLOCKWISE, 8: cv2.ROTATE_90_COUNTERCLOCKWISE}.get(orientacion)
+    return cv2.rotate(img, rotacion) if rotacion is not None else img
+
+
+def _ordenar_esquinas(pts):
+    # arriba-izquierda, arriba-derecha, abajo-derecha, abajo-izquierda
+    suma = pts.sum(axis=1)
+    resta = np.diff(pts, axis=1).ravel()
+    return np.array([pts[np.argmin(suma)], pts[np.argmin(resta)],
+                     pts[np.argmax(suma)], pts[np.argmax(resta)]], dtype='float32')
+
+
+def _recortar_documento(img, area_minima=0.25):
+    """Busca el contorno del papel y endereza la perspectiva.
+
+    La detección se hace sobre una copia de 500 px; si no aparece un
+    cuadrilátero que ocupe al menos area_minima de la foto se deja igual.
+    """
+    alto, ancho = img.shape[:2]
+    escala = 500.0 / max(alto, ancho)
+    copia = cv2.resize(img, (max(1, int(ancho * escala)), max(1, int(alto * escala))), interpolation=cv2.INTER_AREA)
+    gris = cv2.cvtColor(copia, cv2.COLOR_BGR2GRAY)
+    bordes = cv2.Canny(cv2.GaussianBlur(gris, (5, 5), 0), 50, 150)
+    bordes = cv2.dilate(bordes, None)
+    contornos, _ = cv2.findContours(bordes, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    area_copia = copia.shape[0] * copia.shape[1]
+    for c in sorted(contornos, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(c) < area_minima * area_copia:
+            break
+        aprox = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+        if len(aprox) != 4:
+            continue
+        esquinas = _ordenar_esquinas(aprox.reshape(4, 2).astype('float32') / escala)
+        (tl, tr, br, bl) = esquinas
+        ancho_doc = int(max(np.linalg.norm(br - bl), np.linalg.norm(tr - tl)))
+        alto_doc = int(max(np.linalg.norm(tr - br), np.linalg.norm(tl - bl)))
+        destino = np.array([[0, 0], [ancho_doc - 1, 0], [ancho_doc - 1, alto_doc - 1], [0, alto_doc - 1]], dtype='float32')
+        matriz = cv2.getPerspectiveTransform(esquinas, destino)
+        return cv2.warpPerspective(img, matriz, (ancho_doc, alto_doc)), True
+    return img, False
+
+
+def preprocesar(datos, ext='jpg', max_lado=MAX_LADO, calidad=CALIDAD_JPEG):
+    """Prepara una foto de albarán para el modelo.
+
+    Devuelve (datos, mime_type, informe); el informe lleva el tiempo, las
+    dimensiones y el tamaño tras cada etapa. Lanza ValueError si los bytes
+    no son una imagen.
+    """
+    informe = {"bytes_entrada": len(datos), "etapas": []}
+    if not _cargar_cv2():
+        informe["omitido"] = "OpenCV no está instalado (opencv-python-headless)"
+        informe["bytes_salida"] = len(datos)
+        return datos, MIME_TYPES.get(ext, 'image/jpeg'), informe
+
+    t_total = time.perf_counter()
+    t = time.perf_counter()
+
+    def etapa(nombre, img, **extra):
+        nonlocal t
+        ahora = time.perf_counter()
+        informe["etapas"].append({"etapa": nombre, "ms": round((ahora - t) * 1000, 1),
+                                  "ancho": img.shape[1], "alto": img.shape[0], **extra})
+        t = ahora
+
+    img = cv2.imdecode(np.frombuffer(datos, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError("El fichero no es una imagen válida")
+    etapa("decodificar", img)
+
+    orientacion = _orientacion_exif(datos)
+    img = _aplicar_orientacion(img, orientacion)
+    etapa("rotacion_exif", img, orientacion=orientacion)
+
+    img, recortado = _recortar_documento(img)
+    etapa("recorte", img, recortado=recortado)
+
+    # Reducir antes de normalizar: el contraste se calcula sobre muchos menos píxeles
+    alto, ancho = img.shape[:2]
+    if max(alto, ancho) > max_lado:
+        escala = max_lado / max(alto, ancho)
+        img = cv2.resize(img, (int(ancho * escala), int(alto * escala)), interpolation=cv2.INTER_AREA)
+    etapa("reducir", img)
+
+    gris = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gris)
+    etapa("grises_contraste", img)
+
+    ok, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+    if not ok:
+        raise ValueError("No se pudo codificar la imagen")
+    jpeg = jpeg.tobytes()
+    etapa("jpeg", img, bytes=len(jpeg))
+
+    informe["bytes_salida"] = len(jpeg)
+    informe["ms_total"] = round((time.perf_counter() - t_total) * 1000, 1)
+    return jpeg, 'image/jpeg', informe
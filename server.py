@@ -0,0 +1,146 @@
+import argparse
+import os
+import signal
+import threading
+
+# Servidor WSGI de producción (waitress) para la app Flask.
+# El servidor de desarrollo de Werkzeug atiende mal varias peticiones a la vez
+# (ventana del TPV + móvil + navegador de la oficina); waitress usa un pool de
+# hilos fijo, limita conexiones y cierra las inactivas.
+#
+# Uso sin ventana (por ejemplo en un PC de trastienda):
+#     python server.py --port 5000 --threads 16
+try:
+    import waitress
+    HAS_WAITRESS = True
+except ImportError:
+    HAS_WAITRESS = False
+
+HOST = os.environ.get('TPV_HOST', '0.0.0.0')  # todas las interfaces: el móvil entra por la Wi-Fi
+PORT = int(os.environ.get('TPV_PORT', 5000))
+THREADS = int(os.environ.get('TPV_THREADS', 16))
+CONNECTION_LIMIT = int(os.environ.get('TPV_CONNECTION_LIMIT', 100))
+CHANNEL_TIMEOUT = int(os.environ.get('TPV_CHANNEL_TIMEOUT', 120))     # segundos sin actividad antes de cerrar la conexión
+SHUTDOWN_TIMEOUT = float(os.environ.get('TPV_SHUTDOWN_TIMEOUT', 10))  # segundos para terminar las peticiones en curso
+
+
+class Servidor:
+    """waitress en un hilo propio, con parada ordenada.
+
+    cerrar() espera (hasta shutdown_timeout) a que terminen las peticiones en
+    curso y cierra el socket y las conexiones.
+    """
+
+    def __init__(self, app, host=HOST, port=PORT, threads=THREADS, connection_limit=CONNECTION_LIMIT,
+                 channel_timeout=CHANNEL_TIMEOUT, shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.shutdown_timeout = shutdown_timeout
+        self.server = waitress.create_server(
+            app, host=host, port=port, threads=threads,
+            connection_limit=connection_limit, channel_timeout=channel_timeout,
+            max_request_body_size=app.config.get('MAX_CONTENT_LENGTH') or 1073741824,
+            ident='NexusERP',
+        )
+        self.url = f'http://{host}:{port}'
+        self._hilo = None
+        self._cerrando = threading.Event()
+        self._parado = threading.Event()
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self.server.run, name='wsgi', daemon=True)
+        self._hilo.start()
+
+    def cerrar(self):
+        if self._cerrando.is_set():
+            return
+        self._cerrando.set()
+        # Solo API pública de waitress; task_dispatcher no lo es, así que si una
+        # versión no lo tiene se cierra sin esperar a las peticiones en curso.
+        dispatcher = getattr(self.server, 'task_dispatcher', None)
+        if callable(getattr(dispatcher, 'shutdown', None)):
+            dispatcher.shutdown(cancel_pending=True, timeout=self.shutdown_timeout)
+            if getattr(dispatcher, 'threads', None):
+                print(f"Parada: {len(dispatcher.threads)} peticiones seguían en curso tras {self.shutdown_timeout:g}s")
+        self.server.close()
+        self._parado.set()
+
+    def esperar(self):
+        # wait() con timeout: en Windows un wait() sin límite no deja pasar Ctrl+C
+        while not self._parado.wait(0.5):
+            pass
+
+
+class ServidorDesarrollo:
+    """Alternativa con el servidor de Werkzeug (multihilo) si waitress no está instalado."""
+
+    def __init__(self, app, host=HOST, port=PORT, **_opciones):
+        from werkzeug.serving import make_server
+        self.server = make_server(host, port, app, threaded=True)
+        self.url = f'http://{host}:{port}'
+        self._cerrando = threading.Event()
+        self._parado = threading.Event()
+
+    def iniciar(self):
+        threading.Thread(target=self.server.serve_forever, name='wsgi', daemon=True).start()
+
+    def cerrar(self):
+        if self._cerrando.is_set():
+            return
+        self._cerrando.set()
+        self.server.shutdown()
+        self._parado.set()
+
+    def esperar(self):
+        while not self._parado.wait(0.5):
+            pass
+
+
+def _comprobar_hilos(threads):
+    # /api/events y el seguimiento de albaranes retienen un hilo por conexión
+    import eventos
+    largas = eventos.MAX_CLIENTES + eventos.MAX_ESPERAS_TRABAJOS
+    if threads - largas < 2:
+        print(f"Aviso: {threads} hilos y hasta {largas} conexiones largas (TPV_EVENTS_MAX_CLIENTS + "
+              f"TPV_JOB_STREAMS_MAX): las ventas pueden quedarse esperando un hilo libre")
+
+
+def crear_servidor(app, **opciones):
+    _comprobar_hilos(opciones.get('threads', THREADS))
+    if HAS_WAITRESS:
+        return Servidor(app, **opciones)
+    print("waitress no está instalado: se usa el servidor de desarrollo de Werkzeug")
+    return ServidorDesarrollo(app, **opciones)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Nexus ERP sin ventana: solo el servidor web')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--threads', type=int, default=THREADS, help='hilos que atienden peticiones')
+    parser.add_argument('--connection-limit', type=int, default=CONNECTION_LIMIT, help='conexiones abiertas como máximo')
+    parser.add_argument('--channel-timeout', type=int, default=CHANNEL_TIMEOUT, help='segundos de inactividad antes de cerrar una conexión')
+    parser.add_argument('--shutdown-timeout', type=float, default=SHUTDOWN_TIMEOUT, help='segundos de espera a las peticiones en curso al parar')
+    args = parser.parse_args(argv)
+
+    import app as tpv_app
+
+    servidor = crear_servidor(tpv_app.app, host=args.host, port=args.port, threads=args.threads,
+                              connection_limit=args.connection_limit, channel_timeout=args.channel_timeout,
+                              shutdown_timeout=args.shutdown_timeout)
+    tpv_app.preparar_bd()
+
+    def parar(signum, _frame):
+        print(f"Señal {signum} recibida, parando el servidor...")
+        threading.Thread(target=servidor.cerrar, daemon=True).start()
+
+    for nombre in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, nombre):
+            signal.signal(getattr(signal, nombre), parar)
+
+    servidor.iniciar()
+    print(f"Nexus ERP escuchando en {servidor.url} ({args.threads} hilos)")
+    servidor.esperar()
+    print("Servidor parado.")
+
+
+if __name__ == '__main__':
+    main()
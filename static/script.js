@@ -23,6 +23,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Detect IP for phone connection
     setupMobileAssistant();
+
+    // Cambios de otros terminales en tiempo real
+    setupLiveUpdates();
 });
 
 let html5QrCode = null;
@@ -49,46 +52,50 @@ function showView(viewId) {
 }
 
 // --- DASHBOARD ---
+let dashboardData = null;
+
 function loadDashboard() {
     fetch('/api/dashboard')
         .then(r => r.json())
-        .then(data => {
-            animateValue('dash-sales', data.ventas_hoy, '€');
-            animateValue('dash-expenses', data.gastos_hoy, '€');
-            animateValue('dash-profit', data.beneficio_hoy, '€');
-
-            renderSalesChart(data.history);
-
-            // Más vendidos
-            const topList = document.getElementById('top-products-list');
-            topList.innerHTML = data.top_selling.map(p => `
-                <div style="display:flex; justify-content:space-between; padding:5px; border-bottom:1px solid rgba(255,255,255,0.05)">
-                    <span>${p.nombre}</span>
-                    <span style="color:var(--primary); font-weight:bold">${p.cantidad} uds</span>
-                </div>
-            `).join('');
-
-            // Inventario
-            document.getElementById('inv-val-venta').innerText = (data.inventory.valor_venta || 0).toLocaleString() + ' €';
-            document.getElementById('inv-total-items').innerText = (data.inventory.total_items || 0);
-
-            // Alertas Stock
-            const tbody = document.querySelector('#stock-alert-table tbody');
-            if (data.low_stock.length === 0) {
-                tbody.innerHTML = '<tr><td colspan="3" style="text-align:center; color:#10b981"><i class="ph ph-check-circle"></i> Todo el inventario está bien</td></tr>';
-            } else {
-                tbody.innerHTML = data.low_stock.map(p => `
-                <tr>
-                    <td>
-                        <div style="font-weight:500">${p.nombre}</div>
-                        <div style="font-size:0.8rem; color:#94a3b8">${p.codigo}</div>
-                    </td>
-                    <td style="color:#ef4444; font-weight:bold">${p.stock} uds</td>
-                    <td><button class="btn-icon" onclick="showView('upload')"><i class="ph ph-plus-circle"></i></button></td>
-                </tr>
-            `).join('');
-            }
-        });
+        .then(data => { dashboardData = data; renderDashboard(data); });
+}
+
+function renderDashboard(data) {
+    animateValue('dash-sales', data.ventas_hoy, '€');
+    animateValue('dash-expenses', data.gastos_hoy, '€');
+    animateValue('dash-profit', data.beneficio_hoy, '€');
+
+    renderSalesChart(data.history);
+
+    // Más vendidos
+    const topList = document.getElementById('top-products-list');
+    topList.innerHTML = data.top_selling.map(p => `
+        <div style="display:flex; justify-content:space-between; padding:5px; border-bottom:1px solid rgba(255,255,255,0.05)">
+            <span>${p.nombre}</span>
+            <span style="color:var(--primary); font-weight:bold">${p.cantidad} uds</span>
+        </div>
+    `).join('');
+
+    // Inventario
+    document.getElementById('inv-val-venta').innerText = (data.inventory.valor_venta || 0).toLocaleString() + ' €';
+    document.getElementById('inv-total-items').innerText = (data.inventory.total_items || 0);
+
+    // Alertas Stock
+    const tbody = document.querySelector('#stock-alert-table tbody');
+    if (data.low_stock.length === 0) {
+        tbody.innerHTML = '<tr><td colspan="3" style="text-align:center; color:#10b981"><i class="ph ph-check-circle"></i> Todo el inventario está bien</td></tr>';
+    } else {
+        tbody.innerHTML = data.low_stock.map(p => `
+        <tr>
+            <td>
+                <div style="font-weight:500">${p.nombre}</div>
+                <div style="font-size:0.8rem; color:#94a3b8">${p.codigo}</div>
+            </td>
+            <td style="color:#ef4444; font-weight:bold">${p.stock} uds <span style="font-size:0.8rem; color:#94a3b8; font-weight:normal">/ mín. ${p.stock_minimo ?? LOW_STOCK}</span></td>
+            <td><button class="btn-icon" onclick="showView('upload')"><i class="ph ph-plus-circle"></i></button></td>
+        </tr>
+    `).join('');
+    }
 }
 
 function renderSalesChart(history) {
@@ -128,22 +135,79 @@ function animateValue(id, value, suffix) {
     }
 }
 
+// --- HISTORIALES PAGINADOS (ventas y gastos) ---
+// Filtro por días (desde/hasta) y "Cargar más" con el cursor de X-Next-Cursor
+const histories = {
+    sales: { url: '/api/ventas/historial', body: 'sales-history-body', row: v => saleRow(v), cols: 4, cursor: null, req: 0, filtro: '' },
+    expenses: { url: '/api/gastos', body: 'expenses-body', row: g => expenseRow(g), cols: 5, cursor: null, req: 0, filtro: '' },
+};
+
+function historyFilter(key) {
+    const params = new URLSearchParams();
+    const desde = document.getElementById(`${key}-desde`)?.value;
+    const hasta = document.getElementById(`${key}-hasta`)?.value;
+    if (desde) params.set('desde', desde);
+    if (hasta) params.set('hasta', hasta);
+    return params;
+}
+
+function loadHistory(key, append = false) {
+    const h = histories[key];
+    const req = ++h.req;
+    if (!append) h.filtro = historyFilter(key).toString();
+    const params = new URLSearchParams(h.filtro);
+    if (append && h.cursor) params.set('cursor', h.cursor);
+
+    return fetch(`${h.url}?${params}`).then(r => {
+        if (!r.ok) return r.json().then(e => { throw new Error(e.error); });
+        if (req === h.req) h.cursor = r.headers.get('X-Next-Cursor');
+        return r.json();
+    }).then(filas => {
+        if (req !== h.req) return false;
+        const tbody = document.getElementById(h.body);
+        tbody.querySelector('.load-more-row')?.remove();
+        const html = filas.map(h.row).join('');
+        if (append) tbody.insertAdjacentHTML('beforeend', html);
+        else tbody.innerHTML = html;
+        if (h.cursor) {
+            tbody.insertAdjacentHTML('beforeend', `
+                <tr class="load-more-row">
+                    <td colspan="${h.cols}" style="text-align:center"><button class="btn" onclick="loadHistory('${key}', true)">Cargar más</button></td>
+                </tr>
+            `);
+        }
+        return true;
+    }).catch(e => showToast(e.message, 'error'));
+}
+
+// Los eventos en vivo son siempre de hoy: si el filtro acaba antes, no se añaden
+function historyShowsToday(key) {
+    const hasta = new URLSearchParams(histories[key].filtro).get('hasta');
+    return !hasta || hasta >= new Date().toLocaleDateString('sv');
+}
+
+// Descarga (CSV) del periodo filtrado; el servidor la genera por lotes
+function exportHistory(tipo, key) {
+    const params = historyFilter(key);
+    params.set('formato', 'csv');
+    window.location.href = `/api/export/${tipo}?${params}`;
+}
+
 // --- GASTOS ---
-function loadExpenses() {
-    fetch('/api/gastos')
-        .then(r => r.json())
-        .then(gastos => {
-            const tbody = document.getElementById('expenses-body');
-            tbody.innerHTML = gastos.map(g => `
-            <tr>
+function loadExpenses(append = false) {
+    loadHistory('expenses', append);
+}
+
+function expenseRow(g) {
+    return `
+            <tr data-id="${g.id}">
                 <td>${new Date(g.fecha).toLocaleDateString()}</td>
                 <td>${g.concepto}</td>
                 <td><span class="badge" style="background:rgba(255,255,255,0.1); font-weight:400">${g.categoria}</span></td>
                 <td style="color:var(--danger)">-${g.monto.toFixed(2)} €</td>
                 <td><button class="btn-icon" onclick="deleteExpense(${g.id})"><i class="ph ph-trash"></i></button></td>
             </tr>
-        `).join('');
-        });
+        `;
 }
 
 function addExpense() {
@@ -162,34 +226,31 @@ function addExpense() {
             showToast('Gasto registrado');
             document.getElementById('exp-desc').value = '';
             document.getElementById('exp-amount').value = '';
-            loadExpenses();
+            if (!liveConnected) loadExpenses(); // Con /api/events llega el gasto como evento
         });
 }
 
 function deleteExpense(id) {
     if (confirm('¿Borrar registro?')) {
-        fetch(`/api/gastos/${id}`, { method: 'DELETE' }).then(loadExpenses);
+        fetch(`/api/gastos/${id}`, { method: 'DELETE' }).then(() => { if (!liveConnected) loadExpenses(); });
     }
 }
 
 // --- VENTAS HISTORIAL ---
-function loadSalesHistory() {
-    fetch('/api/ventas/historial')
-        .then(r => r.json())
-        .then(ventas => {
-            const tbody = document.getElementById('sales-history-body');
-            tbody.innerHTML = ventas.map(v => {
-                const itemsSummary = v.items.map(i => `${i.cantidad}x ${i.nombre}`).join(', ');
-                return `
-            <tr>
+function loadSalesHistory(append = false) {
+    loadHistory('sales', append).then(ok => { if (ok) salesHistoryLoaded = true; });
+}
+
+function saleRow(v) {
+    const itemsSummary = v.items.map(i => `${i.cantidad}x ${i.nombre}`).join(', ');
+    return `
+            <tr data-id="${v.id}">
                 <td style="font-family:monospace">#${v.id}</td>
                 <td>${new Date(v.fecha).toLocaleString()}</td>
                 <td style="font-weight:bold; color:var(--success)">+${v.total.toFixed(2)} €</td>
                 <td style="font-size:0.9rem; color:#94a3b8; max-width:300px; white-space:nowrap; overflow:hidden; text-overflow:ellipsis" title="${itemsSummary}">${itemsSummary}</td>
             </tr>
             `;
-            }).join('');
-        });
 }
 
 // --- POS / TPV (Adaptado) ---
@@ -377,9 +438,9 @@ function printTicket() {
 }
 
 function loadQuickCatalog() {
-    fetch('/api/productos').then(r => r.json()).then(prods => {
+    fetch('/api/productos?limit=15&fields=codigo,nombre,venta').then(r => r.json()).then(prods => {
         const grid = document.getElementById('quick-products-grid');
-        grid.innerHTML = prods.slice(0, 15).map(p => `
+        grid.innerHTML = prods.map(p => `
             <div class="product-card" onclick="scanProduct('${p.codigo}')">
                 <div style="font-size:0.85rem; height:40px; overflow:hidden">${p.nombre}</div>
                 <div style="margin-top:5px; font-weight:700; color:var(--warning)">${p.venta.toFixed(2)} €</div>
@@ -389,16 +450,20 @@ function loadQuickCatalog() {
 }
 
 // --- UPLOAD & INVENTORY (Simplificado) ---
-function loadInventory() {
-    fetch('/api/productos').then(r => r.json()).then(prods => {
-        document.getElementById('inventory-body').innerHTML = prods.map(p => `
-            <tr>
+const INVENTORY_PAGE_SIZE = 100;
+let inventoryCursor = null;
+let inventorySearch = '';
+let inventoryRequest = 0;
+
+function inventoryRow(p) {
+    return `
+            <tr data-id="${p.id}">
                 <td style="font-family:monospace">${p.codigo}</td>
                 <td>${p.nombre}</td>
                 <td>
                     <div style="display:flex; align-items:center; gap:8px">
                         <button class="btn-icon" onclick="updateStock(${p.id}, -1)" style="font-size:0.8rem"><i class="ph ph-minus"></i></button>
-                        <span class="badge ${p.stock < 5 ? 'bg-red' : 'bg-gray'}">${p.stock}</span>
+                        <span class="badge stock-badge ${isLowStock(p) ? 'bg-red' : 'bg-gray'}" title="Mínimo: ${p.stock_minimo ?? LOW_STOCK}">${p.stock}</span>
                         <button class="btn-icon" onclick="updateStock(${p.id}, 1)" style="font-size:0.8rem"><i class="ph ph-plus"></i></button>
                     </div>
                 </td>
@@ -406,7 +471,33 @@ function loadInventory() {
                 <td>${p.venta.toFixed(2)}</td>
                 <td><button class="btn-icon" onclick="deleteProduct(${p.id})"><i class="ph ph-trash"></i></button></td>
             </tr>
-        `).join('');
+        `;
+}
+
+// Carga una página del inventario; append=true añade la siguiente página
+function loadInventory(append = false) {
+    const req = ++inventoryRequest;
+    let url = `/api/productos?limit=${INVENTORY_PAGE_SIZE}&fields=codigo,nombre,stock,stock_minimo,costo,venta`;
+    if (inventorySearch) url += `&search=${encodeURIComponent(inventorySearch)}`;
+    if (append && inventoryCursor) url += `&cursor=${inventoryCursor}`;
+
+    fetch(url).then(r => {
+        if (req === inventoryRequest) inventoryCursor = r.headers.get('X-Next-Cursor');
+        return r.json();
+    }).then(prods => {
+        if (req !== inventoryRequest) return; // Respuesta antigua (p.ej. búsqueda ya cambiada)
+        const tbody = document.getElementById('inventory-body');
+        tbody.querySelector('.load-more-row')?.remove();
+        const html = prods.map(inventoryRow).join('');
+        if (append) tbody.insertAdjacentHTML('beforeend', html);
+        else tbody.innerHTML = html;
+        if (inventoryCursor) {
+            tbody.insertAdjacentHTML('beforeend', `
+                <tr class="load-more-row">
+                    <td colspan="6" style="text-align:center"><button class="btn" onclick="loadInventory(true)">Cargar más</button></td>
+                </tr>
+            `);
+        }
     });
 }
 
@@ -439,22 +530,121 @@ function setupFileUpload() {
     const zone = document.getElementById('drop-zone');
     if (!input) return; // Puede no existir en todas las vistas inicialmente si hidden
     zone.onclick = () => input.click();
-    input.onchange = (e) => handleUpload(e.target.files[0]);
+    input.onchange = (e) => {
+        const files = e.target.files;
+        if (files.length > 1) handleBatchUpload(files); else handleUpload(files[0]);
+    };
     // Drag handlers ignored for brevity but same logic
 }
 
 function handleUpload(file) {
     if (!file) return;
     const fd = new FormData(); fd.append('file', file);
-    document.getElementById('drop-zone').innerHTML = '<i class="ph ph-spinner ph-spin"></i>';
+    const zone = document.getElementById('drop-zone');
+    zone.innerHTML = '<i class="ph ph-spinner ph-spin"></i>';
 
+    // El servidor encola el albarán y responde con un job_id; seguimos su progreso
     fetch('/api/upload', { method: 'POST', body: fd }).then(r => r.json()).then(res => {
-        document.getElementById('drop-zone').innerHTML = '<i class="ph ph-file-image"></i>';
-        if (res.success) showDetected(res.productos);
-        else showToast(res.error, 'error');
+        if (!res.job_id) {
+            zone.innerHTML = '<i class="ph ph-file-image"></i>';
+            return showToast(res.error, 'error');
+        }
+        watchJob(res.job_id, job => {
+            zone.innerHTML = `<i class="ph ph-spinner ph-spin"></i><p>${job.mensaje}</p>`;
+        }).then(job => {
+            zone.innerHTML = '<i class="ph ph-file-image"></i>';
+            const res = job.resultado || {};
+            if (job.estado === 'completado') {
+                showDetected(res.productos);
+                if (res.rechazadas) showToast(`${res.rechazadas} filas descartadas (sin código o nombre)`, 'error');
+            }
+            else if (job.estado !== 'cancelado') showToast(job.mensaje, 'error');
+        });
+    });
+}
+
+// Sigue un trabajo por SSE (o long polling si no hay EventSource) hasta que termina
+function watchJob(id, onUpdate) {
+    const FINALES = ['completado', 'error', 'cancelado'];
+    return new Promise(resolve => {
+        if (window.EventSource) {
+            const es = new EventSource(`/api/jobs/${id}/events`);
+            es.addEventListener('job', e => {
+                const job = JSON.parse(e.data);
+                if (FINALES.includes(job.estado)) { es.close(); resolve(job); }
+                else onUpdate(job);
+            });
+            es.onerror = () => { es.close(); pollJob(id, -1, onUpdate, FINALES).then(resolve); };
+        } else {
+            pollJob(id, -1, onUpdate, FINALES).then(resolve);
+        }
+    });
+}
+
+async function pollJob(id, version, onUpdate, FINALES) {
+    while (true) {
+        const job = await fetch(`/api/jobs/${id}?wait=20&version=${version}`).then(r => r.json());
+        if (job.error || FINALES.includes(job.estado)) return job.error ? { estado: 'error', mensaje: job.error } : job;
+        // Sin cambios: el servidor no tenía hilo libre para esperar y respondió al momento
+        if (job.version === version) { await new Promise(r => setTimeout(r, 1500)); continue; }
+        onUpdate(job);
+        version = job.version;
+    }
+}
+
+// Varias páginas/ficheros de una entrega: el servidor los extrae en paralelo y
+// va mandando la lista combinada (SKU repetidos sumados) según termina cada uno
+function handleBatchUpload(files) {
+    const fd = new FormData();
+    Array.from(files).forEach(f => fd.append('files', f));
+    const zone = document.getElementById('drop-zone');
+    zone.innerHTML = '<i class="ph ph-spinner ph-spin"></i>';
+
+    fetch('/api/upload/batch', { method: 'POST', body: fd }).then(r => r.json()).then(res => {
+        if (!res.lote_id) {
+            zone.innerHTML = '<i class="ph ph-file-image"></i>';
+            return showToast(res.error, 'error');
+        }
+        const progreso = lote => {
+            zone.innerHTML = `<i class="ph ph-spinner ph-spin"></i><p>${lote.terminados} de ${lote.total} ficheros</p>`;
+        };
+        const parcial = lote => {
+            progreso(lote);
+            if (lote.productos.length) showDetected(lote.productos);
+        };
+        const fin = lote => {
+            zone.innerHTML = '<i class="ph ph-file-image"></i>';
+            showDetected(lote.productos);
+            const fallidos = lote.jobs.filter(j => j.estado === 'error');
+            if (fallidos.length) showToast(`No se pudieron leer: ${fallidos.map(j => j.descripcion).join(', ')}`, 'error');
+            if (lote.rechazadas) showToast(`${lote.rechazadas} filas descartadas (sin código o nombre)`, 'error');
+        };
+
+        if (window.EventSource) {
+            const es = new EventSource(`/api/lotes/${res.lote_id}/events`);
+            es.addEventListener('progreso', e => progreso(JSON.parse(e.data)));
+            es.addEventListener('lote', e => {
+                const lote = JSON.parse(e.data);
+                if (lote.estado === 'completado') { es.close(); fin(lote); }
+                else parcial(lote);
+            });
+            es.onerror = () => { es.close(); pollLote(res.lote_id, parcial, fin); };
+        } else {
+            pollLote(res.lote_id, parcial, fin);
+        }
     });
 }
 
+async function pollLote(id, parcial, fin) {
+    while (true) {
+        const lote = await fetch(`/api/lotes/${id}`).then(r => r.json());
+        if (lote.error) return showToast(lote.error, 'error');
+        if (lote.estado === 'completado') return fin(lote);
+        parcial(lote);
+        await new Promise(r => setTimeout(r, 1500));
+    }
+}
+
 function showDetected(items) {
     document.getElementById('view-upload').querySelector('.upload-hero').classList.add('hidden');
     document.getElementById('ocr-results-panel').classList.remove('hidden');
@@ -469,63 +659,40 @@ function showDetected(items) {
     `).join('');
 
     document.getElementById('save-all-btn').onclick = async () => {
-        for (const tr of tbody.querySelectorAll('tr')) {
-            const p = {
-                codigo: tr.querySelector('[name=cod]').value,
-                nombre: tr.querySelector('[name=nom]').value,
-                stock: tr.querySelector('[name=cant]').value,
-                venta: tr.querySelector('[name=pvp]').value,
-                costo: 0 // Si no lo editamos se queda 0 a menos que venga del server
-            };
-            await fetch('/api/productos', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(p) });
+        const productos = Array.from(tbody.querySelectorAll('tr')).map(tr => ({
+            codigo: tr.querySelector('[name=cod]').value,
+            nombre: tr.querySelector('[name=nom]').value,
+            stock: tr.querySelector('[name=cant]').value,
+            venta: tr.querySelector('[name=pvp]').value,
+            costo: items[tr.dataset.idx].costo || 0 // El costo no se edita: el que vino del albarán
+        }));
+        // Un único POST con todo el albarán (una transacción en el servidor)
+        const res = await fetch('/api/productos/bulk', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ productos }) })
+            .then(r => r.json());
+        if (res.errores && res.errores.length) {
+            showToast(`Guardado con ${res.errores.length} errores`, 'error');
+        } else if (res.error) {
+            return showToast(res.error, 'error');
+        } else {
+            showToast('Guardado');
         }
-        showToast('Guardado');
         document.getElementById('ocr-results-panel').classList.add('hidden');
         document.getElementById('view-upload').querySelector('.upload-hero').classList.remove('hidden');
     };
 }
 
 window.updateStock = async (id, delta) => {
-    const prods = await fetch('/api/productos').then(r => r.json());
-    const p = prods.find(x => x.id === id);
-    if (!p) return;
-    await fetch('/api/productos', {
+    await fetch('/api/stock/movimientos', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            codigo: p.codigo,
-            nombre: p.nombre,
-            costo: p.costo,
-            venta: p.venta,
-            stock: delta
-        })
+        body: JSON.stringify({ movimientos: [{ id, delta }], motivo: 'inventario' })
     });
-    loadInventory();
+    if (!liveConnected) loadInventory();
 };
 
 document.getElementById('inventory-search')?.addEventListener('input', (e) => {
-    const term = e.target.value.toLowerCase();
-    fetch(`/api/productos?search=${encodeURIComponent(term)}`)
-        .then(r => r.json())
-        .then(prods => {
-            const tbody = document.getElementById('inventory-body');
-            tbody.innerHTML = prods.map(p => `
-                <tr>
-                    <td style="font-family:monospace">${p.codigo}</td>
-                    <td>${p.nombre}</td>
-                    <td>
-                        <div style="display:flex; align-items:center; gap:8px">
-                            <button class="btn-icon" onclick="updateStock(${p.id}, -1)" style="font-size:0.8rem"><i class="ph ph-minus"></i></button>
-                            <span class="badge ${p.stock < 5 ? 'bg-red' : 'bg-gray'}">${p.stock}</span>
-                            <button class="btn-icon" onclick="updateStock(${p.id}, 1)" style="font-size:0.8rem"><i class="ph ph-plus"></i></button>
-                        </div>
-                    </td>
-                    <td>${p.costo.toFixed(2)}</td>
-                    <td>${p.venta.toFixed(2)}</td>
-                    <td><button class="btn-icon" onclick="deleteProduct(${p.id})"><i class="ph ph-trash"></i></button></td>
-                </tr>
-            `).join('');
-        });
+    inventorySearch = e.target.value.toLowerCase();
+    loadInventory();
 });
 
 // --- MOBILE & MANUAL ADD ---
@@ -552,6 +719,8 @@ async function saveManualProduct() {
         venta: parseFloat(document.getElementById('man-price').value) || 0,
         stock: parseInt(document.getElementById('man-stock').value) || 0
     };
+    const minimo = document.getElementById('man-min').value;
+    if (minimo !== '') p.stock_minimo = parseInt(minimo);
 
     if (!p.codigo || !p.nombre) return showToast('Código y Nombre obligatorios', 'error');
 
@@ -564,9 +733,9 @@ async function saveManualProduct() {
     if (res.ok) {
         showToast('Producto guardado');
         closeModal('manual-add-modal');
-        loadInventory();
+        if (!liveConnected) loadInventory();
         // Limpiar
-        ['man-code', 'man-name', 'man-cost', 'man-price', 'man-stock'].forEach(id => document.getElementById(id).value = '');
+        ['man-code', 'man-name', 'man-cost', 'man-price', 'man-stock', 'man-min'].forEach(id => document.getElementById(id).value = '');
     } else {
         showToast('Error al guardar', 'error');
     }
@@ -610,6 +779,127 @@ window.closeModal = (id) => {
 
 window.deleteProduct = (id) => {
     if (confirm('¿Eliminar producto?')) {
-        fetch(`/api/productos/${id}`, { method: 'DELETE' }).then(loadInventory);
+        fetch(`/api/productos/${id}`, { method: 'DELETE' }).then(() => { if (!liveConnected) loadInventory(); });
+    }
+}
+
+// --- TIEMPO REAL (/api/events) ---
+// El servidor manda un delta por cada venta, ajuste de stock, producto o gasto
+// (de cualquier terminal) y las vistas se actualizan sin recargar las listas.
+let liveConnected = false;
+let salesHistoryLoaded = false;
+const LOW_STOCK = 5; // si el producto no trae su stock_minimo
+
+function isLowStock(p) {
+    return p.stock <= (p.stock_minimo ?? LOW_STOCK);
+}
+
+let liveRetryMs = 0; // espera antes de reabrir /api/events; 0 = conectado o primer intento
+
+function setupLiveUpdates() {
+    if (!window.EventSource) return;
+    const es = new EventSource('/api/events');
+    es.onopen = () => {
+        liveConnected = true;
+        // Conexión nueva tras cerrarse la anterior: sin Last-Event-ID, se recarga lo perdido
+        if (liveRetryMs) reloadLiveViews();
+        liveRetryMs = 0;
+    };
+    es.onerror = () => {
+        liveConnected = false;
+        // Tras un corte EventSource reintenta solo, pero una respuesta de error
+        // (503: demasiados terminales conectados) lo cierra para siempre
+        if (es.readyState === EventSource.CLOSED) {
+            liveRetryMs = Math.min((liveRetryMs || 2500) * 2, 60000);
+            setTimeout(setupLiveUpdates, liveRetryMs * (0.8 + Math.random() * 0.4));
+        }
+    };
+    const on = (tipo, fn) => es.addEventListener(tipo, e => fn(JSON.parse(e.data)));
+    on('venta', applySaleEvent);
+    on('stock', d => applyStockChanges(d.stock));
+    on('producto', applyProductEvent);
+    on('gasto', applyExpenseEvent);
+    // Eventos perdidos (reinicio del servidor o mucho tiempo desconectado)
+    on('reset', reloadLiveViews);
+}
+
+function reloadLiveViews() {
+    loadDashboard(); loadInventory(); loadSalesHistory(); loadExpenses();
+}
+
+function isToday(dia) {
+    return dia === new Date().toLocaleDateString('sv'); // sv -> YYYY-MM-DD
+}
+
+function applySaleEvent(v) {
+    const tbody = document.getElementById('sales-history-body');
+    // Sin recortar la tabla: las páginas ya cargadas con "Cargar más" siguen valiendo
+    if (tbody && salesHistoryLoaded && historyShowsToday('sales')) tbody.insertAdjacentHTML('afterbegin', saleRow(v));
+    applyStockChanges(v.stock);
+    if (!dashboardData) return;
+    const d = dashboardData;
+    if (isToday(v.dia)) {
+        d.ventas_hoy += v.total;
+        d.beneficio_hoy = d.ventas_hoy - d.gastos_hoy;
+        const hoy = d.history.find(h => h.dia === v.dia);
+        if (hoy) hoy.total += v.total; else d.history.push({ dia: v.dia, total: v.total });
+    }
+    v.items.forEach(i => {
+        const top = d.top_selling.find(t => t.codigo === i.codigo);
+        if (top) top.cantidad += i.cantidad; else d.top_selling.push({ codigo: i.codigo, nombre: i.nombre, cantidad: i.cantidad });
+        d.inventory.total_items = (d.inventory.total_items || 0) - i.cantidad;
+        d.inventory.valor_venta = (d.inventory.valor_venta || 0) - i.cantidad * i.precio;
+    });
+    d.top_selling = d.top_selling.sort((a, b) => b.cantidad - a.cantidad).slice(0, 5);
+    renderDashboard(d);
+}
+
+// stock: [{id, codigo, nombre, stock}] con el stock resultante
+function applyStockChanges(stock) {
+    stock.forEach(p => {
+        const badge = document.querySelector(`#inventory-body tr[data-id="${p.id}"] .stock-badge`);
+        if (badge) {
+            badge.textContent = p.stock;
+            badge.classList.toggle('bg-red', isLowStock(p));
+            badge.classList.toggle('bg-gray', !isLowStock(p));
+        }
+    });
+    if (!dashboardData) return;
+    let low = dashboardData.low_stock.filter(l => !stock.some(p => p.codigo === l.codigo));
+    low = low.concat(stock.filter(isLowStock));
+    dashboardData.low_stock = low.sort((a, b) => a.stock - b.stock).slice(0, 5);
+    renderDashboard(dashboardData);
+}
+
+function applyProductEvent(ev) {
+    const tbody = document.getElementById('inventory-body');
+    if (ev.accion === 'importados') {
+        // Importación masiva: una sola recarga en vez de miles de deltas
+        loadInventory();
+        if (dashboardData) loadDashboard();
+        return;
+    }
+    const row = tbody?.querySelector(`tr[data-id="${ev.accion === 'borrado' ? ev.id : ev.producto.id}"]`);
+    if (ev.accion === 'borrado') {
+        row?.remove();
+        if (dashboardData) loadDashboard();
+        return;
+    }
+    if (row) row.outerHTML = inventoryRow(ev.producto);
+    else if (tbody && !inventorySearch && !inventoryCursor) tbody.insertAdjacentHTML('afterbegin', inventoryRow(ev.producto));
+    applyStockChanges([ev.producto]);
+}
+
+function applyExpenseEvent(ev) {
+    const tbody = document.getElementById('expenses-body');
+    if (ev.accion === 'nuevo') {
+        if (tbody && historyShowsToday('expenses') && !tbody.querySelector(`tr[data-id="${ev.gasto.id}"]`)) tbody.insertAdjacentHTML('afterbegin', expenseRow(ev.gasto));
+    } else {
+        tbody?.querySelector(`tr[data-id="${ev.id}"]`)?.remove();
+    }
+    if (dashboardData && isToday(ev.dia)) {
+        dashboardData.gastos_hoy += ev.accion === 'nuevo' ? ev.gasto.monto : -ev.monto;
+        dashboardData.beneficio_hoy = dashboardData.ventas_hoy - dashboardData.gastos_hoy;
+        renderDashboard(dashboardData);
     }
 }
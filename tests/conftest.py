@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+@pytest.fixture
+def bd(tmp_path, monkeypatch):
+    """database.py sobre una BD vacía en una carpeta temporal."""
+    monkeypatch.setattr(database, 'DB_NAME', str(tmp_path / 'tpv.db'))
+    database.init_db()
+    yield database
+    database.close_writer()
+    database.close_pool()
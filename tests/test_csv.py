@@ -0,0 +1,17 @@
+import ocr_service
+
+
+def test_cantidades_no_finitas_no_hacen_fallar_el_albaran(tmp_path):
+    ruta = tmp_path / 'albaran.csv'
+    ruta.write_text('codigo;nombre;cantidad;costo\n'
+                    'A;Leche;inf;1,5\n'
+                    'B;Pan;1e30;-inf\n'
+                    'C;Huevos;3;2\n', encoding='utf-8')
+
+    res = ocr_service.procesar_csv(str(ruta))
+
+    assert res['success'] is True
+    por_codigo = {p['codigo']: p for p in res['productos']}
+    assert por_codigo['A']['unidades'] == 1 and por_codigo['A']['costo'] == 1.5
+    assert por_codigo['B']['unidades'] == 1 and por_codigo['B']['costo'] == 0.0
+    assert por_codigo['C']['unidades'] == 3
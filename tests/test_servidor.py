@@ -0,0 +1,28 @@
+import urllib.request
+
+import pytest
+from flask import Flask
+
+import server
+
+
+@pytest.mark.skipif(not server.HAS_WAITRESS, reason='waitress no está instalado')
+def test_servidor_arranca_y_para():
+    app = Flask(__name__)
+
+    @app.route('/ping')
+    def ping():
+        return 'ok'
+
+    servidor = server.Servidor(app, host='127.0.0.1', port=0, threads=2, shutdown_timeout=2)
+    servidor.iniciar()
+    puerto = servidor.server.effective_port
+    with urllib.request.urlopen(f'http://127.0.0.1:{puerto}/ping', timeout=5) as resp:
+        assert resp.read() == b'ok'
+
+    servidor.cerrar()
+    servidor.esperar()
+    servidor._hilo.join(5)
+    assert not servidor._hilo.is_alive()
+    with pytest.raises(OSError):
+        urllib.request.urlopen(f'http://127.0.0.1:{puerto}/ping', timeout=2)
@@ -0,0 +1,75 @@
+import os
+import time
+
+
+def _stock(bd, codigo):
+    conn = bd.get_db_connection()
+    try:
+        return conn.execute('SELECT stock FROM productos WHERE codigo = ?', (codigo,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _num_ventas(bd):
+    conn = bd.get_db_connection()
+    try:
+        return conn.execute('SELECT COUNT(*) FROM ventas').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_lote_atomico_anulado_no_da_por_guardado_ningun_ticket(bd):
+    bd.add_or_update_product('A', 'Leche', 1.0, 2.0, 10)
+    res = bd.procesar_ventas_batch([
+        {"items": [{"codigo": "A", "cantidad": 1, "precio": 2.0}]},
+        {"items": [{"codigo": "NO-EXISTE", "cantidad": 1, "precio": 2.0}]},
+    ], atomico=True)
+
+    assert res['success'] is False
+    assert res['procesados'] == 0
+    assert [r['ticket'] for r in res['resultados']] == [0, 1]
+    for r in res['resultados']:
+        assert r['success'] is False
+        assert 'id' not in r and 'total' not in r
+    assert res['resultados'][0]['error'] == 'Anulado por el lote'
+    assert _num_ventas(bd) == 0
+    assert _stock(bd, 'A') == 10
+
+
+def test_lote_no_atomico_guarda_los_tickets_validos(bd):
+    bd.add_or_update_product('A', 'Leche', 1.0, 2.0, 10)
+    res = bd.procesar_ventas_batch([
+        {"items": [{"codigo": "A", "cantidad": 1, "precio": 2.0}]},
+        {"items": [{"codigo": "NO-EXISTE", "cantidad": 1, "precio": 2.0}]},
+    ])
+
+    assert res['procesados'] == 1
+    assert res['resultados'][0]['success'] is True and 'id' in res['resultados'][0]
+    assert res['resultados'][1]['success'] is False
+    assert _num_ventas(bd) == 1
+    assert _stock(bd, 'A') == 9
+
+
+def test_ventas_de_un_producto_por_dia_local(bd):
+    tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/Madrid'
+    time.tzset()
+    try:
+        bd.add_or_update_product('A', 'Leche', 1.0, 2.0, 10)
+        # 22:30 UTC del 17 = 00:30 del 18 en Madrid (CEST)
+        bd.procesar_ventas_batch([
+            {"items": [{"codigo": "A", "cantidad": 2, "precio": 2.0}], "fecha": "2026-10-17 22:30:00"},
+            {"items": [{"codigo": "A", "cantidad": 1, "precio": 2.0}], "fecha": "2026-10-17 21:30:00"},
+        ])
+
+        ventas = bd.get_product_sales('A', '2026-10-18', '2026-10-18')
+        assert ventas['cantidad'] == 2
+        assert ventas['dias'] == [{"dia": "2026-10-18", "cantidad": 2, "importe": 4.0}]
+        informe = bd.get_report('2026-10-18', '2026-10-18')
+        assert informe['ventas'] == ventas['importe']
+    finally:
+        if tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()